@@ -10,4 +10,6 @@
 
 from pyidm import PyIDM
 
-PyIDM.main()
+# guard is required, download engine child processes import this module, see engine.py
+if __name__ == '__main__':
+    PyIDM.main()
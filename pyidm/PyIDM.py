@@ -30,6 +30,7 @@ if hasattr(sys, 'frozen'):  # like if application frozen by cx_freeze
 # standard modules
 from threading import Thread
 import time
+import multiprocessing
 
 
 # This code should stay on top to handle relative imports in case of direct call of pyIDM.py
@@ -125,6 +126,8 @@ def is_solo():
 
 
 def main():
+    # child processes of download engine start from here when app is frozen, see engine.py
+    multiprocessing.freeze_support()
 
     # quit if there is previous instance of this App. already running
     if not is_solo():
@@ -8,18 +8,27 @@
 """
 import os
 import time
-from threading import Thread
+import pycurl
+from threading import Thread, Lock
 import concurrent.futures
 
-from .video import merge_video_audio, unzip_ffmpeg, pre_process_hls, post_process_hls, \
-    convert_audio, download_subtitles, write_metadata  # unzip_ffmpeg required here for ffmpeg callback
-from . import config
-from .config import Status, active_downloads, APP_NAME
+from .video import unzip_ffmpeg, pre_process_hls, post_process_hls, process_media, download_subtitles, \
+    decrypt_segment, plan_stream_postprocess, StreamPostProcessor, main_stream_type, \
+    refresh_stream_urls  # unzip_ffmpeg required here for ffmpeg callback
+from . import config, postprocessing, retry, cache, storage
+from .config import Status, MediaType, active_downloads, APP_NAME
 from .utils import (log, size_format, popup, notify, delete_folder, delete_file, rename_file, load_json, save_json,
-                    print_object, calc_md5, calc_sha256, run_command)
+                    print_object, calc_md5, calc_sha256, set_curl_options, translate_server_code,
+                    get_prefetched, get_headers, execute_command)
 from .worker import Worker
+from .engine import ProcessWorker
 from .downloaditem import Segment
 
+# running downloads by their resource, see share_transfer()
+_transfers = {}  # key: transfer key, value: DownloadItem object
+_transfers_lock = Lock()
+transfer_stats = {'shared': 0, 'bytes_saved': 0}
+
 
 def brain(d=None, downloader=None):
     """main brain for a single download, it controls thread manger, file manager, and get data from workers
@@ -32,6 +41,9 @@ def brain(d=None, downloader=None):
     else:
         d.status = Status.downloading
 
+    # temp files location, download folder or scratch folder on another device
+    d.scratch_temp = storage.use_scratch_temp(d)
+
     # first we will remove temp files because file manager is appending segments blindly to temp file
     delete_file(d.temp_file)
     delete_file(d.audio_file)
@@ -43,39 +55,62 @@ def brain(d=None, downloader=None):
     log('=' * 106)
     log(f'start downloading file: "{d.name}", size: {size_format(d.total_size)}, to: {d.folder}')
 
-    # hls / m3u8 protocols
-    if 'hls' in d.subtype_list:
-        keep_segments = True  # don't delete segments after completed, it will be post-processed by ffmpeg
-        try:
-            success = pre_process_hls(d)
-            if not success:
+    # file manager and thread manager threads
+    managers = []
+
+    # same file downloaded before, create it from local cache without network
+    cached = cache.restore(d)
+    if cached:
+        if d.selected_subtitles:
+            Thread(target=download_subtitles, args=(d.selected_subtitles, d)).start()
+        d.status = Status.completed
+
+    # same resource downloaded now by another item, wait for it and copy its file instead of fetching same bytes twice
+    shared = not cached and share_transfer(d)
+    if shared:
+        d.status = Status.completed
+
+    # small files, one request directly to file, without temp folder, segments, or file / thread managers
+    fast_path = not cached and not shared and use_fast_path(d) and download_small_file(d)
+
+    if not cached and not shared and not fast_path:
+        # hls / m3u8 protocols
+        if 'hls' in d.subtype_list:
+            keep_segments = True  # don't delete segments after completed, it will be post-processed by ffmpeg
+            try:
+                success = pre_process_hls(d)
+                if not success:
+                    d.status = Status.error
+                    return
+            except Exception as e:
                 d.status = Status.error
+                log('pre_process_hls()> error: ', e, showpopup=True)
+                if config.TEST_MODE:
+                    raise e
                 return
-        except Exception as e:
-            d.status = Status.error
-            log('pre_process_hls()> error: ', e, showpopup=True)
-            if config.TEST_MODE:
-                raise e
-            return
-    else:
-        # for non hls videos and normal files
-        keep_segments = True  # False
+        else:
+            # for non hls videos and normal files
+            keep_segments = True  # False
 
-        # build segments
-        d.build_segments()
+            # build segments
+            d.build_segments()
 
-    # load progress info
-    d.load_progress_info()
+        # load progress info
+        d.load_progress_info()
 
-    # run file manager in a separate thread
-    Thread(target=file_manager, daemon=True, args=(d, keep_segments)).start()
+        # file start bytes downloaded while getting headers
+        d.use_prefetched_data()
 
-    # run thread manager in a separate thread
-    Thread(target=thread_manager, daemon=True, args=(d,)).start()
+        # run file manager in a separate thread
+        managers.append(Thread(target=file_manager, daemon=True, args=(d, keep_segments)))
 
-    while True:
-        time.sleep(0.1)  # a sleep time to make the program responsive
+        # run thread manager in a separate thread
+        managers.append(Thread(target=thread_manager, daemon=True, args=(d,)))
+
+        for thread in managers:
+            thread.start()
 
+    while True:
         if d.status == Status.completed:
             # os notification popup
             notification = f"File: {d.name} \nsaved at: {d.folder}"
@@ -88,6 +123,14 @@ def brain(d=None, downloader=None):
         elif d.status == Status.error:
             log(f'brain {d.num}: download error')
             break
+        elif d.status == Status.pending:
+            # paused by thread manager, low disk space, wait for progress info to be saved
+            for thread in managers:
+                thread.join()
+            log(f'brain {d.num}: download paused, waiting for free disk space')
+            break
+
+        time.sleep(0.1)  # a sleep time to make the program responsive
 
     # todo: should find a better way to handle callback.
     # callback, a method or func "name" to call if download completed, it is stored as a string to be able to save it
@@ -96,6 +139,16 @@ def brain(d=None, downloader=None):
         # d.callback()
         globals()[d.callback]()
 
+    # other items downloading same resource will not wait for this one anymore
+    release_transfer(d)
+
+    # free disk space reservation, see storage.reserve()
+    storage.release(d)
+
+    # paused for low disk space, back to pending list until enough space is available, see MainWindow.start_download()
+    if d.status == Status.pending:
+        execute_command('start_download', d, silent=True)
+
     # report quitting
     log(f'brain {d.num}: quitting')
 
@@ -113,12 +166,336 @@ def brain(d=None, downloader=None):
     log('=' * 106, '\n')
 
 
+def transfer_key(d):
+    """
+    identify remote resource of a download item, by effective url, size and validators, for videos by page url and
+    selected formats, in addition to output options, see cache.output_options()
+    :param d: DownloadItem object
+    :return: string or None if resource can't be identified
+    """
+    if d.format_id:
+        return f'{cache.canonical_url(d.url)}|{d.format_id}|{d.audio_format_id or ""}|{cache.output_options(d)}'
+
+    if not d.size or not d.eff_url:
+        return None
+
+    validators = d.validators.get('main', {})
+    version = validators.get('etag') or validators.get('last-modified') or ''
+    return f'{cache.canonical_url(d.eff_url)}|{d.size}|{version}|{cache.output_options(d)}'
+
+
+def share_transfer(d):
+    """
+    if another item is downloading the same resource, i.e. same url added from clipboard and playlist, wait for it to
+    finish then copy its file, otherwise register this item as the one doing the transfer
+    :param d: DownloadItem object
+    :return: True if target file copied from other item
+    """
+    key = transfer_key(d)
+    if not key:
+        return False
+
+    with _transfers_lock:
+        leader = _transfers.get(key)
+        if not leader or leader is d or leader.target_file == d.target_file or \
+                leader.status not in (Status.downloading, Status.processing):
+            _transfers[key] = d
+            return False
+
+    log(f'"{d.name}" is being downloaded by another item: "{leader.name}", waiting to copy it')
+
+    # show leader's progress
+    while leader.status in (Status.downloading, Status.processing) and d.status == Status.downloading:
+        d.downloaded = leader.downloaded
+        time.sleep(0.1)
+
+    if d.status == Status.downloading and leader.status == Status.completed and os.path.isfile(leader.target_file):
+        # independent copy, user might edit one of them
+        method = cache.link_or_copy(leader.target_file, d.target_file, hardlink=False)
+        if method:
+            size = os.path.getsize(d.target_file)
+            d.downloaded = d.size = size
+            transfer_stats['shared'] += 1
+            transfer_stats['bytes_saved'] += size
+            log(f'"{d.name}" copied from "{leader.name}" by {method}, saved:', size_format(size))
+            return True
+
+    # other item failed or cancelled, download normally
+    if d.status != Status.downloading:
+        return False
+
+    log(f'"{d.name}" will be downloaded, shared transfer not completed by "{leader.name}"')
+    with _transfers_lock:
+        _transfers[key] = d
+
+    return False
+
+
+def release_transfer(d):
+    """remove download item from running transfers, see share_transfer()"""
+    with _transfers_lock:
+        for key in [k for k, v in _transfers.items() if v is d]:
+            _transfers.pop(key)
+
+
+def use_fast_path(d):
+    """
+    check if download item can be downloaded by one request directly to file, see download_small_file()
+    :param d: DownloadItem object
+    :return: bool
+    """
+    if not config.small_file_size or not d.eff_url or d.fragments:
+        return False
+
+    # streams need segments or multiple files
+    if any(x in d.subtype_list for x in ('hls', 'dash', 'fragmented', 'f4m', 'ism')):
+        return False
+
+    # previous download exist, let normal path resume it
+    if any(os.path.isdir(folder) for folder in d.temp_folders) or os.path.isfile(d.temp_file):
+        return False
+
+    # small size, or unknown size and no range support, it will be downloaded by one connection anyway
+    return 0 < d.size <= config.small_file_size or (not d.size and not d.resumable)
+
+
+# reusable curl handles for small files downloads, recommended by curl docs for better performance
+_curl_handles = []
+
+# shared thread pool for small files downloads, limits simultaneous connections and curl handles when many small
+# files start at once, i.e. a playlist or a batch of links
+_small_files_executor = None
+_small_files_lock = Lock()
+
+
+def get_small_files_executor():
+    """create small files thread pool on first use, its size is config.small_file_workers"""
+    global _small_files_executor
+    with _small_files_lock:
+        if _small_files_executor is None:
+            _small_files_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.small_file_workers,
+                                                                          thread_name_prefix='small file')
+        return _small_files_executor
+
+
+def download_small_file(d):
+    """
+    download file by one request on a reusable curl handle, data written directly to target file "or temp file if
+    post processing required", no temp folder, no segments, and no file / thread manager threads
+    :param d: DownloadItem object
+    :return: True if download handled "completed, cancelled, or post processing failed", and False if failed and
+    should fall back to normal download path
+    """
+    log('download_small_file()>', d.name, log_level=2)
+
+    file_name = d.temp_file if needs_postprocessing(d) else d.target_file
+    headers = {}
+
+    # whole file downloaded while getting headers, see DownloadItem.use_prefetched_data()
+    data = get_prefetched(d.eff_url, d.size) if d.size else None
+
+    def transfer():
+        """runs in shared small files thread pool, raises exception if failed"""
+        # cancelled by user while waiting for a free worker
+        if d.status != Status.downloading:
+            raise Exception('cancelled')
+
+        with open(file_name, 'wb') as file:
+            if data:
+                file.write(data)
+                d.downloaded = len(data)
+            else:
+                def header_callback(header_line):
+                    header_line = header_line.decode('iso-8859-1').lower()
+                    if ':' in header_line:
+                        name, value = header_line.split(':', 1)
+                        headers[name.strip()] = value.strip()
+
+                def write(chunk):
+                    # don't save html error pages instead of actual file, same as Worker.write()
+                    if 'text/html' in headers.get('content-type', '') and not d.accept_html:
+                        text = chunk.decode('utf-8', errors='ignore').lower()
+                        if '<html' in text or '<!doctype html' in text:
+                            return -1  # abort
+
+                    file.write(chunk)
+                    d.downloaded += len(chunk)
+
+                def progress(*args):
+                    # cancelled by user
+                    if d.status != Status.downloading:
+                        return -1  # abort
+
+                c = _curl_handles.pop() if _curl_handles else pycurl.Curl()
+                c.reset()
+                set_curl_options(c, http_headers=d.http_headers)
+                c.setopt(pycurl.URL, d.eff_url)
+                c.setopt(pycurl.NOPROGRESS, 0)
+                c.setopt(pycurl.MAX_RECV_SPEED_LARGE, config.speed_limit)
+                c.setopt(pycurl.HEADERFUNCTION, header_callback)
+                c.setopt(pycurl.WRITEFUNCTION, write)
+                c.setopt(pycurl.XFERINFOFUNCTION, progress)
+
+                try:
+                    c.perform()
+                finally:
+                    response_code = c.getinfo(pycurl.RESPONSE_CODE)
+                    _curl_handles.append(c)
+
+                if response_code >= 400:
+                    raise Exception(f'server error: {response_code} - {translate_server_code(response_code)}')
+
+        if d.size and os.path.getsize(file_name) != d.size:
+            raise Exception(f'file size mismatch: {os.path.getsize(file_name)} of {d.size}')
+
+    try:
+        # wait for a free worker in shared pool
+        get_small_files_executor().submit(transfer).result()
+
+    except Exception as e:
+        delete_file(file_name)
+        d.downloaded = 0
+
+        if d.status != Status.downloading:
+            # cancelled by user
+            return True
+
+        log('download_small_file()> failed:', e, '- fall back to normal download', log_level=2)
+        return False
+
+    # post processing and renaming temp file if needed
+    d.status = Status.processing
+    finalize(d)
+
+    return True
+
+
+def plan_finalize(d):
+    """
+    choose input files for one ffmpeg run, which does muxing, converting, and writing metadata at once
+    :param d: DownloadItem object
+    :return: list of input files, or empty list if temp file will be renamed only
+    """
+    # vtt subtitle conversion
+    subtitle = d.type == 'subtitle' and 'hls' not in d.subtype_list and d.name.endswith('srt')
+
+    # merged hls streams have mpeg-ts contents, no need for ffmpeg if target is mpeg-ts too
+    hls = 'hls' in d.subtype_list and os.path.splitext(d.target_file)[1].lower() != '.ts'
+
+    metadata = d.metadata_file_content and config.write_metadata
+
+    if 'dash' in d.subtype_list:
+        return [d.temp_file, d.audio_file]
+    elif d.type == 'audio' or subtitle or hls or metadata:
+        return [d.temp_file]
+    else:
+        return []
+
+
+def needs_postprocessing(d, streamed=False):
+    """
+    check if download item needs ffmpeg after all segments merged
+    :param d: DownloadItem object
+    :param streamed: True if post processing done already by StreamPostProcessor
+    :return: bool
+    """
+    if streamed:
+        return False
+
+    # encrypted hls streams which couldn't be decrypted while downloading
+    if 'hls' in d.subtype_list and not all(seg.merge for seg in d.segments if seg.media_type != MediaType.key):
+        return True
+
+    return bool(plan_finalize(d))
+
+
+def finalize(d, streamed=False):
+    """
+    post processing after all segments merged into temp files, i.e. ffmpeg processing, renaming temp file, etc.
+    :param d: DownloadItem object
+    :param streamed: True if post processing done already by StreamPostProcessor, target file is ready
+    :return: None
+    """
+    def failed(*args):
+        # download might be cancelled by user, and ffmpeg subprocess killed
+        if d.status == Status.processing:
+            d.status = Status.error
+            log(*args, showpopup=True)
+
+    if not streamed:
+        # handle HLS streams, ffmpeg will process local m3u8 file for streams which couldn't be merged
+        if 'hls' in d.subtype_list:
+            log('handling hls videos')
+            success = post_process_hls(d)
+            if not success:
+                failed('file_manager()>  post_process_hls() failed, file: \n', d.name)
+                return
+
+        # one ffmpeg run for merging dash video and audio, converting audio / subtitle, and writing metadata
+        inputs = plan_finalize(d)
+        if inputs and d.status == Status.processing:
+            log('file_manager()> processing:', d.name)
+            success = process_media(d, inputs, d.target_file)
+
+            if not success:
+                if d.type == 'subtitle':
+                    # if failed to convert, temp file will be renamed
+                    log("couldn't convert subtitle to srt, check file format might be corrupted")
+                else:
+                    failed('file_manager()> failed to process file: \n', d.name)
+                    return
+
+    # cancelled by user
+    if d.status != Status.processing:
+        return
+
+    # final / target file might be created by ffmpeg in case of dash video for example
+    if os.path.isfile(d.target_file):
+        # delete temp files
+        d.delete_tempfiles()
+    else:
+        # rename temp file, or copy it if on another device
+        start = time.time()
+        success = storage.move_file(d.temp_file, d.target_file, d)
+        if success:
+            # no ffmpeg run, merged hls segments are the target file already
+            stream_type = main_stream_type(d)
+            if stream_type not in d.finalize_info:
+                method = 'concat' if 'hls' in d.subtype_list else 'rename'
+                d.finalize_info[stream_type] = (method, round(time.time() - start, 2))
+
+            # delete temp files
+            d.delete_tempfiles()
+        else:
+            failed('finalize()> failed to move temp file to: \n', d.target_file)
+            return
+
+    # download subtitles
+    if d.selected_subtitles:
+        Thread(target=download_subtitles, args=(d.selected_subtitles, d)).start()
+
+    # at this point all done successfully
+    d.status = Status.completed
+
+    # add to local download cache, hashing big files takes time
+    if config.use_download_cache:
+        Thread(target=cache.store, args=(d,), daemon=True).start()
+
+
 def file_manager(d, keep_segments=True):
     # create temp files, needed for future opening in 'rb+' mode otherwise it will raise file not found error
     temp_files = set([seg.tempfile for seg in d.segments])
     for file in temp_files:
         open(file, 'ab').close()
 
+    # optional, feed ffmpeg while downloading, instead of post processing after all segments merged
+    streamer = None
+    inputs = plan_stream_postprocess(d)
+    if inputs:
+        streamer = StreamPostProcessor(d, inputs)
+        if not streamer.start():
+            streamer = None
+
     while True:
         time.sleep(0.1)
 
@@ -128,15 +505,21 @@ def file_manager(d, keep_segments=True):
         if job_list and job_list[0].range:
             job_list = sorted(job_list, key=lambda seg: seg.range[0])
 
+        # tempfiles which can't get more segments until their first non completed segment is downloaded
+        blocked = set()
+
         for seg in job_list:
 
             # for segments which have no range, it must be appended to temp file in order, or final file will be
-            # corrupted, therefore if the first non completed segment is not "downloaded", will exit loop
+            # corrupted, therefore if the first non completed segment is not "downloaded", its temp file is blocked,
+            # other tempfiles i.e. audio track of dash video can continue
+            if seg.tempfile in blocked:
+                continue
+
             if not seg.downloaded:
                 if not seg.range:
-                    break
-                else:
-                    continue
+                    blocked.add(seg.tempfile)
+                continue
 
             # append downloaded segment to temp file, mark as completed
             try:
@@ -155,8 +538,14 @@ def file_manager(d, keep_segments=True):
                             # read the exact segment size, sometimes segment has extra data as a side effect from auto segmentation
                             contents = src_file.read(seg.size)
                         else:
+                            # encrypted hls segments get decrypted in-process, its key is already downloaded
+                            contents = decrypt_segment(seg) if seg.key else src_file.read()
+
+                            # combined segments, drop unwanted bytes between fragments
+                            if seg.parts:
+                                contents = b''.join(contents[a:b + 1] for a, b in seg.parts)
+
                             target_file = open(seg.tempfile, 'ab')
-                            contents = src_file.read()
 
                         # write data
                         target_file.write(contents)
@@ -175,109 +564,33 @@ def file_manager(d, keep_segments=True):
                 if config.TEST_MODE:
                     raise e
 
-        # all segments already merged
-        if not job_list:
-
-            # handle HLS streams
-            if 'hls' in d.subtype_list:
-                log('handling hls videos')
-                # Set status to processing
-                d.status = Status.processing
-
-                success = post_process_hls(d)
-                if not success:
-                    d.status = Status.error
-                    log('file_manager()>  post_process_hls() failed, file: \n', d.name, showpopup=True)
-                    break
-
-            # handle dash video
-            if 'dash' in d.subtype_list:
-                log('handling dash videos')
-                # merge audio and video
-                output_file = d.target_file 
-
-                # set status to processing
-                d.status = Status.processing
-                error, output = merge_video_audio(d.temp_file, d.audio_file, output_file, d)
-
-                if not error:
-                    log('done merging video and audio for: ', d.target_file)
-
-                    # delete temp files
-                    d.delete_tempfiles()
-
-                else:  # error merging
-                    d.status = Status.error
-                    log('failed to merge audio for file: \n', d.name, showpopup=True)
-                    break
-
-            # handle audio streams
-            if d.type == 'audio':
-                log('handling audio streams')
-                d.status = Status.processing
-                success = convert_audio(d)
-                if not success:
-                    d.status = Status.error
-                    log('file_manager()>  convert_audio() failed, file:', d.target_file, showpopup=True)
-                    break
-                else:
-                    d.delete_tempfiles()
-
-            else:
-                # final / target file might be created by ffmpeg in case of dash video for example
-                if os.path.isfile(d.target_file):
-                    # delete temp files
-                    d.delete_tempfiles()
-                else:
-                    # rename temp file
-                    success = rename_file(d.temp_file, d.target_file)
-                    if success:
-                        # delete temp files
-                        d.delete_tempfiles()
+        # all segments already merged, live recording will add more segments until stream ends
+        if not job_list and not d.recording and d.status == Status.downloading:
 
-            # download subtitles
-            if d.selected_subtitles:
-                Thread(target=download_subtitles, args=(d.selected_subtitles, d)).start()
+            d.status = Status.processing
 
-            # if type is subtitle, will convert vtt to srt
-            if d.type == 'subtitle' and 'hls' not in d.subtype_list and d.name.endswith('srt'):
-                # ffmpeg file full location
-                ffmpeg = config.ffmpeg_actual_path
+            # streaming post processing, wait for ffmpeg to finish, fallback to normal post processing if failed
+            streamed = False
+            if streamer:
+                streamed = streamer.finish()
 
-                input_file = d.target_file
-                output_file = f'{d.target_file}2.srt'  # must end with srt for ffmpeg to recognize output format
-
-                log('verifying "srt" subtitle:', input_file)
-                cmd = f'"{ffmpeg}" -y -i "{input_file}" "{output_file}"'
-
-                error, _ = run_command(cmd, verbose=True)
-                if not error:
+                if streamed:
                     delete_file(d.target_file)
-                    rename_file(oldname=output_file, newname=input_file)
-                    log('verified subtitle successfully:', input_file)
-                else:
-                    # if failed to convert
-                    log("couldn't convert subtitle to srt, check file format might be corrupted")
+                    streamed = rename_file(streamer.output, d.target_file)
 
-            # write metadata
-            if d.metadata_file_content and config.write_metadata:
-                log('file manager()> writing metadata info to:', d.name)
-                try:
-                    # create metadata file
-                    metadata_filename = d.target_file + '.meta'
-                    with open(metadata_filename, 'w') as f:
-                        f.write(d.metadata_file_content)
+                streamer = None
 
-                    # let ffmpeg write metadata to file
-                    write_metadata(d.target_file, metadata_filename)
+            # save progress info before post processing, temp folder will be deleted afterwards
+            if any(os.path.isdir(folder) for folder in d.temp_folders):
+                d.save_progress_info()
 
-                    # delete meta file
-                    delete_file(metadata_filename)
-                except Exception as e:
-                    log('file manager()> writing metada error:', e)
+            # ffmpeg jobs and moving temp file to another device run in post processing queue, which frees
+            # download slot right away
+            if needs_postprocessing(d, streamed) or not storage.same_device(d.temp_file, d.target_file):
+                postprocessing.submit(d, finalize, streamed)
+            else:
+                finalize(d, streamed)
 
-            # at this point all done successfully
-            d.status = Status.completed
             # print('---------file manager done merging segments---------')
             break
 
@@ -286,14 +599,184 @@ def file_manager(d, keep_segments=True):
             # print('--------------file manager cancelled-----------------')
             break
 
-    # save progress info for future resuming
-    if os.path.isdir(d.temp_folder):
+    # stop streaming post processing if download cancelled
+    if streamer:
+        streamer.cancel()
+
+    # save progress info for future resuming, unless post processing job is still running
+    if any(os.path.isdir(folder) for folder in d.temp_folders) and d.status != Status.processing:
         d.save_progress_info()
 
     # Report quitting
     log(f'file_manager {d.num}: quitting')
 
 
+def use_single_connection(d):
+    """
+    replace ranged segments with one segment per temp file, for servers which ignore range requests, all
+    previously downloaded data will be discarded
+    :param d: DownloadItem object
+    :return: None
+    """
+    segments = []
+    for i, (tempfile, track) in enumerate(get_tracks(d.segments).items()):
+        if not any(seg.range for seg in track):
+            segments += track
+            continue
+
+        for seg in track:
+            delete_file(seg.name)
+
+        # file size is the end of last range
+        size = max(seg.range[1] for seg in track if seg.range) + 1
+        seg = Segment(name=os.path.join(d.temp_folder, f'single_{i}'), num=0, url=track[0].url, tempfile=tempfile,
+                      size=size, media_type=track[0].media_type)
+        segments.append(seg)
+
+        # empty temp file, it might have merged data from ranged segments
+        open(tempfile, 'wb').close()
+
+    d.segments = segments
+    d.downloaded = 0
+
+    log('Thread manager: server ignores range requests, download will continue by one connection, segments:',
+        [seg.basename for seg in segments])
+
+
+def restart_download(d):
+    """
+    discard all downloaded data and build segments again, used when remote file changed while downloading, file size
+    is taken from new remote file validators
+    :param d: DownloadItem object
+    :return: None
+    """
+    # file manager shouldn't merge old segments anymore
+    for seg in d.segments:
+        seg.downloaded = False
+        delete_file(seg.name)
+
+    # empty temp files, they might have merged data from old segments
+    for tempfile in get_tracks(d.segments):
+        open(tempfile, 'wb').close()
+
+    d.size = d.validators.get('main', {}).get('size') or d.size
+    d.audio_size = d.validators.get('audio', {}).get('size') or d.audio_size
+
+    d.build_segments()
+    d.downloaded = 0
+    d.remote_changed = False
+
+    log('Thread manager: remote file changed, download will start over:', d.name, '- new size:', size_format(d.size))
+
+
+def refresh_link(d):
+    """
+    get a fresh link for an expired url, then swap urls of not completed segments, video links are extracted again
+    by youtube-dl, other links are checked again to follow redirects to a new effective url
+    :param d: DownloadItem object
+    :return: True if any segment got a new url, False if link works with the same urls, None if refresh failed
+    """
+    old_urls = {'eff_url': d.eff_url, 'audio_url': d.audio_url}
+
+    try:
+        if d.format_id:
+            urls = refresh_stream_urls(d)
+        else:
+            headers = get_headers(d.url, http_headers=d.http_headers, use_cache=False)
+            if headers.get('status_code') in (200, 206) and not \
+                    ('text/html' in headers.get('content-type', '') and not d.accept_html):
+                d.eff_url = headers.get('eff_url')
+                urls = {}
+            else:
+                urls = None
+    except Exception as e:
+        log('refresh_link()> error:', e)
+        urls = None
+
+    if urls is None:
+        log('Thread manager: failed to refresh link for:', d.name)
+        return None
+
+    # completed segments are updated too, they might be used to build new segments, see use_single_connection()
+    changed = 0
+    for seg in d.segments:
+        if seg.name in urls:
+            url = urls[seg.name]
+        elif seg.url == old_urls['eff_url']:
+            url = d.eff_url
+        elif seg.url and seg.url == old_urls['audio_url']:
+            url = d.audio_url
+        else:
+            continue
+
+        if url and url != seg.url:
+            seg.url = url
+            seg.retries = 0
+            seg.retry_time = 0
+            changed += not seg.downloaded
+
+    log('Thread manager: refreshed link for:', d.name, '- segments with new url:', changed)
+
+    return bool(changed)
+
+
+def get_tracks(segments):
+    """
+    group segments by their tempfile, i.e. video and audio tracks of dash video, keys go with their stream
+    :param segments: list of segments
+    :return: dict of tempfile: list of segments, in original order
+    """
+    tracks = {}
+    for seg in segments:
+        tracks.setdefault(seg.tempfile, []).append(seg)
+    return tracks
+
+
+def track_shares(segments, connections):
+    """
+    calculate connections share for every track in proportion to its remaining bytes
+    :param segments: list of not downloaded segments
+    :param connections: number of allowable connections
+    :return: dict of tempfile: number of connections, i.e. {'_temp_x.mp4': 8, 'audio_for_x.mp4': 2}
+    """
+    tracks = get_tracks(segments)
+    remaining = {tempfile: sum(seg.remaining or 1 for seg in segs) for tempfile, segs in tracks.items()}
+    total = sum(remaining.values()) or 1
+
+    return {tempfile: max(round(connections * value / total), 1) for tempfile, value in remaining.items()}
+
+
+def schedule_jobs(segments):
+    """
+    order segments for downloading, for dash video, video and audio segments are interleaved in proportion to their
+    remaining bytes, so both tracks finish at about the same time and merging video with audio can start right away
+    :param segments: list of not downloaded segments
+    :return: job list, reversed to be used with pop()
+    """
+    tracks = get_tracks(segments)
+
+    if len(tracks) > 1:
+        # position of every segment in its track, as a fraction of track's total bytes
+        positions = {}
+        for segs in tracks.values():
+            known_sizes = [seg.size for seg in segs if seg.size]
+            avg_size = sum(known_sizes) / len(known_sizes) if known_sizes else 1
+            sizes = [seg.size or avg_size for seg in segs]
+            total = sum(sizes)
+
+            done = 0
+            for seg, size in zip(segs, sizes):
+                positions[id(seg)] = (done + size / 2) / total
+                done += size
+
+        segments = sorted(segments, key=lambda seg: positions[id(seg)])
+    else:
+        segments = list(segments)
+
+    segments.reverse()
+    return segments
+
+
 def thread_manager(d):
 
     #   soft start, connections will be gradually increase over time to reach max. number
@@ -301,18 +784,16 @@ def thread_manager(d):
     #   from server when exceeding multi-connection number set by server.
     limited_connections = 1
 
-    # create worker/connection list
-    all_workers = [Worker(tag=i, d=d) for i in range(config.max_connections)]
+    # create worker/connection list, process workers download in engine child processes, see engine.py
+    worker_class = ProcessWorker if config.use_process_engine else Worker
+    all_workers = [worker_class(tag=i, d=d) for i in range(config.max_connections)]
     free_workers = set([w for w in all_workers])
     threads_to_workers = dict()
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.max_connections)
     num_live_threads = 0
 
-    # job_list
-    job_list = [seg for seg in d.segments if not seg.downloaded]
-
-    # reverse job_list to process segments in proper order use pop()
-    job_list.reverse()
+    # job_list, reversed to process segments in proper order using pop()
+    job_list = schedule_jobs([seg for seg in d.segments if not seg.downloaded])
 
     d.remaining_parts = len(job_list)
 
@@ -329,6 +810,25 @@ def thread_manager(d):
     # speed limit
     sl_timer = time.time()
 
+    # fragments batching
+    batch_size = 1
+    batch_timer = 0
+
+    # connections shares for dash video tracks
+    shares = {}
+    shares_timer = 0
+
+    # free disk space check
+    space_timer = 0
+
+    # expired link refresh, see refresh_link()
+    link_refreshes = 0
+    link_refresh_timer = 0
+    refresh_thread = None
+    refresh_result = []
+    d.link_errors = []
+    d.link_refreshable = True
+
     # for compatibility reasons will reset segment size
     config.segment_size = config.DEFAULT_SEGMENT_SIZE
 
@@ -339,6 +839,65 @@ def thread_manager(d):
         for _ in range(config.error_q.qsize()):
             errors_descriptions.add(config.error_q.get())
 
+    def get_batch_size():
+        """
+        number of consecutive fragments to be downloaded by one worker, target is a batch takes around
+        config.batch_duration seconds, a fragment takes a round trip time plus its transfer time
+        :return: int
+        """
+        # fragments are segments with no range, ranged segments are big enough
+        sizes = [seg.size for seg in d.segments if not seg.range and seg.size]
+        if not config.fragment_batching or len(sizes) < 2:
+            return 1
+
+        avg_size = sum(sizes) / len(sizes)
+
+        rtt_list = [w.rtt for w in all_workers if w.rtt]
+        rtt = sum(rtt_list) / len(rtt_list) if rtt_list else 0.1
+
+        # speed per connection
+        speed = d.speed / max(num_live_threads, 1) if d.speed else 0
+
+        fragment_time = rtt + avg_size / speed if speed else rtt * 2
+        size = int(config.batch_duration / max(fragment_time, 0.001))
+
+        # keep all connections busy
+        size = min(size, len(job_list) // max(config.max_connections, 1), config.max_batch_size)
+
+        return max(size, 1)
+
+    def pop_job():
+        """
+        pop next job from job list, for dash video every track gets a connections share in proportion to its remaining
+        bytes, if next job's track already uses its share, a job from the other track will be used instead
+        :return: Segment object
+        """
+        nonlocal shares, shares_timer
+
+        if 'dash' in d.subtype_list and len(job_list) > 1:
+            # recalculate connections shares every n seconds
+            if time.time() - shares_timer >= 1:
+                shares_timer = time.time()
+                shares = track_shares(job_list, allowable_connections)
+
+            busy = [w.seg.tempfile for w in threads_to_workers.values() if w.seg]
+
+            if busy.count(job_list[-1].tempfile) >= shares.get(job_list[-1].tempfile, 1):
+                for i in range(len(job_list) - 2, -1, -1):
+                    tempfile = job_list[i].tempfile
+                    if tempfile != job_list[-1].tempfile and busy.count(tempfile) < shares.get(tempfile, 1):
+                        return job_list.pop(i)
+
+        return job_list.pop()
+
+    def within_share(seg):
+        """check if segment's track uses less connections than its share, see pop_job()"""
+        if 'dash' not in d.subtype_list:
+            return True
+
+        busy = [w.seg.tempfile for w in threads_to_workers.values() if w.seg]
+        return busy.count(seg.tempfile) < shares.get(seg.tempfile, 1)
+
     def on_completion_callback(future):
         """add worker to free workers once thread is completed, it will be called by future.add_done_callback()"""
         try:
@@ -353,21 +912,46 @@ def thread_manager(d):
         # Failed jobs returned from workers, will be used as a flag to rebuild job_list --------------------------------
         if config.jobs_q.qsize() > 0:
             # rebuild job_list
-            job_list = [seg for seg in d.segments if not seg.downloaded and not seg.locked]
-            job_list.reverse()
+            job_list = schedule_jobs([seg for seg in d.segments if not seg.downloaded and not seg.locked])
 
             # empty queue
             for _ in range(config.jobs_q.qsize()):
                 _ = config.jobs_q.get()
                 # job_list.append(job)
 
+        # server ignored range requests, wait for running workers to abort then fall back to one connection, no new
+        # requests or segment splits meanwhile, see Threads section below
+        range_fallback = not d.resumable and any(seg.range for seg in d.segments)
+        if range_fallback:
+            job_list = []
+            if num_live_threads == 0:
+                use_single_connection(d)
+                job_list = schedule_jobs(d.segments)
+                d.remaining_parts = len(job_list)
+
+        # remote file changed, wait for running workers to abort then start over, no new requests meanwhile
+        if d.remote_changed:
+            job_list = []
+            if num_live_threads == 0:
+                restart_download(d)
+                job_list = schedule_jobs(d.segments)
+                d.remaining_parts = len(job_list)
+
+        # low disk space, pause download before writes start failing, it will resume when space is available
+        if time.time() - space_timer >= 1:
+            space_timer = time.time()
+            if d.status == Status.downloading and storage.low_space(d):
+                log(f'low disk space in "{d.folder}", less than {size_format(config.min_free_space)}, '
+                    f'download paused:', d.name)
+                d.status = Status.pending
+
         # create new workers if user increases max_connections while download is running
         if config.max_connections > len(all_workers):
             extra_num = config.max_connections - len(all_workers)
             index = len(all_workers)
             for i in range(extra_num):
                 index += i
-                worker = Worker(tag=index, d=d)
+                worker = worker_class(tag=index, d=d)
                 all_workers.append(worker)
                 free_workers.add(worker)
 
@@ -415,6 +999,42 @@ def thread_manager(d):
                 log('Thread manager: too many connection errors', 'maybe network problem or expired link',
                     start='', sep='\n', showpopup=True)
 
+        # expired link -----------------------------------------------------------------------------------------------
+        # a burst of 403/410 responses or html pages instead of media, get a fresh link and continue with new urls
+        if refresh_thread and not refresh_thread.is_alive():
+            refresh_thread = None
+            d.link_errors = []  # ignore errors from old urls
+
+            # same urls again, link didn't expire, i.e. server refuses too many connections, no more refreshes, these
+            # errors will reduce connections number as other server errors, see Worker.handle_failure()
+            refreshed = refresh_result.pop()
+            if refreshed is False:
+                d.link_refreshable = False
+                log('Thread manager: link did not expire, errors will limit connections number instead, for:', d.name)
+
+            # refresh failed, no working link
+            elif refreshed is None:
+                link_refreshes = config.max_link_refreshes
+
+        # only a burst of errors within link_expiry_window seconds means an expired link
+        d.link_errors = [t for t in d.link_errors if time.time() - t < config.link_expiry_window]
+
+        if config.auto_refresh_link and d.link_refreshable and len(d.link_errors) >= config.link_expiry_errors \
+                and not refresh_thread and d.status == Status.downloading:
+            if link_refreshes >= config.max_link_refreshes:
+                d.status = Status.error
+                log('Thread manager: link expired or not found, failed to get a working link for:', d.name,
+                    start='', sep='\n', showpopup=True)
+
+            # rate limit, a real failure shouldn't cause extraction storms
+            elif time.time() - link_refresh_timer >= config.link_refresh_interval:
+                link_refreshes += 1
+                link_refresh_timer = time.time()
+                log('Thread manager: link might be expired, refreshing link, attempt:', link_refreshes)
+
+                refresh_thread = Thread(target=lambda: refresh_result.append(refresh_link(d)), daemon=True)
+                refresh_thread.start()
+
         # speed limit ------------------------------------------------------------------------------------------------
         # wait some time for dynamic connection manager to release all connections
         if time.time() - sl_timer < config.max_connections * errors_check_interval:
@@ -424,14 +1044,16 @@ def thread_manager(d):
             worker_sl = (config.speed_limit // allowable_connections) if allowable_connections else 0
 
         # Threads ------------------------------------------------------------------------------------------------------
-        if d.status == Status.downloading:
-            if free_workers and num_live_threads < allowable_connections:
+        if d.status == Status.downloading and not range_fallback and not d.remote_changed:
+            # pending segments wait for fresh urls while refreshing link
+            if free_workers and num_live_threads < allowable_connections and not refresh_thread:
                 seg = None
                 if job_list:
-                    seg = job_list.pop()
+                    seg = pop_job()
                 else:
                     # share segments and help other workers
-                    remaining_segs = [seg for seg in d.segments if seg.remaining > config.segment_size]
+                    # only ranged segments can be split, fragments and single connection segments have no range
+                    remaining_segs = [seg for seg in d.segments if seg.range and seg.remaining > config.segment_size]
                     remaining_segs = sorted(remaining_segs, key=lambda seg: seg.remaining)
                     # log('x'*20, 'check remaining')
 
@@ -444,14 +1066,51 @@ def thread_manager(d):
                         # create new segment
                         start = current_seg.range[1] + 1
                         seg = Segment(name=os.path.join(d.temp_folder, f'{len(d.segments)}'), url=current_seg.url,
-                                      tempfile=current_seg.tempfile, range=[start, end])
+                                      tempfile=current_seg.tempfile, range=[start, end],
+                                      media_type=current_seg.media_type)
 
                         # add to segments
                         d.segments.append(seg)
                         log('-' * 10, f'new segment {seg.basename} created from {current_seg.basename} '
                                       f'with range {current_seg.range}', log_level=3)
 
+                # segment waiting for its retry time, or server's circuit breaker is open, keep it for later
+                if seg and not seg.downloaded and not seg.locked and \
+                        (seg.retry_time > time.time() or retry.allow_request(seg.url)):
+                    job_list.insert(0, seg)
+                    seg = None
+
                 if seg and not seg.downloaded and not seg.locked:
+                    # batch of next consecutive fragments, will be downloaded by the same worker
+                    batch = []
+                    if not seg.range:
+                        if time.time() - batch_timer >= 1:
+                            batch_timer = time.time()
+                            batch_size = get_batch_size()
+
+                        # next fragments of the same track, other track's jobs are skipped, fragments waiting for
+                        # their retry time or for host's circuit breaker stay in job list, a track which already uses
+                        # its connections share gets no batch, its worker will be free soon for other tracks
+                        for i in range(len(job_list) - 1 if within_share(seg) else -1, -1, -1):
+                            if len(batch) >= batch_size - 1 or job_list[i].range:
+                                break
+                            x = job_list[i]
+                            if x.tempfile == seg.tempfile and x.retry_time <= time.time() and \
+                                    not retry.allow_request(x.url):
+                                batch.append(x)
+
+                        # remove from job list
+                        if batch:
+                            job_list = [x for x in job_list if x not in batch]
+                            batch = [x for x in batch if not x.downloaded and not x.locked]
+
+                    # segments go to scratch folder, or download folder if scratch folder is full
+                    for x in [seg] + batch:
+                        storage.place_segment(d, x)
+
+                    # first request after circuit breaker cooldown is the probe, see retry.py
+                    retry.report_request(seg.url)
+
                     worker = free_workers.pop()
                     # sometimes download chokes when remaining only one worker, will set higher minimum speed and
                     # less timeout for last workers batch
@@ -460,7 +1119,8 @@ def thread_manager(d):
                     else:
                         minimum_speed = timeout = None  # default as in utils.set_curl_option
 
-                    ready = worker.reuse(seg=seg, speed_limit=worker_sl, minimum_speed=minimum_speed, timeout=timeout)
+                    ready = worker.reuse(seg=seg, speed_limit=worker_sl, minimum_speed=minimum_speed, timeout=timeout,
+                                         batch=batch)
                     if ready:
                         if config.use_thread_pool_executor:
                             thread = executor.submit(worker.run)
@@ -485,8 +1145,12 @@ def thread_manager(d):
         # Required check if things goes wrong --------------------------------------------------------------------------
         if num_live_threads + len(job_list) + config.jobs_q.qsize() == 0:
             # rebuild job_list
-            job_list = [seg for seg in d.segments if not seg.downloaded]
+            job_list = schedule_jobs([seg for seg in d.segments if not seg.downloaded])
             if not job_list:
+                # wait for new segments from live recording
+                if d.recording:
+                    time.sleep(0.1)
+                    continue
                 break
             else:
                 # remove an orphan locks
@@ -502,4 +1166,6 @@ def thread_manager(d):
     # update d param
     d.live_connections = 0
     d.remaining_parts = num_live_threads + len(job_list) + config.jobs_q.qsize()
+    if config.use_disk_writers:
+        log('disk writers:', storage.writer_stats(), log_level=3)
     log(f'thread_manager {d.num}: quitting')
@@ -0,0 +1,315 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# local download cache, completed files are stored by their content hash "sha256", and looked up by a key made from
+# canonical url, remote file validators, size, and output options, the same file downloaded again "i.e. in another
+# folder" is created from cache as a hardlink, reflink, or copy without using network
+# files with the same contents from different urls are stored once, and target files are hardlinked to cached object
+
+import os
+import time
+import shutil
+import hashlib
+from threading import Lock
+from urllib.parse import urlsplit, urlunsplit
+
+from . import config
+from .config import Status
+from .utils import log, size_format, save_json, load_json, delete_file
+
+# index: {'objects': {digest: {'size': int, 'mtime': float, 'last_used': float}}, 'keys': {key: digest},
+#         'stats': {...}}
+_index = None
+_lock = Lock()
+
+FICLONE = 0x40049409  # linux ioctl request number for reflink "copy on write clone"
+
+
+def get_folder():
+    """cache folder, config.download_cache_folder or 'cache' folder in settings folder"""
+    return config.download_cache_folder or os.path.join(config.sett_folder or config.current_directory, 'cache')
+
+
+def _index_file():
+    return os.path.join(get_folder(), 'cache_index.cfg')
+
+
+def _object_path(digest):
+    return os.path.join(get_folder(), 'objects', digest[:2], digest)
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        data = load_json(_index_file()) if os.path.isfile(_index_file()) else None
+        _index = data if isinstance(data, dict) else {}
+        _index.setdefault('objects', {})
+        _index.setdefault('keys', {})
+        _index.setdefault('stats', {'hits': 0, 'misses': 0, 'stored': 0, 'deduplicated': 0, 'evicted': 0,
+                                    'bytes_saved': 0})
+    return _index
+
+
+def _save_index():
+    os.makedirs(get_folder(), exist_ok=True)
+    save_json(_index_file(), _index)
+
+
+def canonical_url(url):
+    """
+    normalize url to be used in cache key, scheme and host are case insensitive, default ports and fragments are removed
+    :param url: string
+    :return: string
+    """
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = parts.netloc.lower()
+        if (scheme, parts.port) in (('http', 80), ('https', 443)):
+            netloc = netloc.rsplit(':', 1)[0]
+        return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+    except Exception:
+        return url
+
+
+def output_options(d):
+    """
+    options which change target file contents for the same remote resource, target extension decides the container
+    ffmpeg writes for videos, and metadata gets embedded if config.write_metadata is set
+    :param d: DownloadItem object
+    :return: string
+    """
+    extension = os.path.splitext(d.name)[1].lower()
+
+    if d.format_id:
+        metadata = bool(d.metadata_file_content and config.write_metadata)
+        return f'{extension}|metadata={metadata}'
+
+    return extension
+
+
+def get_key(d):
+    """
+    cache key for download item
+    video: page url with selected video / audio format ids, stream urls are temporary
+    other files: effective url, size, and etag or last-modified, files without validators are not cached
+    both include output options, i.e. the same video saved as mp4 and mkv are different files
+    :param d: DownloadItem object
+    :return: string or None if item can't be cached
+    """
+    if d.format_id:
+        return f'video|{canonical_url(d.url)}|{d.format_id}|{d.audio_format_id or ""}|{output_options(d)}'
+
+    validators = d.validators.get('main', {})
+    version = validators.get('etag') or validators.get('last-modified')
+    if not d.size or not version:
+        return None
+
+    return f'file|{canonical_url(d.eff_url or d.url)}|{d.size}|{version}|{output_options(d)}'
+
+
+def file_digest(file_name, chunk_size=1024 * 1024):
+    """sha256 of a file, read in chunks to keep memory usage low"""
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def reflink(src, dst):
+    """
+    copy on write clone, supported on some file systems i.e. btrfs, xfs
+    :return: True if succeeded
+    """
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except Exception:
+        delete_file(dst)
+        return False
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """
+    create dst file with src contents, the fastest way available, hardlink, reflink, then normal copy
+    :param hardlink: False for independent files, editing one of hardlinked files changes the other
+    :return: method name 'hardlink', 'reflink', 'copy', or None if failed
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    # create under a temp name, dst will be replaced at once
+    temp = dst + '.cache_tmp'
+    delete_file(temp)
+
+    try:
+        if not hardlink:
+            raise OSError
+        os.link(src, temp)
+        method = 'hardlink'
+    except OSError:
+        if reflink(src, temp):
+            method = 'reflink'
+        else:
+            try:
+                shutil.copyfile(src, temp)
+                method = 'copy'
+            except Exception as e:
+                log('cache.link_or_copy()> error:', e)
+                delete_file(temp)
+                return None
+
+    os.replace(temp, dst)
+    return method
+
+
+def _valid_object(digest):
+    """check cached object still exists and unchanged, i.e. a hardlinked target file might be edited by user"""
+    obj = _index['objects'].get(digest)
+    path = _object_path(digest)
+    try:
+        return obj and os.path.getsize(path) == obj['size'] and os.path.getmtime(path) == obj['mtime']
+    except OSError:
+        return False
+
+
+def _remove_object(digest):
+    _index['objects'].pop(digest, None)
+    for key in [k for k, v in _index['keys'].items() if v == digest]:
+        _index['keys'].pop(key)
+    delete_file(_object_path(digest))
+
+
+def _evict():
+    """remove least recently used objects until cache size within config.download_cache_size"""
+    objects = _index['objects']
+    total = sum(obj['size'] for obj in objects.values())
+
+    for digest in sorted(objects, key=lambda x: objects[x]['last_used']):
+        if total <= config.download_cache_size:
+            break
+        total -= objects[digest]['size']
+        _remove_object(digest)
+        _index['stats']['evicted'] += 1
+        log('cache: evicted', digest[:12], log_level=3)
+
+
+def restore(d):
+    """
+    create download item's target file from cache if the same file downloaded before
+    :param d: DownloadItem object
+    :return: True if target file created from cache
+    """
+    if not config.use_download_cache:
+        return False
+
+    key = get_key(d)
+    if not key:
+        return False
+
+    with _lock:
+        _load_index()
+        digest = _index['keys'].get(key)
+
+        # file size must match, except for videos, final file is merged from video and audio streams
+        size_changed = digest and not d.format_id and _index['objects'].get(digest, {}).get('size') != d.size
+
+        if not digest or not _valid_object(digest) or size_changed:
+            if digest:
+                _remove_object(digest)
+            _index['stats']['misses'] += 1
+            return False
+
+        obj = _index['objects'][digest]
+
+    # copy outside lock, other items can use cache meanwhile, copying a big file might take long time
+    t = time.time()
+    method = link_or_copy(_object_path(digest), d.target_file)
+    if not method:
+        return False
+
+    with _lock:
+        obj['last_used'] = time.time()
+        _index['stats']['hits'] += 1
+        _index['stats']['bytes_saved'] += obj['size']
+        _save_index()
+
+    d.size = d.size or obj['size']
+    d.downloaded = obj['size']
+    log(f'cache: "{d.name}" restored from cache by {method} in {round(time.time() - t, 3)} seconds, saved:',
+        size_format(obj['size']))
+
+    return True
+
+
+def store(d):
+    """
+    add completed download to cache, target file contents are stored once per content hash, if the same contents
+    already cached from another url, target file is replaced by a hardlink to cached object to save disk space
+    :param d: DownloadItem object
+    :return: None
+    """
+    if not config.use_download_cache or d.status != Status.completed:
+        return
+
+    key = get_key(d)
+    if not key:
+        return
+
+    try:
+        size = os.path.getsize(d.target_file)
+        if size < config.download_cache_min_size or size > config.download_cache_size:
+            return
+
+        digest = file_digest(d.target_file)
+
+        with _lock:
+            _load_index()
+            path = _object_path(digest)
+
+            if _valid_object(digest):
+                # same contents, hardlink target to cached object
+                if not os.path.samefile(path, d.target_file) and link_or_copy(path, d.target_file) == 'hardlink':
+                    _index['stats']['deduplicated'] += 1
+                    log('cache: deduplicated', d.name, '- saved disk space:', size_format(size), log_level=2)
+            else:
+                if not link_or_copy(d.target_file, path):
+                    return
+                _index['stats']['stored'] += 1
+
+            _index['objects'][digest] = {'size': size, 'mtime': os.path.getmtime(path), 'last_used': time.time()}
+            _index['keys'][key] = digest
+
+            _evict()
+            _save_index()
+
+        log('cache: stored', d.name, '- sha256:', digest[:12], log_level=3)
+    except Exception as e:
+        log('cache.store()> error:', e)
+
+
+def stats():
+    """
+    cache statistics
+    :return: dict of hits, misses, stored, deduplicated, evicted, bytes_saved, files, and size
+    """
+    with _lock:
+        _load_index()
+        return dict(_index['stats'], files=len(_index['objects']),
+                    size=sum(obj['size'] for obj in _index['objects'].values()))
+
+
+def clear():
+    """delete all cached files"""
+    global _index
+    with _lock:
+        shutil.rmtree(get_folder(), ignore_errors=True)
+        _index = None
@@ -72,6 +72,7 @@ big_playlist_length = 50  # minimum number of videos in big playlist, it will ig
 manually_select_dash_audio = False  # if True, will prompt user to select audio format for dash video
 auto_rename = False  # auto rename file if there is an existing file with same name at download folder
 write_metadata = True  # write metadata to video file
+record_live_hls = True  # keep recording live / event hls streams, until stream ends
 
 # connection / network
 speed_limit = 0  # in bytes, zero == no limit
@@ -114,6 +115,48 @@ keep_temp = False  # keep temp files / folders after done downloading for debugg
 checksum = False  # calculate checksums for completed files MD5 and SHA256
 use_thread_pool_executor = False
 max_seg_retries = 10  # maximum retries for a segment until reporting downloaded, this is for segment with unknown size
+max_coalesced_size = 1024 * 1024 * 4  # adjacent byte ranges of same resource are combined into one request up to 4 MB
+max_coalesced_gap = 1024 * 64  # unwanted bytes between 2 ranges which will be downloaded and dropped, instead of a new request
+fragment_batching = True  # a worker downloads a batch of consecutive fragments over same connection
+batch_duration = 2  # in seconds, fragments batch size is adjusted to finish in n seconds
+max_batch_size = 50  # max. number of fragments in one batch
+stream_postprocessing = False  # feed ffmpeg with in-order streams while downloading, i.e. hls and fragmented dash
+max_postprocessing_jobs = 0  # number of simultaneous ffmpeg jobs, 0 = half of cpu cores
+max_command_output_lines = 500  # subprocess output lines kept in memory, older lines will be dropped
+command_log_interval = 0.5  # minimum seconds between subprocess output lines forwarded to log, others will be skipped
+size_probe_timeout = 10  # seconds, time budget for getting missing video streams sizes
+headers_cache_ttl = 30  # seconds to reuse http headers of a recently checked url, 0 = disable cache
+headers_cache_size = 200  # max number of cached urls headers
+prefetch_size = 1024 * 256  # bytes downloaded while checking url headers, will be used as first segment data
+prefetch_ttl = 60  # seconds, prefetched data older than this will not be used
+prefetch_cache_size = 1024 * 1024 * 16  # max. bytes of prefetched data kept in memory, oldest data dropped first
+share_connections = True  # all curl handles share dns cache, tls sessions, and connections pool
+small_file_size = 1024 * 512  # files smaller than this downloaded by one request without segments, 0 = disabled
+small_file_workers = 8  # max. number of small files downloaded at the same time, see brain.download_small_file()
+range_check_ttl = 3600  # seconds to remember servers which ignore range requests
+max_retry_after = 300  # seconds, max. wait time requested by server's Retry-After header
+circuit_breaker_threshold = 5  # consecutive failures from a server before pausing all requests to it
+circuit_breaker_cooldown = 5  # seconds, pause time after circuit breaker opens, doubled with every failed probe
+circuit_breaker_probe_timeout = 60  # seconds, circuit breaker allows another probe if previous one isn't resolved
+auto_refresh_link = True  # get a fresh link for expired urls while downloading, i.e. video links
+link_expiry_errors = 3  # number of 401/403/404/410 or html responses which trigger a link refresh
+link_expiry_window = 60  # seconds, link expiry errors older than this are ignored
+link_refresh_interval = 30  # minimum seconds between link refreshes for the same download item
+max_link_refreshes = 3  # max. number of link refreshes for a download item before giving up
+use_download_cache = False  # keep completed files in a local cache, same file downloaded again is copied from it
+download_cache_size = 1024 ** 3 * 5  # max. cache size in bytes, least recently used files will be removed
+download_cache_min_size = 1024 * 1024  # smaller files are not cached
+download_cache_folder = ''  # empty for default, i.e. 'cache' folder in settings folder
+scratch_folder = ''  # fast local folder for segments i.e. ssd or tmpfs, empty = download folder, see storage.py
+scratch_size = 1024 ** 3 * 4  # max. segments size in scratch folder, more segments spill over to download folder
+move_chunk_size = 1024 * 1024 * 8  # bytes copied at once, when moving completed file to another device
+move_speed_limit = 0  # bytes per second, when moving completed file to another device, zero == no limit
+check_disk_space = True  # reserve disk space before starting a download, and pause downloads if space gets low
+min_free_space = 1024 * 1024 * 200  # bytes kept free on download folder device
+use_disk_writers = True  # segments written by one writer thread per device, instead of inside curl callbacks
+writer_queue_size = 1024 * 1024 * 32  # max. bytes waiting in a disk writer queue before pausing transfers
+use_process_engine = False  # download segments in child processes, see engine.py
+engine_processes = 0  # number of engine child processes, zero == number of cpu cores
 
 # -------------------------------------------------------------------------------------
 
@@ -160,7 +203,10 @@ settings_keys = ['current_theme', 'monitor_clipboard', 'show_download_window', '
                  'update_frequency', 'last_update_check', 'proxy', 'proxy_type', 'raw_proxy', 'enable_proxy',
                  'log_level', 'download_folder', 'manually_select_dash_audio', 'use_referer', 'referer_url',
                  'close_action', 'process_playlist', 'keep_temp', 'auto_rename', 'dynamic_theme_change', 'checksum',
-                 'use_proxy_dns', 'use_thread_pool_executor', 'write_metadata']
+                 'use_proxy_dns', 'use_thread_pool_executor', 'write_metadata', 'record_live_hls',
+                 'fragment_batching', 'stream_postprocessing', 'share_connections',
+                 'auto_refresh_link', 'use_download_cache', 'download_cache_size', 'scratch_folder', 'scratch_size',
+                 'check_disk_space', 'use_disk_writers', 'use_process_engine', 'engine_processes']
 
 
 # -------------------------------------------------------------------------------------
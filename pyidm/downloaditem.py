@@ -10,6 +10,7 @@
 # Download Item Class
 
 import os
+import re
 import mimetypes
 import time
 from collections import deque
@@ -17,8 +18,9 @@ from queue import Queue
 from threading import Thread, Lock
 from urllib.parse import urljoin
 from .utils import (validate_file_name, get_headers, translate_server_code, size_splitter, get_seg_size, log,
-                    delete_file, delete_folder, save_json, load_json, size_format, get_range_list, arabic_renderer)
-from . import config
+                    delete_file, delete_folder, save_json, load_json, size_format, get_range_list, arabic_renderer,
+                    coalesce_ranges, get_prefetched, is_range_ignored, get_validators, validators_match)
+from . import config, storage
 from .config import MediaType
 
 
@@ -41,11 +43,24 @@ class Segment:
         self.locked = False  # set True by the worker which is currently downloading this segment
         self.media_type = media_type
         self.retries = 0  # number of download retries
+        self.retry_time = 0  # time stamp, segment shouldn't be downloaded before it, see retry.py
+
+        # request range of a remote resource i.e. hls #EXT-X-BYTERANGE, unlike range it isn't an offset in tempfile
+        self.byte_range = None
+
+        # offsets of logical fragments inside a combined segment i.e. [[0, 640], [2197, 63702]], gaps are dropped
+        # while merging, None means all segment contents will be merged
+        self.parts = None
 
         # override size if range available
         if range:
             self.size = range[1] - range[0] + 1
 
+    @property
+    def stream(self):
+        """segment's stream, key for remote file validators, see DownloadItem.validators"""
+        return 'audio' if self.media_type == MediaType.audio else 'main'
+
     @property
     def current_size(self):
         try:
@@ -200,10 +215,29 @@ class DownloadItem:
 
         # errors
         self.errors = 0  # an indicator for server, network, or other errors while downloading
+        self.link_errors = []  # time stamps of responses which might mean an expired link, i.e. 403, 410, or html
+        self.link_refreshable = True  # False if a link refresh returned the same urls, link doesn't expire
+
+        # remote file validators for every stream, key: 'main' or 'audio', value: dict, see utils.get_validators()
+        self.validators = {}
+        self.remote_changed = False  # remote file changed while downloading, see Worker.check_validators()
 
         # subprocess references
         self.subprocess = None
 
+        # live hls stream recording is in progress, more segments will be added while downloading
+        self.recording = False
+
+        # post processing method and time taken in seconds for each stream, i.e. {'video': ('remux', 3.2)}
+        self.finalize_info = {}
+
+        # ffmpeg post processing progress, i.e. {'time': 5.0, 'speed': 12.5, 'size': 1024, 'percent': 25.0, 'eta': 1.2}
+        # or moving temp file to another device, i.e. {'time': 5.0, 'rate': 1048576, ...}, see storage.move_file()
+        self.processing_progress = {}
+
+        # temp files assembled in scratch folder, see storage.use_scratch_temp()
+        self.scratch_temp = False
+
         # test
         self.seg_names = []
 
@@ -220,7 +254,7 @@ class DownloadItem:
                                  'fragment_base_url', 'audio_fragments', 'audio_fragment_base_url',
                                  '_total_size', 'protocol', 'manifest_url', 'selected_subtitles',
                                  'abr', 'tbr', 'format_id', 'audio_format_id', 'resolution', 'audio_quality',
-                                 'http_headers', 'metadata_file_content']
+                                 'http_headers', 'metadata_file_content', 'validators']
 
         # property to indicate that there is a time consuming operation is running on download item now
         self.busy = False
@@ -321,10 +355,35 @@ class DownloadItem:
 
         return p
 
+    @property
+    def track_progress(self):
+        """progress percentage for video and audio tracks of dash video, i.e. {'video': 52.5, 'audio': 49.1}"""
+        tracks = {}
+        for seg in self.segments:
+            if seg.media_type != MediaType.key:
+                track = 'audio' if seg.media_type == MediaType.audio else 'video'
+                tracks.setdefault(track, []).append(seg)
+
+        progress = {}
+        for track, segments in tracks.items():
+            total = sum(seg.size for seg in segments)
+            if total:
+                done = sum(seg.size for seg in segments if seg.downloaded)
+            else:
+                # unknown sizes, use number of segments instead
+                total = len(segments)
+                done = len([seg for seg in segments if seg.downloaded])
+
+            progress[track] = round(done * 100 / total, 1)
+
+        return progress
+
     @property
     def time_left(self):
         if self.status == config.Status.downloading and self.total_size and self.total_size >= self.downloaded:
             return (self.total_size - self.downloaded) / self.speed if self.speed else -1
+        elif self.status == config.Status.processing and 'eta' in self.processing_progress:
+            return self.processing_progress['eta']
         else:
             return '---'
 
@@ -370,19 +429,33 @@ class DownloadItem:
 
     @property
     def temp_file(self):
-        """return temp file name including path"""
+        """return temp file name including path, inside scratch folder if scratch_temp is True"""
         name = f'_temp_{self.name}'.replace(' ', '_')
-        return os.path.join(self.folder, name)
+        return storage.scratch_path(self, name) if self.scratch_temp else os.path.join(self.folder, name)
 
     @property
     def audio_file(self):
         """return temp file name including path"""
         name = f'audio_for_{self.name}'.replace(' ', '_')
-        return os.path.join(self.folder, name)
+        return storage.scratch_path(self, name) if self.scratch_temp else os.path.join(self.folder, name)
 
     @property
     def temp_folder(self):
-        return f'{self.temp_file}_parts_'
+        """segments folder, inside scratch folder if configured, see storage.py"""
+        if config.scratch_folder:
+            return storage.scratch_path(self, os.path.basename(self.spill_folder))
+        return self.spill_folder
+
+    @property
+    def spill_folder(self):
+        """segments folder in download folder, used if scratch folder not configured or full"""
+        name = f'_temp_{self.name}_parts_'.replace(' ', '_')
+        return os.path.join(self.folder, name)
+
+    @property
+    def temp_folders(self):
+        """all folders which might have segments"""
+        return list(dict.fromkeys([self.temp_folder, self.spill_folder]))
 
     @property
     def i(self):
@@ -473,7 +546,8 @@ class DownloadItem:
         if url in ('', None):
             return
 
-        headers = get_headers(url)
+        # first bytes of file will be downloaded too and used later by first segment, see use_prefetched_data()
+        headers = get_headers(url, prefetch=config.prefetch_size)
         # print('update d parameters:', headers)
 
         # update headers only if no other update thread created with different url
@@ -516,13 +590,14 @@ class DownloadItem:
                     name += ext
 
             # resume support
-            resumable = headers.get('accept-ranges', 'none') != 'none'
+            resumable = headers.get('accept-ranges', 'none') != 'none' and not is_range_ignored(self.eff_url)
 
             self.name = name
             self.ext = ext
             self.size = size
             self.type = content_type
             self.resumable = resumable
+            self.validators = {'main': get_validators(headers)}
 
             # build segments
             self.build_segments()
@@ -535,7 +610,8 @@ class DownloadItem:
         """delete temp files and folder for a given download item"""
 
         if force_delete or not config.keep_temp:
-            delete_folder(self.temp_folder)
+            for folder in self.temp_folders:
+                delete_folder(folder)
             delete_file(self.temp_file)
             delete_file(self.audio_file)
 
@@ -549,14 +625,12 @@ class DownloadItem:
         if self.fragments:
             # print(self.fragments)
             # example 'fragments': [{'path': 'range/0-640'}, {'path': 'range/2197-63702', 'duration': 9.985},]
-            _segments = [Segment(name=os.path.join(self.temp_folder, str(i)), num=i, range=None, size=0,
-                                 url=urljoin(self.fragment_base_url, x.get('path', '')), tempfile=self.temp_file,
-                                 media_type=MediaType.video)
-                         for i, x in enumerate(self.fragments)]
+            _segments = self.build_fragment_segments(self.fragment_base_url, self.fragments, self.temp_file,
+                                                     MediaType.video)
 
         else:
-            # general files or video files with known sizes and resumable
-            if self.resumable and self.size:
+            # general files or video files with known sizes and resumable, and server didn't ignore range requests
+            if self.resumable and self.size and not is_range_ignored(self.eff_url):
                 # get list of ranges i.e. [[0, 100], [101, 2000], ... ]
                 range_list = get_range_list(self.size)
             else:
@@ -572,14 +646,11 @@ class DownloadItem:
             # handle fragmented audio
             if self.audio_fragments:
                 # example 'fragments': [{'path': 'range/0-640'}, {'path': 'range/2197-63702', 'duration': 9.985},]
-                audio_segments = [
-                    Segment(name=os.path.join(self.temp_folder, str(i) + '_audio'), num=i, range=None, size=0,
-                            url=urljoin(self.audio_fragment_base_url, x.get('path', '')), tempfile=self.audio_file,
-                            media_type=MediaType.audio)
-                    for i, x in enumerate(self.audio_fragments)]
+                audio_segments = self.build_fragment_segments(self.audio_fragment_base_url, self.audio_fragments,
+                                                              self.audio_file, MediaType.audio, suffix='_audio')
 
             else:
-                range_list = get_range_list(self.audio_size)
+                range_list = get_range_list(self.audio_size) if not is_range_ignored(self.audio_url) else [None]
 
                 audio_segments = [
                     Segment(name=os.path.join(self.temp_folder, str(i) + '_audio'), num=i, range=x,
@@ -594,29 +665,141 @@ class DownloadItem:
 
         self.segments = _segments
 
+    def use_prefetched_data(self):
+        """
+        write file start bytes downloaded while getting headers to first segment, worker will resume this segment
+        from where prefetched data ends, using the same connection if still open
+        :return: None
+        """
+        if not self.segments or not self.size or self.fragments or 'hls' in self.subtype_list:
+            return
+
+        seg = self.segments[0]
+
+        # first segment must start at file beginning, and has no previous downloaded data
+        if seg.media_type != MediaType.general or (seg.range and seg.range[0] != 0) or seg.current_size:
+            return
+
+        # unknown segment size "not resumable" is allowed only if prefetched data is the whole file
+        data = get_prefetched(self.eff_url, self.size)
+        if not data or (not seg.range and len(data) != self.size):
+            return
+
+        data = data[:seg.size or None]
+        if not seg.range:
+            seg.size = len(data)
+
+        try:
+            os.makedirs(self.temp_folder, exist_ok=True)
+            with open(seg.name, 'wb') as f:
+                f.write(data)
+        except Exception as e:
+            log('use_prefetched_data()> error:', e)
+            return
+
+        self.downloaded += len(data)
+        log('use_prefetched_data()>', seg.basename, 'prefetched:', size_format(len(data)), log_level=2)
+
+    def build_fragment_segments(self, base_url, fragments, tempfile, media_type, suffix=''):
+        """
+        build segments for fragmented video / audio, adjacent fragments with url path range i.e. 'range/0-640' are
+        combined in one segment, to save a full request round trip for every tiny fragment
+        :param base_url: fragment base url
+        :param fragments: list of dicts i.e. [{'path': 'range/0-640'}, {'path': 'range/2197-63702'}, ...]
+        :param tempfile: temp file which segments will be merged into
+        :param media_type: MediaType.video or MediaType.audio
+        :param suffix: segment name suffix i.e. '_audio'
+        :return: list of Segment objects
+        """
+        # group fragments by url prefix, i.e. [(prefix, [range1, range2, ...]), (url, None), ...]
+        groups = []
+        for x in fragments:
+            url = urljoin(base_url, x.get('path', ''))
+            match = re.match(r'(.*range/)(\d+)-(\d+)$', url)
+            if match:
+                prefix = match.group(1)
+                range_ = [int(match.group(2)), int(match.group(3))]
+                if groups and groups[-1][0] == prefix and groups[-1][1]:
+                    groups[-1][1].append(range_)
+                else:
+                    groups.append((prefix, [range_]))
+            else:
+                groups.append((url, None))
+
+        segments = []
+        i = 0  # fragment index
+        for url, ranges in groups:
+            if not ranges:
+                segments.append(Segment(name=os.path.join(self.temp_folder, f'{i}{suffix}'), num=len(segments),
+                                        url=url, tempfile=tempfile, media_type=media_type))
+                i += 1
+                continue
+
+            for span, parts in coalesce_ranges(ranges):
+                # segment name for a single fragment is the same as before, i.e. '5', and for combined ones i.e. '5-9'
+                name = f'{i}{suffix}' if len(parts) == 1 else f'{i}-{i + len(parts) - 1}{suffix}'
+                seg = Segment(name=os.path.join(self.temp_folder, name), num=len(segments),
+                              url=f'{url}{span[0]}-{span[1]}', size=span[1] - span[0] + 1, tempfile=tempfile,
+                              media_type=media_type)
+
+                # drop gaps between fragments while merging
+                if sum(b - a + 1 for a, b in parts) < seg.size:
+                    seg.parts = [[a - span[0], b - span[0]] for a, b in parts]
+
+                segments.append(seg)
+                i += len(parts)
+
+        if len(segments) < len(fragments):
+            log(f'build_fragment_segments()> combined {len(fragments)} fragments into {len(segments)} segments',
+                log_level=3)
+
+        return segments
+
     def save_progress_info(self):
-        """save segments info to disk"""
-        progress_info = [{'name': seg.name, 'downloaded': seg.downloaded, 'completed': seg.completed, 'size': seg.size,
-                          '_range': seg.range, 'media_type': seg.media_type}
-                         for seg in self.segments]
+        """save segments info to disk, with remote file validators which segments downloaded from"""
+        segments = [{'name': seg.name, 'downloaded': seg.downloaded, 'completed': seg.completed, 'size': seg.size,
+                     '_range': seg.range, 'media_type': seg.media_type}
+                    for seg in self.segments]
+        progress_info = {'validators': self.validators, 'segments': segments}
+        os.makedirs(self.temp_folder, exist_ok=True)
         file = os.path.join(self.temp_folder, 'progress_info.txt')
         save_json(file, progress_info)
 
     def load_progress_info(self):
         """
-        load progress info from disk, update segments' info, verify actual segments' size on disk
+        load progress info from disk, update segments' info, verify actual segments' size on disk, segments will be
+        discarded if remote file changed since they were downloaded
         :return: None
         """
         # log('load_progress_info()> Loading progress info')
         progress_info = None
+        validators = {}
 
-        # load progress info from temp folder if exist
-        file = os.path.join(self.temp_folder, 'progress_info.txt')
-        if os.path.isfile(file):
+        # load progress info from temp folder if exist, or from download folder if scratch folder changed
+        files = [os.path.join(folder, 'progress_info.txt') for folder in self.temp_folders]
+        file = next((x for x in files if os.path.isfile(x)), None)
+        if file:
             data = load_json(file)
-            if isinstance(data, list):
+            if isinstance(data, dict):
+                progress_info = data.get('segments')
+                validators = data.get('validators') or {}
+            elif isinstance(data, list):  # old format, segments only
                 progress_info = data
 
+        # compare with validators from current headers, it doesn't cost extra requests
+        changed = [k for k in validators if k in self.validators
+                   and not validators_match(validators[k], self.validators[k])]
+        if progress_info and changed:
+            log('load_progress_info()> remote file changed since previous download, it will be downloaded again:',
+                self.name)
+            for item in progress_info:
+                delete_file(item.get('name'))
+            progress_info = None
+
+        # keep validators of previous download, segment requests will use it in "If-Range" header
+        elif progress_info:
+            self.validators = dict(validators, **self.validators)
+
         # update segments from progress info
         if progress_info:
             downloaded = 0
@@ -660,7 +843,8 @@ class DownloadItem:
             # for fixed segments will update segments list only
             elif self.segments:
                 for seg, item in zip(self.segments, progress_info):
-                    if seg.name == item.get('name'):
+                    # segment might be spilled over to download folder, see storage.place_segment()
+                    if seg.basename == os.path.basename(item.get('name') or ''):
                         seg.__dict__.update(item)
                 log('load_progress_info()> updated current segments for:', self.name)
 
@@ -0,0 +1,367 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# multi-process download engine, segments are downloaded in a pool of child processes, every process has its own
+# python interpreter and GIL, so curl callbacks of many connections don't compete with thread manager, file manager,
+# gui, and youtube-dl in main process.
+# download items stay in main process, thread manager uses ProcessWorker objects as usual, every segment request is
+# sent as a job to the least busy child process, received bytes, segment sizes "thread manager might shrink a running
+# segment", and cancel flags are shared thru shared memory, and results "response code, headers, validators, etc."
+# come back thru a queue and applied to download item
+
+import os
+import sys
+import time
+import queue
+import multiprocessing
+from threading import Thread, Lock, Event
+
+from . import config
+from .config import Status
+from .utils import log, mark_range_ignored, is_range_ignored
+from .downloaditem import Segment
+from .worker import Worker
+
+MAX_SLOTS = 512  # max. number of simultaneous jobs in all child processes
+
+# fork is not safe in a multi-threaded process, and not available on windows
+_ctx = multiprocessing.get_context('spawn')
+
+_pool = None
+_lock = Lock()
+
+# segment attributes sent to child process
+seg_fields = ('name', 'num', '_range', 'size', 'url', 'media_type', 'byte_range', 'retries')
+
+# config attributes used by worker and set_curl_options() in child process, in addition to settings_keys
+config_fields = ('HEADERS', 'proxy', 'referer_url', 'use_cookies', 'cookie_file_path', 'username', 'password',
+                 'TEST_MODE')
+
+
+def config_snapshot():
+    """current settings, child process has default config values"""
+    return {k: getattr(config, k) for k in config.settings_keys + list(config_fields) if hasattr(config, k)}
+
+
+class Pool:
+    """child processes, with shared memory slots for job progress, segment size, and cancel flags"""
+
+    def __init__(self, size):
+        self.size = size
+        self.progress = _ctx.Array('q', MAX_SLOTS, lock=False)  # received bytes per job slot
+        self.sizes = _ctx.Array('q', MAX_SLOTS, lock=False)  # segment size per job slot
+        self.cancel = _ctx.Array('b', MAX_SLOTS, lock=False)  # 1 = abort job
+        self.free_slots = list(range(MAX_SLOTS))
+        self.result_q = _ctx.Queue()
+        self.job_qs = [None] * size
+        self.processes = [None] * size
+        self.load = [0] * size  # running jobs per process
+        self.waiting = {}  # key: slot, value: [Event, result]
+        self.lock = Lock()
+
+        for i in range(size):
+            self.start_process(i)
+
+        Thread(target=self.collect_results, daemon=True, name='engine results').start()
+
+    def start_process(self, i):
+        self.job_qs[i] = _ctx.Queue()
+        self.processes[i] = _ctx.Process(target=child_main, daemon=True, name=f'pyidm engine {i}',
+                                         args=(self.job_qs[i], self.result_q, self.progress, self.sizes,
+                                               self.cancel))
+        self.processes[i].start()
+        self.load[i] = 0
+        log('engine: started process', i, '- pid:', self.processes[i].pid, log_level=2)
+
+    def submit(self, job):
+        """
+        send job to least busy child process
+        :return: slot number, process index, and [Event, result] list which will be filled with job result
+        """
+        waiter = [Event(), None]
+
+        while True:
+            with self.lock:
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                    break
+            time.sleep(0.01)
+
+        with self.lock:
+            # replace dead processes
+            for i, p in enumerate(self.processes):
+                if not p.is_alive():
+                    log('engine: process', i, 'exited with code', p.exitcode, '- restarting')
+                    self.start_process(i)
+
+            i = self.load.index(min(self.load))
+            self.load[i] += 1
+            self.progress[slot] = 0
+            self.sizes[slot] = job['seg']['size']
+            self.cancel[slot] = 0
+            self.waiting[slot] = waiter
+
+        job['slot'] = slot
+        self.job_qs[i].put(job)
+
+        return slot, i, waiter
+
+    def release(self, slot, i):
+        with self.lock:
+            self.waiting.pop(slot, None)
+            self.free_slots.append(slot)
+            self.load[i] = max(self.load[i] - 1, 0)
+
+    def collect_results(self):
+        while True:
+            kind, value = self.result_q.get()
+
+            if kind == 'log':
+                # log lines from child processes, already filtered by log level
+                log(value, start='', log_level=0)
+                continue
+
+            with self.lock:
+                waiter = self.waiting.get(value['slot'])
+
+            if waiter:
+                waiter[1] = value
+                waiter[0].set()
+
+
+def get_pool():
+    """start engine processes on first use, config.engine_processes or cpu cores count"""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = Pool(config.engine_processes or os.cpu_count() or 2)
+        return _pool
+
+
+def transfer(worker):
+    """
+    download worker's current segment in a child process, progress is reflected on download item while waiting
+    :param worker: ProcessWorker object, its segment, file mode, and resume range are set by reuse()
+    :return: http status code, and curl error number
+    """
+    d, seg = worker.d, worker.seg
+    pool = get_pool()
+
+    job = {'seg': {k: getattr(seg, k) for k in seg_fields}, 'tag': worker.tag, 'mode': worker.mode,
+           'resume_range': worker.resume_range, 'speed_limit': worker.speed_limit,
+           'minimum_speed': worker.minimum_speed, 'timeout': worker.timeout,
+           'd': {'http_headers': d.http_headers, 'validators': d.validators, 'accept_html': d.accept_html},
+           'config': config_snapshot()}
+
+    slot, i, waiter = pool.submit(job)
+    received = 0
+    size = seg.size
+
+    try:
+        while not waiter[0].wait(0.05):
+            # received bytes since last check
+            n = pool.progress[slot]
+            d.downloaded += n - received
+            received = n
+
+            # segment range changed by thread manager
+            if seg.size != size:
+                size = seg.size
+                pool.sizes[slot] = size
+
+            # cancelled by user
+            if d.status != Status.downloading:
+                pool.cancel[slot] = 1
+
+            if not pool.processes[i].is_alive():
+                log('Seg', seg.basename, 'engine process exited while downloading', '- worker', worker.tag)
+                return 0, 0
+
+        d.downloaded += pool.progress[slot] - received
+        received = pool.progress[slot]
+    finally:
+        pool.release(slot, i)
+
+    result = waiter[1]
+
+    # apply changes made by worker in child process
+    worker.headers = result['headers']
+    worker.response_code = result['response_code']
+    worker.html_received = result['html_received']
+    worker.byte_range_ignored = result['byte_range_ignored']
+    worker.downloaded = result['downloaded']
+    worker.rtt = result['rtt'] or worker.rtt
+
+    # size from content-length header
+    if not seg.size:
+        seg.size = result['seg_size']
+
+    # segment might be shrunk by thread manager after child process got its last size update, count only bytes
+    # within segment size as an in-process worker does, see Worker.write()
+    if seg.size:
+        start_size = result['start_size']
+        d.downloaded += min(start_size + result['downloaded'], seg.size) - start_size - received
+
+    for stream, validators in result['validators'].items():
+        if d.validators.get(stream) != validators:
+            d.validators[stream] = validators
+
+    if result['remote_changed']:
+        d.remote_changed = True
+
+    if not result['resumable']:
+        d.resumable = False
+
+    if result['range_ignored']:
+        mark_range_ignored(seg.url)
+
+    for description in result['errors']:
+        worker.report_error(description)
+
+    return result['response_code'], result['curl_errno']
+
+
+class ProcessWorker(Worker):
+    """worker which downloads segments in engine's child processes, everything else runs in main process"""
+
+    def transfer(self):
+        return transfer(self)
+
+
+# child process ---------------------------------------------------------------------------------------------------
+class ChildItem:
+    """download item stand-in inside child process, has only the attributes which Worker.transfer() uses"""
+
+    def __init__(self, job, progress, cancel):
+        self.slot = job['slot']
+        self.progress = progress
+        self.cancel = cancel
+        self.http_headers = job['d']['http_headers']
+        self.validators = job['d']['validators']
+        self.accept_html = job['d']['accept_html']
+        self.remote_changed = False
+        self.resumable = True
+
+    @property
+    def status(self):
+        return Status.cancelled if self.cancel[self.slot] else Status.downloading
+
+    @property
+    def downloaded(self):
+        return self.progress[self.slot]
+
+    @downloaded.setter
+    def downloaded(self, value):
+        self.progress[self.slot] = value
+
+
+class ChildSegment(Segment):
+    """segment in child process, its size is shared with the segment object in main process"""
+    slot = None
+
+    def __init__(self, job, sizes):
+        super().__init__()
+        self.sizes = sizes
+        self.slot = job['slot']
+        self.__dict__.update({k: v for k, v in job['seg'].items() if k != 'size'})
+
+    @property
+    def size(self):
+        return self.sizes[self.slot] if self.slot is not None else 0
+
+    @size.setter
+    def size(self, value):
+        if self.slot is not None:
+            self.sizes[self.slot] = value
+
+
+class ChildWorker(Worker):
+    """worker in child process, errors are collected and sent back with job result"""
+
+    def __init__(self):
+        super().__init__()
+        self.errors = []
+
+    def report_error(self, description='unspecified error'):
+        self.errors.append(description)
+
+
+def child_main(job_q, result_q, progress, sizes, cancel):
+    """child process entry, every job runs in a separate thread, curl handles are reused"""
+    # log lines are sent to main process, which prints them and shows them in log window
+    sys.stdout = open(os.devnull, 'w')
+
+    def forward_logs():
+        while True:
+            text = config.log_recorder_q.get()
+            result_q.put(('log', text.rstrip('\n')))
+
+            # not used in child process
+            for _ in range(config.log_q.qsize()):
+                config.log_q.get()
+
+    Thread(target=forward_logs, daemon=True).start()
+
+    workers = []  # free ChildWorker objects
+    lock = Lock()
+
+    def run_job(job):
+        config.__dict__.update(job['config'])
+
+        with lock:
+            worker = workers.pop() if workers else ChildWorker()
+
+        d = ChildItem(job, progress, cancel)
+        seg = ChildSegment(job, sizes)
+
+        worker.d = d
+        worker.reset()
+        worker.errors = []
+        worker.seg = seg
+        worker.mode = job['mode']
+        worker.resume_range = job['resume_range']
+        worker.speed_limit = job['speed_limit']
+        worker.minimum_speed = job['minimum_speed']
+        worker.timeout = job['timeout']
+        worker.rtt = 0
+
+        try:
+            response_code, curl_errno = worker.transfer()
+        except Exception as e:
+            log('engine: job error:', e)
+            response_code = curl_errno = 0
+
+        result_q.put(('result', {
+            'slot': job['slot'], 'response_code': response_code, 'curl_errno': curl_errno,
+            'headers': worker.headers, 'html_received': worker.html_received,
+            'byte_range_ignored': worker.byte_range_ignored, 'downloaded': worker.downloaded,
+            'start_size': worker.start_size, 'rtt': worker.rtt, 'seg_size': seg.size, 'validators': d.validators,
+            'remote_changed': d.remote_changed, 'resumable': d.resumable,
+            'range_ignored': is_range_ignored(seg.url), 'errors': worker.errors}))
+
+        worker.d = None
+        with lock:
+            workers.append(worker)
+
+    # quit if main process exited without stopping child processes, i.e. killed, parent_process() is new in
+    # python 3.8, for older versions on posix, orphaned process gets adopted by another process and its ppid changes
+    parent = getattr(multiprocessing, 'parent_process', lambda: None)()
+    ppid = os.getppid()
+
+    while True:
+        try:
+            job = job_q.get(timeout=1)
+        except queue.Empty:
+            if (parent and not parent.is_alive()) or os.getppid() != ppid:
+                break
+            continue
+
+        if job is None:
+            break
+        Thread(target=run_job, args=(job,), daemon=True).start()
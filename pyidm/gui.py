@@ -24,7 +24,8 @@ from . import setting
 from . import config
 from .config import Status
 from . import update
-from .brain import brain
+from .brain import brain, plan_finalize
+from . import storage
 from . import video
 from .video import Video, check_ffmpeg, download_ffmpeg, unzip_ffmpeg, get_ytdl_options, process_video_info, \
     download_m3u8, parse_subtitles, download_sub
@@ -80,6 +81,7 @@ class MainWindow:
         self.pl_quality = None
         self._pl_menu = []
         self._stream_menu = []
+        self.stream_menu_video = None  # video object which current stream menu belongs to
         self.m_bar_lock = Lock()  # a lock to access a video quality progress bar from threads
         self._m_bar = 0  # main playlist progress par value
         self._s_bar = 0  # individual video streams progress bar value
@@ -397,7 +399,9 @@ class MainWindow:
             [sg.Checkbox('Auto rename file if same name exists in download folder', default=config.auto_rename,
                          enable_events=True, key='auto_rename')],
             [sg.Checkbox('Write metadata to media files', default=config.write_metadata,
-                         enable_events=True, key='write_metadata')]
+                         enable_events=True, key='write_metadata')],
+            [sg.Checkbox('Keep recording live HLS streams until stream ends', default=config.record_live_hls,
+                         enable_events=True, key='record_live_hls')]
         ]
 
         network = [
@@ -500,6 +504,25 @@ class MainWindow:
                          default=config.checksum, key='checksum', enable_events=True, )],
             [sg.Checkbox('Use ThreadPoolExecutor instead of individual threads',
                          default=config.use_thread_pool_executor, key='use_thread_pool_executor', enable_events=True, )],
+            [sg.Checkbox('Download consecutive video fragments in batches over the same connection',
+                         default=config.fragment_batching, key='fragment_batching', enable_events=True, )],
+            [sg.Checkbox('Post-process HLS / DASH videos with ffmpeg while downloading (experimental)',
+                         default=config.stream_postprocessing, key='stream_postprocessing', enable_events=True, )],
+            [sg.Checkbox('Share connections between downloads and reuse url checking connection for first segment',
+                         default=config.share_connections, key='share_connections', enable_events=True, )],
+            [sg.Checkbox('Refresh expired links automatically while downloading, i.e. video links',
+                         default=config.auto_refresh_link, key='auto_refresh_link', enable_events=True, )],
+            [sg.Checkbox('Keep completed files in a local cache, same file downloaded again will be copied from it',
+                         default=config.use_download_cache, key='use_download_cache', enable_events=True, )],
+            [sg.Checkbox('Check free disk space before downloading, and pause downloads if space gets low',
+                         default=config.check_disk_space, key='check_disk_space', enable_events=True, )],
+            [sg.Checkbox('Write downloaded data by one disk writer thread per drive, instead of connection threads',
+                         default=config.use_disk_writers, key='use_disk_writers', enable_events=True, )],
+            [sg.Checkbox('Download in multiple processes, for very fast connections with many segments',
+                         default=config.use_process_engine, key='use_process_engine', enable_events=True, )],
+            [sg.T('Scratch folder for segments, i.e. SSD, empty = download folder:'),
+             sg.Input(config.scratch_folder, size=(25, 1), key='scratch_folder', enable_events=True),
+             sg.FolderBrowse(target='scratch_folder')],
         ]
 
         # layout ----------------------------------------------------------------------------------------------------
@@ -541,9 +564,9 @@ class MainWindow:
               sg.Tab('Log', log_layout)]],
             key='tab_group')],
             [
-             sg.T('', size=(73, 1), relief=sg.RELIEF_SUNKEN, font='any 8', key='status_bar'),
+             sg.T('', size=(69, 1), relief=sg.RELIEF_SUNKEN, font='any 8', key='status_bar'),
              sg.Text('', size=(10, 1), key='status_code', relief=sg.RELIEF_SUNKEN, font='any 8'),
-             sg.T('5 ▼  |  6 ⏳', size=(12, 1), key='active_downloads', relief=sg.RELIEF_SUNKEN, font='any 8', tooltip=' active downloads | pending downloads '),
+             sg.T('5 ▼  |  6 ⏳  |  1 ↯', size=(16, 1), key='active_downloads', relief=sg.RELIEF_SUNKEN, font='any 8', tooltip=' active downloads | pending downloads | post processing '),
              sg.T('⬇350 bytes/s', font='any 8', relief=sg.RELIEF_SUNKEN, size=(12, 1), key='total_speed'),
             ]
         ]
@@ -851,8 +874,9 @@ class MainWindow:
             if self.active_tab == 'Downloads':
                 self.update_table()
 
-            # update active and pending downloads
-            self.window['active_downloads'](f' {len(self.active_downloads)} ▼  |  {len(self.pending)} ⏳')
+            # update active, pending downloads, and post processing items
+            processing = len([d for d in self.d_list if d.status == Status.processing])
+            self.window['active_downloads'](f' {len(self.active_downloads)} ▼  |  {len(self.pending)} ⏳  |  {processing} ↯')
 
             # Settings
             speed_limit = size_format(config.speed_limit) if config.speed_limit > 0 else "_no limit_"
@@ -1425,6 +1449,9 @@ class MainWindow:
             elif event == 'write_metadata':
                 config.write_metadata = values['write_metadata']
 
+            elif event == 'record_live_hls':
+                config.record_live_hls = values['record_live_hls']
+
             # elif event == 'segment_size':
             #     user_input = values['segment_size']
             #
@@ -1591,6 +1618,34 @@ class MainWindow:
             elif event == 'use_thread_pool_executor':
                 config.use_thread_pool_executor = values['use_thread_pool_executor']
 
+            elif event == 'fragment_batching':
+                config.fragment_batching = values['fragment_batching']
+
+            elif event == 'stream_postprocessing':
+                config.stream_postprocessing = values['stream_postprocessing']
+
+            elif event == 'share_connections':
+                config.share_connections = values['share_connections']
+
+            elif event == 'auto_refresh_link':
+                config.auto_refresh_link = values['auto_refresh_link']
+
+            elif event == 'use_download_cache':
+                config.use_download_cache = values['use_download_cache']
+
+            elif event == 'check_disk_space':
+                config.check_disk_space = values['check_disk_space']
+
+            elif event == 'use_disk_writers':
+                config.use_disk_writers = values['use_disk_writers']
+
+            elif event == 'use_process_engine':
+                config.use_process_engine = values['use_process_engine']
+
+            elif event == 'scratch_folder':
+                folder = values['scratch_folder'].strip()
+                config.scratch_folder = os.path.abspath(folder) if folder else ''
+
             # log ---------------------------------------------------------------------------------------------------
             elif event == 'log_level':
                 config.log_level = int(values['log_level'])
@@ -1625,9 +1680,12 @@ class MainWindow:
                 # scheduled downloads
                 self.check_scheduled()
 
-                # process pending jobs
+                # process pending jobs, items waiting for disk space are skipped until their next check time
                 if self.pending and len(self.active_downloads) < config.max_concurrent_downloads:
-                    self.start_download(self.pending.popleft(), silent=True)
+                    d = next((x for x in self.pending if storage.space_check_due(x)), None)
+                    if d:
+                        self.pending.remove(d)
+                        self.start_download(d, silent=True)
 
             # run active windows
             for win in self.active_windows:
@@ -1795,15 +1853,17 @@ class MainWindow:
             if response == 'Resume':
                 log('check resuming?')
 
-                # to resume, size must match, otherwise it will just overwrite
-                if d.size == d_from_list.size and d.selected_quality == d_from_list.selected_quality:
+                # to resume, size must match and remote file not changed, otherwise it will just overwrite
+                if d.size == d_from_list.size and d.selected_quality == d_from_list.selected_quality and \
+                        validators_match(d_from_list.validators.get('main', {}), d.validators.get('main', {})):
                     log('resume is possible')
                     # get the same segment size
                     d.segment_size = d_from_list.segment_size
                     d.downloaded = d_from_list.downloaded
                 else:
                     if not silent:
-                        msg = f'Resume not possible, New "download item" has differnet properties than existing one \n' \
+                        msg = f'Resume not possible, New "download item" has differnet properties than existing one, \n' \
+                              f'or remote file changed since previous download \n' \
                               f'New item    : size={size_format(d.size)}, selected quality={d.selected_quality}\n' \
                               f'current item: size={size_format(d_from_list.size)}, selected quality={d_from_list.selected_quality}\n' \
                               f'if you continue, previous download will be overwritten'
@@ -1845,6 +1905,14 @@ class MainWindow:
             self.pending.append(d)
             return None
 
+        # not enough free disk space for this download and other running downloads, wait in pending queue
+        if not storage.reserve(d, postprocessing=bool(plan_finalize(d))):
+            if d.status != Status.pending:
+                log(f'not enough free disk space for "{d.name}", it will start when space is available')
+            d.status = Status.pending
+            self.pending.append(d)
+            return None
+
         # create download window and append to active list
         if config.show_download_window and (not silent or force_window):
             self.show_download_window(d)
@@ -2418,7 +2486,12 @@ class MainWindow:
 
     def update_stream_menu(self):
         try:
+            # same video with updated streams names, i.e. streams sizes arrived late, keep current selection
+            same_video = self.video is self.stream_menu_video and len(self.stream_menu) == len(self.video.stream_menu)
+            current_index = self.window['stream_menu'].Widget.current()
+
             self.stream_menu = self.video.stream_menu
+            self.stream_menu_video = self.video
 
             # check if there any requested quality / stream
             if self.requested_quality and self.requested_quality in self.stream_menu:
@@ -2426,6 +2499,8 @@ class MainWindow:
 
                 # reset requested quality, because it's one time use only
                 self.requested_quality = None
+            elif same_video and current_index > 0:
+                index = current_index
             else:
                 index = 1
 
@@ -2975,7 +3050,7 @@ class DownloadWindow:
 
     def create_window(self):
         layout = [
-            [sg.T('', size=(60, 4), key='out')],
+            [sg.T('', size=(60, 5), key='out')],
 
             [sg.T(' ' * 120, key='percent')],
 
@@ -3006,6 +3081,21 @@ class DownloadWindow:
               f"speed: {size_format(self.d.speed, '/s') }  {time_format(self.d.time_left)} left \n" \
               f"live connections: {self.d.live_connections} - remaining parts: {self.d.remaining_parts} {errors}\n"
 
+        # video and audio progress for dash videos
+        if 'dash' in self.d.subtype_list and self.d.status == Status.downloading:
+            out += ' - '.join(f'{track}: {p}%' for track, p in self.d.track_progress.items())
+
+        # moving completed file to another device, see storage.move_file()
+        elif self.d.status == Status.processing and 'rate' in self.d.processing_progress:
+            p = self.d.processing_progress
+            out += f"moving file: {p['percent']}% at {size_format(p['rate'])}/s - {time_format(p['eta'])} left"
+
+        # ffmpeg progress while post processing
+        elif self.d.status == Status.processing and self.d.processing_progress:
+            p = self.d.processing_progress
+            out += f"processing: {p.get('percent', '--')}% - {time_format(p['time'])} at {p['speed']}x " \
+                   f"- {time_format(p.get('eta', -1))} left"
+
         try:
             self.window['out'](value=out)
 
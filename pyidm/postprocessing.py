@@ -0,0 +1,83 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# post processing queue, ffmpeg jobs i.e. merging, converting, and writing metadata use cpu and disk not network, they
+# run here in a bounded worker pool sized by cpu count, instead of each download's file manager thread
+
+import os
+import itertools
+from queue import PriorityQueue
+from threading import Thread, Lock
+
+from . import config
+from .config import Status
+from .utils import log
+
+jobs_q = PriorityQueue()  # items: (priority, order, d, func, args)
+_order = itertools.count()  # keep first in first out order for jobs with same priority
+_workers = []
+_lock = Lock()
+
+
+def pool_size():
+    """number of post processing workers, config.max_postprocessing_jobs or half of cpu cores"""
+    return config.max_postprocessing_jobs or max((os.cpu_count() or 2) // 2, 1)
+
+
+def submit(d, func, *args, priority=None):
+    """
+    add a post processing job
+    :param d: DownloadItem object, its status should be Status.processing, cancelled jobs are skipped
+    :param func: function to be called as func(d, *args)
+    :param priority: lower value runs first, default is item size, small files finish first
+    :return: None
+    """
+    if priority is None:
+        priority = d.total_size or 0
+
+    d.status = Status.processing
+    jobs_q.put((priority, next(_order), d, func, args))
+    log('post processing queued:', d.name, '- waiting jobs:', jobs_q.qsize(), log_level=2)
+
+    start_workers()
+
+
+def start_workers():
+    """start workers up to pool size, pool grows if config.max_postprocessing_jobs increased"""
+    with _lock:
+        _workers[:] = [t for t in _workers if t.is_alive()]
+
+        for _ in range(pool_size() - len(_workers)):
+            t = Thread(target=worker, daemon=True)
+            t.start()
+            _workers.append(t)
+
+
+def worker():
+    while True:
+        priority, _, d, func, args = jobs_q.get()
+
+        # download cancelled while waiting in queue
+        if d.status != Status.processing:
+            log('post processing skipped:', d.name, '- status:', d.status, log_level=2)
+            continue
+
+        log('post processing started:', d.name, log_level=2)
+        try:
+            func(d, *args)
+        except Exception as e:
+            log('post processing error:', d.name, e)
+            if d.status == Status.processing:
+                d.status = Status.error
+            if config.TEST_MODE:
+                raise e
+
+        # job ended without setting final status
+        if d.status == Status.processing:
+            d.status = Status.error
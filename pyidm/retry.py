@@ -0,0 +1,251 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# retry policies, failed requests are classified by http status code and curl error number, every class has its own
+# backoff delay, fatal limit, and whether it should reduce connections number, also a per-host circuit breaker shared
+# between all downloads stops hammering a server which keeps failing or throttling
+
+import time
+import random
+import email.utils
+from threading import Lock
+
+from . import config
+from .utils import log, get_host
+
+# curl error numbers, https://curl.haxx.se/libcurl/c/libcurl-errors.html
+CURLE_COULDNT_RESOLVE_PROXY = 5
+CURLE_COULDNT_RESOLVE_HOST = 6
+CURLE_COULDNT_CONNECT = 7
+CURLE_WRITE_ERROR = 23
+CURLE_OPERATION_TIMEDOUT = 28
+CURLE_SSL_CONNECT_ERROR = 35
+CURLE_ABORTED_BY_CALLBACK = 42
+CURLE_GOT_NOTHING = 52
+CURLE_SEND_ERROR = 55
+CURLE_RECV_ERROR = 56
+CURLE_HTTP2_STREAM = 92
+
+# policy for every error class:
+# delay: base backoff delay in seconds, doubled with every retry up to max_delay, with random jitter
+# fatal: number of retries after which download will stop with error, 0 = never, network errors are counted per host
+# reduce: True to reduce connections number, i.e. server can't handle current connections
+# breaker: True to count failure in host's circuit breaker
+# expiry: True if error might mean an expired link, see refresh_link() in brain.py
+policies = {
+    'html': dict(delay=1, max_delay=30, fatal=0, reduce=True, breaker=False, expiry=True),  # html page, i.e. login page
+    'aborted': dict(delay=0, max_delay=0, fatal=0, reduce=False, breaker=False, expiry=False),  # cancelled, or write callback
+    'throttled': dict(delay=2, max_delay=120, fatal=0, reduce=True, breaker=True, expiry=False),  # 429, 503
+    'server': dict(delay=1, max_delay=60, fatal=0, reduce=True, breaker=True, expiry=False),  # other 5xx
+    'forbidden': dict(delay=2, max_delay=60, fatal=10, reduce=True, breaker=True, expiry=True),  # 401, 403, too many connections?
+    'not_found': dict(delay=1, max_delay=10, fatal=3, reduce=False, breaker=False, expiry=True),  # 404, 410, expired link
+    'client': dict(delay=1, max_delay=10, fatal=3, reduce=False, breaker=False, expiry=False),  # other 4xx
+    'timeout': dict(delay=0.5, max_delay=30, fatal=0, reduce=True, breaker=True, expiry=False),  # 408, curl timeout
+    'network': dict(delay=1, max_delay=60, fatal=10, reduce=False, breaker=True, expiry=False),  # dns and connection errors
+    'other': dict(delay=0.5, max_delay=30, fatal=0, reduce=True, breaker=False, expiry=False),  # unknown errors
+}
+
+
+def classify(response_code=0, curl_errno=0, html=False):
+    """
+    classify failed request
+    :param response_code: http status code
+    :param curl_errno: curl error number from pycurl.error exception
+    :param html: True if request aborted because server sent html contents instead of file contents
+    :return: error class name, key in policies dict
+    """
+    if html:
+        return 'html'
+    elif curl_errno in (CURLE_WRITE_ERROR, CURLE_ABORTED_BY_CALLBACK):
+        return 'aborted'
+    elif response_code in (429, 503):
+        return 'throttled'
+    elif response_code in (408,) or curl_errno == CURLE_OPERATION_TIMEDOUT:
+        return 'timeout'
+    elif response_code >= 500:
+        return 'server'
+    elif response_code in (401, 403):
+        return 'forbidden'
+    elif response_code in (404, 410):
+        return 'not_found'
+    elif response_code >= 400:
+        return 'client'
+    elif curl_errno in (CURLE_COULDNT_RESOLVE_PROXY, CURLE_COULDNT_RESOLVE_HOST, CURLE_COULDNT_CONNECT,
+                        CURLE_SSL_CONNECT_ERROR, CURLE_GOT_NOTHING, CURLE_SEND_ERROR, CURLE_RECV_ERROR,
+                        CURLE_HTTP2_STREAM):
+        return 'network'
+    else:
+        return 'other'
+
+
+def parse_retry_after(value):
+    """
+    parse Retry-After header
+    :param value: seconds "i.e. '120'", or http date "i.e. 'Wed, 21 Oct 2015 07:28:00 GMT'"
+    :return: seconds to wait, or None if not valid
+    """
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+
+def backoff_delay(error_class, retries, retry_after=None):
+    """
+    exponential backoff with full jitter, server's Retry-After is respected if available
+    :param error_class: key in policies dict
+    :param retries: number of previous retries
+    :param retry_after: seconds from Retry-After header
+    :return: delay in seconds
+    """
+    policy = policies[error_class]
+    delay = random.uniform(0, min(policy['max_delay'], policy['delay'] * 2 ** max(retries - 1, 0)))
+
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, config.max_retry_after))
+
+    return delay
+
+
+def is_fatal(error_class, retries):
+    """check if request shouldn't be retried anymore"""
+    fatal = policies[error_class]['fatal']
+    return bool(fatal) and retries >= fatal
+
+
+class CircuitBreaker:
+    """
+    per-host circuit breaker, after a number of consecutive failures circuit "opens" and no requests allowed until
+    cooldown time passes, then the first sent request makes it "half-open" and works as a probe, if succeeded circuit
+    closes again, and if failed it opens with a doubled cooldown, a probe which isn't resolved in time "i.e. never
+    sent" drops it back to open, so another probe can be sent
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.state = 'closed'  # closed, open, or half-open
+        self.open_until = 0
+        self.probe_until = 0
+        self.cooldown = config.circuit_breaker_cooldown
+
+    def allow(self):
+        """:return: seconds to wait before next request, zero means request allowed"""
+        if self.state == 'half-open':
+            # probe request still running
+            if time.time() < self.probe_until:
+                return 1
+
+            # probe timeout
+            self.state = 'open'
+
+        if self.state == 'open':
+            return max(self.open_until - time.time(), 0)
+
+        return 0
+
+    def probe(self):
+        """a request is being sent, the first one after cooldown is the probe"""
+        if self.state == 'open' and time.time() >= self.open_until:
+            self.state = 'half-open'
+            self.probe_until = time.time() + config.circuit_breaker_probe_timeout
+
+    def success(self):
+        self.failures = 0
+        self.state = 'closed'
+        self.cooldown = config.circuit_breaker_cooldown
+
+    def failure(self, retry_after=None):
+        self.failures += 1
+
+        if self.state == 'half-open':
+            # probe failed
+            self.cooldown = min(self.cooldown * 2, config.max_retry_after)
+        elif self.failures < config.circuit_breaker_threshold:
+            return
+
+        # server's Retry-After overrides own cooldown
+        cooldown = min(retry_after, config.max_retry_after) if retry_after is not None else self.cooldown
+
+        self.state = 'open'
+        self.open_until = time.time() + cooldown
+
+
+_breakers = {}  # key: host, value: CircuitBreaker object
+_lock = Lock()
+
+
+def _get_breaker(url):
+    host = get_host(url)
+    with _lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+
+def allow_request(url):
+    """
+    check host's circuit breaker before sending a request, request isn't counted as a probe until report_request()
+    :param url: request url
+    :return: seconds to wait, zero means request is allowed
+    """
+    with _lock:
+        breaker = _breakers.get(get_host(url))
+        return breaker.allow() if breaker else 0
+
+
+def host_failures(url):
+    """:return: number of consecutive failures from url's host"""
+    with _lock:
+        breaker = _breakers.get(get_host(url))
+        return breaker.failures if breaker else 0
+
+
+def report_request(url):
+    """a request to url will be sent now, it becomes the probe if host's circuit breaker cooldown passed"""
+    with _lock:
+        breaker = _breakers.get(get_host(url))
+        if breaker:
+            breaker.probe()
+
+
+def report_success(url):
+    breaker = _get_breaker(url)
+    with _lock:
+        if breaker.state != 'closed' or breaker.failures:
+            log('circuit breaker closed for:', get_host(url), log_level=3)
+        breaker.success()
+
+
+def report_failure(url, error_class, retry_after=None):
+    breaker = _get_breaker(url)
+    with _lock:
+        state = breaker.state
+
+        if not policies[error_class]['breaker']:
+            # a probe is resolved whatever the outcome, server answered with html page or 4xx, or request aborted
+            if state == 'half-open':
+                if error_class in ('html', 'not_found', 'client'):
+                    breaker.success()
+                else:
+                    breaker.failure()
+            return
+
+        breaker.failure(retry_after)
+
+        if breaker.state == 'open' and state != 'open':
+            log('circuit breaker open for:', get_host(url), 'for', round(breaker.open_until - time.time(), 1),
+                'seconds', log_level=2)
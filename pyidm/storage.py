@@ -0,0 +1,543 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# disk storage helpers, segments can be downloaded into a fast scratch folder "i.e. local ssd or tmpfs" instead of
+# download folder "i.e. nas or slow hdd", then file manager assembles them into temp file in download folder in one
+# sequential pass, segments spill over to download folder when scratch folder budget or free space runs out
+# if scratch folder is on another device and has room for the whole file, temp file is assembled in scratch folder
+# too, and moved to download folder after done by one sequential copy in post processing pool
+# disk budget, every download reserves its estimated peak disk usage on download folder's device before starting,
+# downloads wait in pending list until there is enough free space, and running downloads pause if space gets low
+# disk writers, workers hand received data to one writer thread per device instead of writing inside curl's write
+# callback, so a slow disk or network mount doesn't stall network receive directly
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+from collections import deque
+from threading import Lock, Condition, Thread
+
+from . import config
+from .config import Status
+from .utils import log, size_format, delete_file
+
+_usage = {'time': 0, 'bytes': 0, 'reserved': 0}  # cached scratch folder usage, see scratch_used()
+_lock = Lock()
+
+# scratch folder space promised to segments and temp files before they are written, folder scan doesn't see them yet
+# key: id(d), value: list of [files, seg, bytes], seg is None for temp files, see scratch_used()
+_scratch_reservations = {}
+
+# disk space reservations, key: id(d), value: {'d': d, 'device': st_dev, 'bytes': int, 'start': int, 'time': float}
+_reservations = {}
+
+# items waiting for disk space, key: id(d), value: [next check time, delay], delay is doubled after every failed check,
+# all items are checked again once a reservation is released
+_space_waits = {}
+
+
+def scratch_root():
+    """scratch folder full path, or empty string if not configured"""
+    return os.path.abspath(config.scratch_folder) if config.scratch_folder else ''
+
+
+def scratch_path(d, name):
+    """
+    path of a download item's temp file or folder inside scratch folder, it must be unique for every target file and
+    the same between sessions to be able to resume
+    :param d: DownloadItem object
+    :param name: temp file or folder name, i.e. '_temp_video.mp4_parts_'
+    :return: full path
+    """
+    digest = hashlib.md5(os.path.abspath(d.folder).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(scratch_root(), f'{digest}{name}')
+
+
+def same_device(src, dst):
+    """check if moving src file to dst path is just a rename, dst file might not exist yet"""
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    except OSError:
+        return True
+
+
+def folder_size(folder):
+    """total size of all files in folder and its sub folders"""
+    total = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def _scratch_reserved():
+    """
+    scratch folder reservations which are not written yet, downloaded segments are released, caller must hold _lock
+    :return: bytes
+    """
+    total = 0
+    for items in _scratch_reservations.values():
+        for item in list(items):
+            files, seg, size = item
+            if seg and seg.downloaded:
+                items.remove(item)
+                continue
+
+            written = sum(os.path.getsize(file) for file in files if os.path.isfile(file))
+            total += max(size - written, 0)
+
+    return total
+
+
+def scratch_used():
+    """
+    scratch folder usage in bytes, including reserved space which is not written yet, folder is scanned once per
+    second at most
+    """
+    with _lock:
+        if time.time() - _usage['time'] > 1:
+            _usage['bytes'] = folder_size(scratch_root())
+            _usage['reserved'] = _scratch_reserved()
+            _usage['time'] = time.time()
+        return _usage['bytes'] + _usage['reserved']
+
+
+def place_segment(d, seg):
+    """
+    choose segment location before downloading it, segment stays in scratch folder if scratch budget and free space
+    allow, otherwise it will be moved to download folder, segments with downloaded data are not moved
+    :param d: DownloadItem object
+    :param seg: Segment object
+    :return: None
+    """
+    root = scratch_root()
+    if not root or os.path.dirname(seg.name) != d.temp_folder or seg.current_size:
+        return
+
+    # hls local m3u8 file refers to segments by their path, see video.pre_process_hls()
+    if 'hls' in d.subtype_list:
+        return
+
+    size = seg.size or config.segment_size
+
+    try:
+        free = shutil.disk_usage(root).free
+    except OSError:
+        free = 0
+
+    used = scratch_used()
+    if used + size <= config.scratch_size and size < free:
+        # reserve it now, released when segment is downloaded or download item is done
+        with _lock:
+            _scratch_reservations.setdefault(id(d), []).append([[seg.name], seg, size])
+            _usage['reserved'] += size
+        return
+
+    seg.name = os.path.join(d.spill_folder, seg.basename)
+    log(f'scratch folder full, used: {size_format(used)} of {size_format(config.scratch_size)}, free: '
+        f'{size_format(free)}, segment {seg.basename} spilled over to download folder', log_level=3)
+
+
+def use_scratch_temp(d):
+    """
+    decide if download item's temp files will be assembled in scratch folder, only if scratch folder is on another
+    device than download folder, and has room for the whole file, otherwise moving final file costs a copy for nothing
+    :param d: DownloadItem object
+    :return: bool
+    """
+    root = scratch_root()
+    size = d.total_size
+    if not root or size <= config.small_file_size:
+        return False
+
+    try:
+        os.makedirs(root, exist_ok=True)
+        free = shutil.disk_usage(root).free
+    except OSError:
+        return False
+
+    if same_device(root, os.path.join(d.folder, d.name)):
+        return False
+
+    if scratch_used() + size > config.scratch_size or size >= free:
+        return False
+
+    # reserve it now for temp files, released when download item is done
+    with _lock:
+        files = [scratch_path(d, f'{prefix}{d.name}'.replace(' ', '_')) for prefix in ('_temp_', 'audio_for_')]
+        _scratch_reservations.setdefault(id(d), []).append([files, None, size])
+        _usage['reserved'] += size
+    return True
+
+
+def copy_data(src_file, dst_file, size, callback=None):
+    """
+    copy file contents in chunks, by os.copy_file_range() in kernel space if available, otherwise read / write
+    :param src_file: file object opened for reading
+    :param dst_file: file object opened for writing
+    :param size: number of bytes to be copied
+    :param callback: called with number of copied bytes after every chunk, returns False to abort
+    :return: number of copied bytes
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    done = 0
+
+    while done < size:
+        n = min(config.move_chunk_size, size - done)
+        count = 0
+
+        if copy_file_range:
+            try:
+                count = copy_file_range(src_file.fileno(), dst_file.fileno(), n, done, done)
+            except OSError as e:
+                # not supported between these file systems or by kernel
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                copy_file_range = None
+
+        if not copy_file_range:
+            src_file.seek(done)
+            dst_file.seek(done)
+            data = src_file.read(n)
+            dst_file.write(data)
+            count = len(data)
+
+        if not count:
+            break
+
+        done += count
+        if callback and callback(done) is False:
+            break
+
+    return done
+
+
+def move_file(src, dst, d=None):
+    """
+    move file to its final location, os.replace() on the same device, otherwise chunked copy to a temp name in
+    destination folder with progress, speed limit, and free space check, then fsync and atomic rename
+    :param src: source file path
+    :param dst: destination file path, must not exist
+    :param d: DownloadItem object, for progress report in d.processing_progress, copy aborts if d.status changed
+    :return: True if succeeded
+    """
+    if src == dst:
+        return True
+    elif os.path.isfile(dst):
+        log('move_file()> destination file already exist')
+        return False
+
+    if same_device(src, dst):
+        try:
+            os.replace(src, dst)
+            log('done renaming file:', src, '... to:', dst)
+            return True
+        except OSError as e:
+            log('move_file()> ', e)
+            return False
+
+    temp = dst + '.moving'
+    t = time.time()
+
+    def callback(done):
+        elapsed = max(time.time() - t, 0.001)
+
+        # speed limit
+        if config.move_speed_limit:
+            time.sleep(max(done / config.move_speed_limit - elapsed, 0))
+            elapsed = max(time.time() - t, 0.001)
+
+        if d:
+            rate = done / elapsed
+            d.processing_progress = {'time': elapsed, 'rate': rate, 'size': done,
+                                     'percent': round(done * 100 / size, 1) if size else 100,
+                                     'eta': (size - done) / rate if rate else -1}
+
+            # cancelled by user
+            if d.status != Status.processing:
+                return False
+
+    try:
+        size = os.path.getsize(src)
+        free = shutil.disk_usage(os.path.dirname(os.path.abspath(dst))).free
+        if size >= free:
+            log('move_file()> not enough disk space to move:', os.path.basename(dst), '- required:',
+                size_format(size), '- free:', size_format(free), showpopup=True)
+            return False
+
+        log('moving file to another device:', src, '... to:', dst, log_level=2)
+
+        with open(src, 'rb') as src_file, open(temp, 'wb') as dst_file:
+            done = copy_data(src_file, dst_file, size, callback)
+            if done != size:
+                raise Exception(f'copied {done} of {size} bytes')
+
+            dst_file.flush()
+            os.fsync(dst_file.fileno())
+
+        os.replace(temp, dst)
+        delete_file(src)
+
+        elapsed = max(time.time() - t, 0.001)
+        log('done moving file:', src, '... to:', dst, f'- {size_format(size)} in {round(elapsed, 2)} seconds, '
+            f'{size_format(size / elapsed)}/s')
+        return True
+
+    except Exception as e:
+        log('move_file()> error:', e)
+        delete_file(temp)
+        return False
+
+    finally:
+        if d:
+            d.processing_progress = {}
+
+
+def estimate_space(d, postprocessing=False):
+    """
+    estimate peak disk usage of a download item, segments are kept until temp file is completed, and ffmpeg writes
+    another copy while post processing, i.e. up to 3 times file size
+    :param d: DownloadItem object
+    :param postprocessing: True if ffmpeg will write target file, see brain.plan_finalize()
+    :return: bytes, zero if size is unknown
+    """
+    size = d.total_size
+    if not size:
+        return 0
+
+    # remaining segments, previously downloaded segments are already on disk
+    need = max(size - d.downloaded, 0)
+
+    # temp file assembled from segments
+    need += size
+
+    # ffmpeg output
+    if postprocessing:
+        need += size
+
+    return need
+
+
+def _remaining(r):
+    """reserved bytes which are not written yet, for running downloads only"""
+    d = r['d']
+    if d.status not in (Status.downloading, Status.processing) and time.time() - r['time'] > 5:
+        # download finished, or its brain thread not started yet and grace period is over
+        return 0
+
+    return max(r['bytes'] - max(d.downloaded - r['start'], 0), 0)
+
+
+def reserve(d, postprocessing=False):
+    """
+    reserve disk space for a download item on its download folder device, all segments and temp files are counted
+    there, scratch folder has its own budget and spills over to download folder
+    :param d: DownloadItem object
+    :param postprocessing: True if ffmpeg will write target file
+    :return: True if enough free space, otherwise download should wait
+    """
+    with _lock:
+        _reservations.pop(id(d), None)
+
+        need = estimate_space(d, postprocessing)
+        if not config.check_disk_space or not need:
+            return True
+
+        try:
+            device = os.stat(d.folder).st_dev
+            free = shutil.disk_usage(d.folder).free
+        except OSError:
+            return True
+
+        reserved = sum(_remaining(r) for r in _reservations.values() if r['device'] == device)
+        if free - reserved - need < config.min_free_space:
+            log(f'reserve()> "{d.name}" needs {size_format(need)}, free: {size_format(free)}, '
+                f'reserved by other downloads: {size_format(reserved)}', log_level=3)
+
+            # back off before checking again
+            delay = min(_space_waits.get(id(d), [0, 0.5])[1] * 2, 30)
+            _space_waits[id(d)] = [time.time() + delay, delay]
+            return False
+
+        _space_waits.pop(id(d), None)
+        _reservations[id(d)] = {'d': d, 'device': device, 'bytes': need, 'start': d.downloaded, 'time': time.time()}
+        return True
+
+
+def release(d):
+    """remove disk space and scratch folder reservations of a download item, waiting items will be checked again"""
+    with _lock:
+        _reservations.pop(id(d), None)
+        _space_waits.clear()
+
+        if _scratch_reservations.pop(id(d), None):
+            _usage['reserved'] = _scratch_reserved()
+
+
+def space_check_due(d):
+    """check if a download item waiting for disk space should try reserve() again, see reserve()"""
+    with _lock:
+        return time.time() >= _space_waits.get(id(d), [0])[0]
+
+
+def low_space(d):
+    """check if free space on download folder device is below config.min_free_space"""
+    if not config.check_disk_space:
+        return False
+
+    try:
+        return shutil.disk_usage(d.folder).free < config.min_free_space
+    except OSError:
+        return False
+
+
+class DiskWriter:
+    """
+    writer thread for one device, received chunks are queued as they are "no copy", and written in order, adjacent
+    chunks of the same file are coalesced into one os.writev() call, queue size is limited by
+    config.writer_queue_size, workers pause curl transfer when queue is full, see Worker.write()
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.q = deque()  # items: (file, data, time)
+        self.queued = 0  # bytes in queue
+        self.pending = {}  # key: file object, value: number of queued chunks
+        self.errors = {}  # key: file object, value: OSError
+        self.cv = Condition()
+
+        # metrics
+        self.max_queued = 0
+        self.writes = 0
+        self.written = 0
+        self.latency = 0  # average seconds between queuing a chunk and writing it
+        self.pauses = 0
+
+        Thread(target=self.run, daemon=True, name=f'disk writer {device}').start()
+
+    @property
+    def full(self):
+        return self.queued >= config.writer_queue_size
+
+    def submit(self, file, data, wait=0):
+        """
+        queue data to be written to file
+        :param file: file object opened in binary mode
+        :param data: bytes, or memoryview
+        :param wait: seconds to wait for space in queue if full
+        :return: True if queued, False if queue is full
+        :raise: OSError if a previous write to the same file failed
+        """
+        with self.cv:
+            if file in self.errors:
+                raise self.errors[file]
+
+            if self.full and not self.cv.wait_for(lambda: not self.full, timeout=wait):
+                self.pauses += 1
+                return False
+
+            self.q.append((file, data, time.time()))
+            self.queued += len(data)
+            self.max_queued = max(self.max_queued, self.queued)
+            self.pending[file] = self.pending.get(file, 0) + 1
+            self.cv.notify_all()
+            return True
+
+    def flush(self, file):
+        """
+        wait until all queued chunks of a file are written
+        :return: OSError if a write failed, otherwise None
+        """
+        with self.cv:
+            self.cv.wait_for(lambda: not self.pending.get(file))
+            self.pending.pop(file, None)
+            return self.errors.pop(file, None)
+
+    def run(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: self.q)
+
+                # adjacent chunks of the same file, os.writev() accepts limited number of buffers
+                file, data, t = self.q.popleft()
+                chunks, times = [data], [t]
+                while self.q and self.q[0][0] is file and len(chunks) < 512:
+                    _, data, t = self.q.popleft()
+                    chunks.append(data)
+                    times.append(t)
+
+            size = sum(len(x) for x in chunks)
+            error = None
+            try:
+                if file not in self.errors:
+                    write_chunks(file, chunks)
+            except OSError as e:
+                error = e
+                log('disk writer> error:', e)
+
+            now = time.time()
+            with self.cv:
+                if error:
+                    self.errors[file] = error
+                self.queued -= size
+                self.pending[file] -= len(chunks)
+                self.writes += 1
+                self.written += size
+                self.latency = self.latency * 0.9 + (now - sum(times) / len(times)) * 0.1
+                self.cv.notify_all()
+
+    def stats(self):
+        return {'queued': self.queued, 'max_queued': self.max_queued, 'writes': self.writes, 'written': self.written,
+                'latency_ms': round(self.latency * 1000, 2), 'pauses': self.pauses}
+
+
+def write_chunks(file, chunks):
+    """write list of bytes / memoryview chunks to file, by one system call if possible"""
+    view = None
+    if hasattr(os, 'writev'):
+        count = os.writev(file.fileno(), chunks)
+        total = sum(len(x) for x in chunks)
+        if count < total:
+            # partial write, i.e. disk full, write remaining data normally
+            view = memoryview(b''.join(chunks))[count:]
+    else:
+        view = memoryview(b''.join(chunks))
+
+    while view:
+        count = file.write(view)
+        if not count:
+            raise OSError(errno.EIO, 'write failed')
+        view = view[count:]
+
+
+_writers = {}  # key: device id, value: DiskWriter object
+
+
+def get_writer(file_name):
+    """
+    disk writer for file's device, created on first use
+    :param file_name: file path, its folder must exist
+    :return: DiskWriter object
+    """
+    device = os.stat(os.path.dirname(os.path.abspath(file_name))).st_dev
+    with _lock:
+        if device not in _writers:
+            _writers[device] = DiskWriter(device)
+        return _writers[device]
+
+
+def writer_stats():
+    """disk writers metrics, i.e. {device: {'queued': 0, 'max_queued': 1048576, 'latency_ms': 0.3, ...}}"""
+    with _lock:
+        return {device: writer.stats() for device, writer in _writers.items()}
@@ -21,6 +21,9 @@ import subprocess
 import shlex
 import re
 import json
+from collections import deque, OrderedDict
+from threading import Lock, Event
+from urllib.parse import urlparse
 import pyperclip as clipboard
 try:
     from PIL import Image
@@ -70,6 +73,28 @@ def handle_exceptions(error):
         log(error)
 
 
+# curl share object, all curl handles share dns cache, tls sessions, and connections pool, a connection left open by
+# one handle "i.e. header probe" will be reused by another handle "i.e. first worker" without a new handshake
+_curl_share = None
+
+
+def get_curl_share():
+    global _curl_share
+    if not _curl_share:
+        _curl_share = pycurl.CurlShare()
+        _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+        # connections sharing requires libcurl 7.57
+        if hasattr(pycurl, 'LOCK_DATA_CONNECT'):
+            try:
+                _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+            except pycurl.error:
+                pass
+
+    return _curl_share
+
+
 def set_curl_options(c, http_headers=None):
     """take pycurl object as an argument and set basic options"""
 
@@ -129,13 +154,108 @@ def set_curl_options(c, http_headers=None):
     c.setopt(pycurl.TIMEOUT, 300)
     c.setopt(pycurl.AUTOREFERER, 1)
 
+    # shared dns cache, tls sessions, and connections
+    if config.share_connections:
+        try:
+            c.setopt(pycurl.SHARE, get_curl_share())
+        except pycurl.error:
+            pass  # reused curl handle, "i.e. worker" is already sharing
+
+
+# headers cache, key: (url, http headers, proxy, referer, cookies), value: (time stamp, headers dict)
+_headers_cache = OrderedDict()
+_headers_inflight = {}  # key: [Event, headers] for requests in progress
+_headers_lock = Lock()
+headers_cache_stats = {'hits': 0, 'misses': 0, 'shared': 0}
+
+
+def headers_cache_key(url, http_headers=None):
+    """cache key includes every option which might change server response"""
+    http_headers = http_headers or config.HEADERS
+    return (url, tuple(sorted(http_headers.items())), config.proxy, config.referer_url,
+            config.use_cookies and config.cookie_file_path)
+
+
+def cache_headers(key, headers):
+    """store headers in cache, least recently used items will be removed when cache is full"""
+    # don't cache network errors, i.e. status code = 0
+    if not headers.get('status_code') or not config.headers_cache_ttl:
+        return
+
+    with _headers_lock:
+        _headers_cache[key] = (time.time(), headers)
+        _headers_cache.move_to_end(key)
+        while len(_headers_cache) > config.headers_cache_size:
+            _headers_cache.popitem(last=False)
 
-def get_headers(url, verbose=False, http_headers=None):
-    """return dictionary of headers"""
+
+def get_headers(url, verbose=False, http_headers=None, use_cache=True, prefetch=0):
+    """
+    return dictionary of headers, recent results will be reused from cache, and identical requests running
+    at the same time from different threads will share one request
+    :param url: string
+    :param verbose: if True print headers
+    :param http_headers: dict of http headers
+    :param use_cache: if False will send a new request and update cache
+    :param prefetch: number of bytes to download from file start, will be used later as first segment data,
+    see get_prefetched()
+    :return: dict of headers, includes 'status_code' and 'eff_url' keys
+    """
+    key = headers_cache_key(url, http_headers)
+
+    with _headers_lock:
+        if use_cache and not verbose:
+            # fresh cached headers
+            timestamp, headers = _headers_cache.get(key, (0, None))
+            if headers and time.time() - timestamp < config.headers_cache_ttl:
+                _headers_cache.move_to_end(key)
+                headers_cache_stats['hits'] += 1
+                return dict(headers)
+
+            # same request in progress by another thread
+            inflight = _headers_inflight.get(key)
+            if inflight:
+                headers_cache_stats['shared'] += 1
+        else:
+            inflight = None
+
+        if not inflight:
+            headers_cache_stats['misses'] += 1
+            _headers_inflight[key] = [Event(), None]
+
+    if inflight:
+        event, _ = inflight
+        event.wait()
+        return dict(inflight[1])
+
+    headers = {}
+    try:
+        headers = _get_headers(url, verbose=verbose, http_headers=http_headers, prefetch=prefetch)
+        cache_headers(key, headers)
+    finally:
+        # release waiting threads
+        with _headers_lock:
+            inflight = _headers_inflight.pop(key)
+        inflight[1] = headers
+        inflight[0].set()
+
+    log('get_headers()> cache stats:', headers_cache_stats, log_level=3)
+
+    return dict(headers)
+
+
+def _get_headers(url, verbose=False, http_headers=None, prefetch=0):
+    """
+    return dictionary of headers
+    if prefetch is set, a ranged request will be sent to get first bytes of file, connection stays open at the end
+    and will be reused by first worker "when config.share_connections is enabled"
+    """
 
     log('get_headers()> getting headers for:', url, log_level=3)
 
     curl_headers = {}
+    body = []
+    received = 0
 
     def header_callback(header_line):
         # quit if main window terminated
@@ -143,20 +263,26 @@ def get_headers(url, verbose=False, http_headers=None):
             return
 
         header_line = header_line.decode('iso-8859-1')
-        header_line = header_line.lower()
 
         if ':' not in header_line:
             return
 
         name, value = header_line.split(':', 1)
-        name = name.strip()
-        value = value.strip()
+        name = name.strip().lower()
+        value = value.strip() if name in validator_headers else value.strip().lower()
         curl_headers[name] = value
         if verbose:
             print(name, ':', value)
 
     def write_callback(data):
-        return -1  # send terminate flag
+        nonlocal received
+
+        # server ignored range header or sent more data than requested
+        if not prefetch or received + len(data) > prefetch:
+            return -1  # send terminate flag
+
+        body.append(data)
+        received += len(data)
 
     def debug_callback(handle, type, data, size=0, userdata=''):
         """it takes output from curl verbose and pass it to my log function"""
@@ -176,22 +302,276 @@ def get_headers(url, verbose=False, http_headers=None):
     c.setopt(pycurl.URL, url)
     c.setopt(pycurl.WRITEFUNCTION, write_callback)
     c.setopt(pycurl.HEADERFUNCTION, header_callback)
+
+    if prefetch:
+        c.setopt(pycurl.RANGE, f'0-{prefetch - 1}')
     # endregion
 
     try:
         c.perform()
     except Exception as e:
-        if 'Failed writing body' not in str(e):
+        # aborted by write callback, newer libcurl versions say "Failure writing output"
+        if not any(statement in str(e) for statement in ('Failed writing body', 'Failure writing output')):
             log('get_headers()>', e)
 
     # add status code and effective url to headers
     curl_headers['status_code'] = c.getinfo(pycurl.RESPONSE_CODE)
     curl_headers['eff_url'] = c.getinfo(pycurl.EFFECTIVE_URL)
 
+    # closing handle will leave connection open in shared connections pool
+    c.close()
+
+    if prefetch:
+        # partial content, restore full file headers, i.e. content-range: bytes 0-262143/5000000
+        if curl_headers['status_code'] == 206:
+            match = re.match(r'bytes 0-(\d+)/(\d+)', curl_headers.get('content-range', ''))
+            if match:
+                curl_headers['content-length'] = match.group(2)
+                curl_headers['accept-ranges'] = 'bytes'
+
+                # complete transfer
+                if int(match.group(1)) + 1 == received:
+                    store_prefetched(curl_headers['eff_url'], int(match.group(2)), b''.join(body))
+            else:
+                # unknown file size
+                curl_headers.pop('content-length', None)
+
+            curl_headers['status_code'] = 200
+            curl_headers.pop('content-range', None)
+
+        elif curl_headers['status_code'] == 200:
+            # whole file received, server ignored range header
+            if str(received) == curl_headers.get('content-length'):
+                store_prefetched(curl_headers['eff_url'], received, b''.join(body))
+
+            # server ignored range header, resume and multi-connections are not possible
+            elif 'content-length' in curl_headers and int(curl_headers['content-length']) > prefetch:
+                mark_range_ignored(curl_headers['eff_url'])
+                curl_headers['accept-ranges'] = 'none'
+
     # return headers
     return curl_headers
 
 
+# hosts which answered ranged requests with whole file or wrong range, key: host name, value: time stamp
+_range_ignoring_hosts = {}
+
+
+def get_host(url):
+    """return host name of url, i.e. 'www.example.com:8080'"""
+    return urlparse(url or '').netloc.lower()
+
+
+def mark_range_ignored(url):
+    """remember that server ignores range requests, files from this host will be downloaded by one connection"""
+    host = get_host(url)
+    if host and host not in _range_ignoring_hosts:
+        log('server ignores range requests:', host, log_level=2)
+    _range_ignoring_hosts[host] = time.time()
+
+
+def is_range_ignored(url):
+    """check if server is known to ignore range requests, see mark_range_ignored()"""
+    timestamp = _range_ignoring_hosts.get(get_host(url))
+
+    # servers might change their behaviour, don't remember forever
+    return bool(timestamp) and time.time() - timestamp < config.range_check_ttl
+
+
+# response headers which identify a remote file version, values are case sensitive and kept as is while parsing headers
+validator_headers = ('etag', 'last-modified')
+
+
+def get_validators(headers):
+    """
+    get remote file validators from response headers, used to check if file changed since some segments downloaded
+    :param headers: dict of response headers
+    :return: dict i.e. {'etag': '"5e1a-16b"', 'last-modified': 'Wed, 21 Oct 2015 07:28:00 GMT', 'size': 23066}
+    """
+    validators = {k: headers[k] for k in validator_headers if headers.get(k)}
+
+    # total file size, partial content has it in content-range i.e. 'bytes 0-99/23066'
+    match = re.match(r'bytes \d+-\d+/(\d+)', headers.get('content-range', ''))
+    size = match.group(1) if match else headers.get('content-length', '')
+    if size.isdigit():
+        validators['size'] = int(size)
+
+    return validators
+
+
+def validators_match(old, new):
+    """
+    compare validators of the same remote file, only values available in both are compared
+    :param old: dict, see get_validators()
+    :param new: dict, see get_validators()
+    :return: False if remote file changed
+    """
+    return all(old[k] == new[k] for k in old if k in new)
+
+
+def get_if_range(validators):
+    """
+    value for "If-Range" request header, server sends requested range only if file not changed, otherwise sends
+    the whole new file, weak etags are not allowed, https://tools.ietf.org/html/rfc7233#section-3.2
+    :param validators: dict, see get_validators()
+    :return: strong etag, last modified date, or None
+    """
+    etag = validators.get('etag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return validators.get('last-modified')
+
+
+# file start bytes downloaded while getting headers, key: effective url, value: (time stamp, file size, data)
+# oldest entries first
+_prefetched = {}
+_prefetched_lock = Lock()
+
+
+def remove_stale_prefetched():
+    """remove prefetched data older than config.prefetch_ttl, caller must hold _prefetched_lock"""
+    for key, (timestamp, _, _) in list(_prefetched.items()):
+        if time.time() - timestamp > config.prefetch_ttl:
+            _prefetched.pop(key, None)
+
+
+def store_prefetched(url, size, data):
+    """
+    keep file start bytes for get_prefetched(), total data in memory is limited to config.prefetch_cache_size,
+    oldest entries are dropped first, i.e. urls which checked but never downloaded
+    :param url: effective url
+    :param size: file size reported by server
+    :param data: bytes
+    """
+    with _prefetched_lock:
+        remove_stale_prefetched()
+
+        # re-insert to be the newest entry
+        _prefetched.pop(url, None)
+        _prefetched[url] = (time.time(), size, data)
+
+        total = sum(len(item[2]) for item in _prefetched.values())
+        for key in list(_prefetched):
+            if total <= config.prefetch_cache_size:
+                break
+            total -= len(_prefetched.pop(key)[2])
+
+
+def get_prefetched(url, size):
+    """
+    get first bytes of a file downloaded by get_headers(..., prefetch=n), data is used only once
+    :param url: effective url
+    :param size: expected file size, data will be ignored if server reported different size
+    :return: bytes or None
+    """
+    with _prefetched_lock:
+        remove_stale_prefetched()
+        timestamp, file_size, data = _prefetched.pop(url, (0, 0, None))
+
+    if data and file_size == size:
+        return data
+
+
+def get_headers_multi(urls, http_headers=None, timeout=10, max_connections=None, callback=None):
+    """
+    get headers for many urls concurrently using one curl multi handle, which shares connections and dns cache
+    between transfers, instead of sequential get_headers() calls
+    :param urls: list of urls
+    :param http_headers: dict of http headers
+    :param timeout: time budget in seconds for the whole call, unfinished requests will be aborted
+    :param max_connections: max simultaneous connections, default is config.max_connections
+    :param callback: optional function called with (url, headers) as soon as every request finishes
+    :return: dict of {url: headers}, headers is same as get_headers() output, unfinished urls will be missing
+    """
+    urls = list(dict.fromkeys(urls))  # remove duplicates and keep order
+    result = {}
+
+    if not urls:
+        return result
+
+    log('get_headers_multi()> getting headers for', len(urls), 'urls', log_level=3)
+
+    m = pycurl.CurlMulti()
+    max_connections = max_connections or config.max_connections
+
+    def header_callback(headers, header_line):
+        header_line = header_line.decode('iso-8859-1')
+
+        if ':' not in header_line:
+            return
+
+        name, value = header_line.split(':', 1)
+        name = name.strip().lower()
+        headers[name] = value.strip() if name in validator_headers else value.strip().lower()
+
+    handles = {}  # running transfers
+    queue = urls[::-1]
+
+    def add_handles():
+        # limit simultaneous transfers, don't flood server with connections
+        while queue and len(handles) < max_connections:
+            url = queue.pop()
+            headers = {}
+            c = pycurl.Curl()
+            set_curl_options(c, http_headers)
+            c.setopt(pycurl.URL, url)
+            c.setopt(pycurl.WRITEFUNCTION, lambda data: -1)  # abort when body starts, we need headers only
+            c.setopt(pycurl.HEADERFUNCTION, lambda line, headers=headers: header_callback(headers, line))
+            handles[c] = (url, headers)
+            m.add_handle(c)
+
+    def collect(c):
+        url, headers = handles.pop(c)
+
+        # add status code and effective url to headers
+        headers['status_code'] = c.getinfo(pycurl.RESPONSE_CODE)
+        headers['eff_url'] = c.getinfo(pycurl.EFFECTIVE_URL)
+        result[url] = headers
+
+        # share results with get_headers()
+        cache_headers(headers_cache_key(url, http_headers), dict(headers))
+
+        m.remove_handle(c)
+        c.close()
+
+        if callback:
+            try:
+                callback(url, headers)
+            except Exception as e:
+                log('get_headers_multi()> callback error:', e)
+
+    add_handles()
+    deadline = time.time() + timeout
+    while handles and time.time() < deadline and not config.terminate:
+        while True:
+            ret, num_handles = m.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        # finished transfers, "Failed writing body" errors are expected since we abort at body
+        _, ok_list, err_list = m.info_read()
+        for c in ok_list + [x[0] for x in err_list]:
+            collect(c)
+
+        # start queued urls, then call perform() again without waiting
+        if ok_list or err_list:
+            add_handles()
+            continue
+
+        m.select(min(1.0, max(deadline - time.time(), 0)))
+
+    # abort unfinished transfers
+    for c in list(handles):
+        m.remove_handle(c)
+        c.close()
+    m.close()
+
+    log('get_headers_multi()> done', len(result), 'of', len(urls), log_level=3)
+
+    return result
+
+
 def download(url, file_name=None, verbose=True, http_headers=None):
     """
     simple file download, into bytesio buffer and store it on disk if file_name is given
@@ -454,7 +834,41 @@ def get_seg_size(seg):
         return 0
 
 
-def run_command(cmd, verbose=True, shell=False, hide_window=True, d=None, nonblocking=False):
+def parse_ffmpeg_progress(fields, duration=None):
+    """
+    convert ffmpeg "-progress" key/value block into processing progress
+    :param fields: dict of one progress block, i.e. {'out_time_us': '5000000', 'speed': '12.5x', 'total_size': '1024'}
+    :param duration: total media duration in seconds, required for percentage and eta
+    :return: dict, i.e. {'time': 5.0, 'speed': 12.5, 'size': 1024, 'percent': 25.0, 'eta': 1.2}
+    """
+    progress = {}
+
+    # processed media time, out_time_ms is actually in microseconds as well
+    try:
+        progress['time'] = int(fields.get('out_time_us') or fields.get('out_time_ms')) / 1000000
+    except:
+        progress['time'] = 0
+
+    # processing speed relative to real time, i.e. "12.5x", it will be "N/A" at the beginning
+    try:
+        progress['speed'] = float(fields.get('speed', '').rstrip('x'))
+    except:
+        progress['speed'] = 0
+
+    try:
+        progress['size'] = int(fields.get('total_size'))
+    except:
+        progress['size'] = 0
+
+    if duration:
+        progress['percent'] = min(round(progress['time'] * 100 / duration, 1), 100)
+        remaining = max(duration - progress['time'], 0)
+        progress['eta'] = remaining / progress['speed'] if progress['speed'] else -1
+
+    return progress
+
+
+def run_command(cmd, verbose=True, shell=False, hide_window=True, d=None, nonblocking=False, duration=None):
     """
     run command in a subprocess
     :param cmd: string of actual command to be executed
@@ -463,7 +877,8 @@ def run_command(cmd, verbose=True, shell=False, hide_window=True, d=None, nonblo
     :param hide_window: True or False, hide shell window
     :param d: DownloadItem object mainly use "status" property to terminate subprocess
     :param nonblocking: if True, run subprocess and exit in other words it will not block until finish subprocess
-    :return: error (True or False), output (string of stdout/stderr output)
+    :param duration: media duration in seconds, used to calculate ffmpeg progress percentage and eta
+    :return: error (True or False), output (string of last lines of stdout/stderr output)
     """
 
     # override shell parameter currently can't kill subprocess if shell=True at least on windows, more investigation required
@@ -500,19 +915,44 @@ def run_command(cmd, verbose=True, shell=False, hide_window=True, d=None, nonblo
         if d:
             d.subprocess = process
 
-        output = ''
+        # keep last lines only, a long ffmpeg run might print thousands of lines
+        lines = deque(maxlen=config.max_command_output_lines)
+
+        # ffmpeg "-progress pipe:1" writes key=value lines to stdout, every block ends with "progress=continue/end"
+        track_progress = '-progress' in cmd
+        progress_fields = {}
+
+        # rate limit log forwarding
+        log_timer = 0
+        skipped = 0
 
         for line in process.stdout:
             line = line.strip()
-            output += line
+            if not line:
+                continue
+
+            if track_progress:
+                key, sep, value = line.partition('=')
+                if sep and ' ' not in key:
+                    progress_fields[key] = value.strip()
+                    if key == 'progress':
+                        if d:
+                            d.processing_progress = parse_ffmpeg_progress(progress_fields, duration)
+                        progress_fields = {}
+                    continue
+
+            lines.append(line)
+
             if verbose:
-                log(line)
+                if time.time() - log_timer >= config.command_log_interval:
+                    log(line if not skipped else f'{line}  ... ({skipped} lines skipped)')
+                    log_timer = time.time()
+                    skipped = 0
+                else:
+                    skipped += 1
 
-            # # monitor kill switch
-            # if d and d.status == config.Status.cancelled:
-            #     log('terminate run_command()>', cmd)
-            #     process.kill()
-                # return 1, 'Cancelled by user'
+        if verbose and skipped:
+            log(lines[-1], f'  ... ({skipped} lines skipped)')
 
         # wait for subprocess to finish, process.wait() is not recommended
         process.communicate()
@@ -521,6 +961,8 @@ def run_command(cmd, verbose=True, shell=False, hide_window=True, d=None, nonblo
         process.poll()
         error = process.returncode != 0  # True or False
 
+        output = '\n'.join(lines)
+
     except Exception as e:
         log('error running command: ', e, ' - cmd:', cmd)
 
@@ -1031,6 +1473,34 @@ def get_range_list(file_size):
     return range_list
 
 
+def coalesce_ranges(ranges, max_size=None, max_gap=None):
+    """
+    group consecutive byte ranges of the same resource, to be downloaded in one request instead of one request per range
+    :param ranges: list of byte ranges i.e. [[0, 640], [2197, 63702], ... ], in the same order they will be merged
+    :param max_size: maximum size in bytes for a combined range, default is config.max_coalesced_size
+    :param max_gap: maximum number of bytes between 2 ranges, which will be downloaded and dropped later
+    :return: list of (span, parts) i.e. [([0, 63702], [[0, 640], [2197, 63702]]), ...]
+    """
+    max_size = config.max_coalesced_size if max_size is None else max_size
+    max_gap = config.max_coalesced_gap if max_gap is None else max_gap
+
+    groups = []
+    for range_ in ranges:
+        if groups:
+            span, parts = groups[-1]
+            gap = range_[0] - span[1] - 1
+
+            # only forward ranges, overlapped or reversed ranges will start a new group
+            if 0 <= gap <= max_gap and range_[1] - span[0] + 1 <= max_size:
+                span[1] = range_[1]
+                parts.append(range_)
+                continue
+
+        groups.append(([range_[0], range_[1]], [range_]))
+
+    return groups
+
+
 char_map = {
     # mapping for rendering arabic letters on linux
         '\u0628': '\ufe91',
@@ -9,14 +9,29 @@
 import copy
 import os
 import re
+import shlex
+import subprocess
 import zipfile
 import time
+from threading import Thread
 from urllib.parse import urljoin
 
 from . import config
+from .config import MediaType
 from .downloaditem import DownloadItem, Segment
-from .utils import (log, validate_file_name, get_headers, size_format, run_command, size_splitter, get_seg_size,
-                    delete_file, download, process_thumbnail, execute_command, rename_file)
+from .utils import (log, validate_file_name, get_headers_multi, size_format, run_command, size_splitter, get_seg_size,
+                    delete_file, download, process_thumbnail, execute_command, coalesce_ranges)
+
+# AES cipher for in-process decryption of hls segments, optional, same package used by youtube-dl "pycryptodomex"
+try:
+    from Cryptodome.Cipher import AES
+except ImportError:
+    try:
+        from Crypto.Cipher import AES
+    except ImportError:
+        AES = None
+        log('pycryptodomex module is missing, encrypted hls streams will be decrypted by ffmpeg after downloading',
+            log_level=2)
 
 # youtube-dl
 ytdl = None  # youtube-dl will be imported in a separate thread to save loading time
@@ -105,6 +120,7 @@ class Video(DownloadItem):
         self.stream_menu = []  # streams names
         self.stream_menu_map = []  # actual stream objects in same order like streams names in stream_menu
         self.names_map = {'mp4_videos': [], 'other_videos': [], 'audio_streams': [], 'extra_streams': []}
+        self.streams_map = {}  # same like names_map but with actual stream objects
         self.audio_streams = []
         self.video_streams = []
 
@@ -204,10 +220,9 @@ class Video(DownloadItem):
         all_streams = video_streams + audio_streams + extra_streams
 
         # create a name map
-        names_map = {'mp4_videos': [stream.name for stream in mp4_videos],
-                     'other_videos': [stream.name for stream in other_videos],
-                     'audio_streams': [stream.name for stream in audio_streams],
-                     'extra_streams': [stream.name for stream in extra_streams]}
+        streams_map = {'mp4_videos': mp4_videos, 'other_videos': other_videos, 'audio_streams': audio_streams,
+                       'extra_streams': extra_streams}
+        names_map = {key: [stream.name for stream in streams] for key, streams in streams_map.items()}
 
         # build menu
         stream_menu = ['● Video streams:                     '] + [stream.name for stream in mp4_videos] + [stream.name for stream in other_videos]  \
@@ -222,9 +237,64 @@ class Video(DownloadItem):
         self.stream_menu = stream_menu
         self.stream_menu_map = stream_menu_map
         self.names_map = names_map  # {'mp4_videos': [], 'other_videos': [], 'audio_streams': [], 'extra_streams': []}
+        self.streams_map = streams_map
         self.audio_streams = audio_streams
         self.video_streams = video_streams
 
+        # get missing sizes in a separate thread, stream menu names will be updated when done
+        if any(stream.size_pending for stream in all_streams):
+            Thread(target=self.probe_stream_sizes, args=(all_streams,), daemon=True).start()
+
+    def probe_stream_sizes(self, streams):
+        """
+        get missing streams sizes from http headers concurrently, stream menu names are updated as soon as every
+        size is received
+        :param streams: list of Stream objects
+        :return: None
+        """
+        pending = [stream for stream in streams if stream.size_pending]
+
+        def update(url, headers):
+            # streams from an old setup() call, i.e. after refresh(), no need to update
+            if streams is not self.all_streams:
+                return
+
+            for stream in pending:
+                if stream.url == url:
+                    try:
+                        stream.size = int(headers.get('content-length', 0))
+                    except ValueError:
+                        stream.size = 0
+                    stream.size_pending = False
+
+            self.update_stream_names()
+
+        results = get_headers_multi([stream.url for stream in pending], http_headers=self.http_headers,
+                                    timeout=config.size_probe_timeout, callback=update)
+
+        log('Video.probe_stream_sizes()>', self.title, '- got', len(results), 'sizes of', len(pending), 'streams',
+            log_level=3)
+
+        # unfinished requests, sizes will stay unknown
+        if streams is self.all_streams and any(stream.size_pending for stream in pending):
+            for stream in pending:
+                stream.size_pending = False
+            self.update_stream_names()
+
+    def update_stream_names(self):
+        """rebuild stream names after sizes changed, gui will notice stream menu change and refresh it"""
+        self.names_map = {key: [stream.name for stream in value] for key, value in self.streams_map.items()}
+        self.stream_menu = [stream.name if stream else text for text, stream in zip(self.stream_menu, self.stream_menu_map)]
+
+        # update sizes of selected streams
+        if self._selected_stream:
+            self.selected_quality = self._selected_stream.name
+            self.size = self._selected_stream.size
+            audio_stream = getattr(self, 'audio_stream', None)
+            if audio_stream and self.audio_url:
+                self.audio_quality = audio_stream.name
+                self.audio_size = audio_stream.size
+
     def select_stream(self, index=None, name=None, raw_name=None, update=True):  
         """
         search for a stream in self.stream_menu_map
@@ -383,6 +453,72 @@ def process_video_info(vid, getthumbnail=True):
         vid.busy = False
 
 
+def refresh_stream_urls(d):
+    """
+    extract fresh urls for an expired video link with youtube-dl, streams are matched by format id, download item's
+    urls are updated and new segments built to get their urls, completed segments are not touched
+    :param d: Video object
+    :return: dict of segment name: new url for fragmented and hls streams, empty dict for other streams,
+             or None if failed
+    """
+    if ytdl is None:
+        return None
+
+    with ytdl.YoutubeDL(get_ytdl_options()) as ydl:
+        vid_info = ydl.extract_info(d.url, download=False, process=True)
+
+    if not vid_info:
+        return None
+
+    # playlist url, pick our video
+    if vid_info.get('entries'):
+        vid_id = d.vid_info.get('id') if getattr(d, 'vid_info', None) else None
+        entries = [entry for entry in vid_info['entries'] if entry and entry.get('id') == vid_id]
+        if not entries:
+            return None
+        vid_info = entries[0]
+
+    formats = {item.get('format_id'): item for item in vid_info.get('formats') or [vid_info]}
+
+    if d.format_id not in formats or (d.audio_format_id and d.audio_format_id not in formats):
+        log('refresh_stream_urls()> stream not found, format id:', d.format_id, d.audio_format_id)
+        return None
+
+    stream = Stream(formats[d.format_id])
+    audio_stream = Stream(formats[d.audio_format_id]) if d.audio_format_id else None
+
+    d.eff_url = stream.url
+    d.manifest_url = stream.manifest_url
+    d.fragment_base_url = stream.fragment_base_url
+    d.fragments = stream.fragments
+    d.http_headers = vid_info.get('http_headers') or d.http_headers
+
+    if audio_stream:
+        d.audio_url = audio_stream.url
+        d.audio_fragment_base_url = audio_stream.fragment_base_url
+        d.audio_fragments = audio_stream.fragments
+
+    # build new segments with the same names as old ones to get their urls
+    segments = []
+    if 'hls' in d.subtype_list:
+        streams = [(d.eff_url, 'video'), (d.audio_url, 'audio')] if 'dash' in d.subtype_list else [(d.eff_url, 'video')]
+        for url, stream_type in streams:
+            m3u8_doc = download_m3u8(url, http_headers=d.http_headers)
+            if not m3u8_doc:
+                return None
+            segments += MediaPlaylist(d, url, m3u8_doc, stream_type).create_segment_list()
+
+    else:
+        if d.fragments:
+            segments += d.build_fragment_segments(d.fragment_base_url, d.fragments, d.temp_file, MediaType.video)
+
+        if audio_stream and d.audio_fragments:
+            segments += d.build_fragment_segments(d.audio_fragment_base_url, d.audio_fragments, d.audio_file,
+                                                  MediaType.audio, suffix='_audio')
+
+    return {seg.name: seg.url for seg in segments}
+
+
 class Stream:
     def __init__(self, stream_info):
         # fetch data from youtube-dl stream_info dictionary
@@ -417,24 +553,20 @@ class Stream:
         self.fragment_base_url = stream_info.get('fragment_base_url', None)
         self.fragments = stream_info.get('fragments', None)
 
-        # get missing size
+        # missing size will be probed later for all streams at once, see Video.probe_stream_sizes()
+        self.size_pending = False
         if self.fragments or 'm3u8' in self.protocol:
             # ignore fragmented streams, since the size coming from headers is for first fragment not whole file
             self.size = 0
         if not isinstance(self.size, int):
-            self.size = self.get_size()
+            self.size = 0
+            self.size_pending = bool(self.url)
 
         # hls stream specific
         self.manifest_url = stream_info.get('manifest_url', '')
 
         # print(self.name, self.size, isinstance(self.size, int))
 
-    def get_size(self):
-        headers = get_headers(self.url)
-        size = int(headers.get('content-length', 0))
-        log('stream.get_size()>', self.name, log_level=3)
-        return size
-
     @property
     def name(self):
         fps = f' - {self.fps} fps' if self.fps else ''
@@ -557,31 +689,6 @@ def check_ffmpeg():
             config.global_sett_folder, 'or', config.current_directory)
 
 
-def merge_video_audio(video, audio, output, d):
-    """merge video file and audio file into output file, d is a reference for current DownloadItem object"""
-    log('merging video and audio')
-
-    # ffmpeg file full location
-    ffmpeg = config.ffmpeg_actual_path
-
-    # very fast audio just copied, format must match [mp4, m4a] and [webm, webm]
-    cmd1 = f'"{ffmpeg}" -loglevel error -stats -y -i "{video}" -i "{audio}" -c copy "{output}"'
-
-    # slow, mix different formats
-    cmd2 = f'"{ffmpeg}" -loglevel error -stats -y -i "{video}" -i "{audio}" "{output}"'
-
-    verbose = True if config.log_level >= 2 else False
-
-    # run command with shell=False if failed will use shell=True option
-    error, output = run_command(cmd1, verbose=verbose, hide_window=True, d=d)
-
-    # retry on error with cmd2
-    if error:
-        error, output = run_command(cmd2, verbose=verbose, hide_window=True, d=d)
-
-    return error, output
-            
-
 def import_ytdl():
     # import youtube_dl using thread because it takes sometimes 20 seconds to get imported and impact app startup time
     start = time.time()
@@ -743,7 +850,7 @@ def pre_process_hls(d):
         process m3u8 file, extract urls, build local m3u8 file, and build segments for download item
         :param m3u8_doc: m3u8 as a text
         :param stream_type: 'video' or 'audio'
-        :return: None
+        :return: MediaPlaylist object
         """
 
         url = d.eff_url if stream_type == 'video' else d.audio_url
@@ -765,89 +872,498 @@ def pre_process_hls(d):
         with open(os.path.join(d.temp_folder, file_path), 'w') as f:
             f.write(media_playlist.create_local_m3u8_doc())
 
+        return media_playlist
+
     # reset segments first
     d.segments = []
 
     # send video m3u8 file for processing
-    process_m3u8(video_m3u8, stream_type='video')
+    playlists = [process_m3u8(video_m3u8, stream_type='video')]
 
     # send audio m3u8 file for processing
     if 'dash' in d.subtype_list:
-        process_m3u8(audio_m3u8, stream_type='audio')
+        playlists.append(process_m3u8(audio_m3u8, stream_type='audio'))
+
+    # live / event playlists, keep recording new segments until stream ends
+    if any(playlist.live for playlist in playlists):
+        if not config.record_live_hls:
+            log('pre_process_hls()> live stream, will download available segments only')
+        elif not all(seg.merge for seg in d.segments if seg.media_type != MediaType.key):
+            log('pre_process_hls()> live recording is not supported for this stream, '
+                'will download available segments only')
+        else:
+            log('pre_process_hls()> live stream, start recording')
+            d.recording = True
+            Thread(target=record_live_hls, daemon=True, args=(d, playlists)).start()
 
     log('pre_process_hls()> done processing', d.name)
 
     return True
 
 
+def record_live_hls(d, playlists):
+    """
+    reload live / event media playlists periodically, and append only new segments to download item, new segments get
+    merged continuously by file manager, completed segments are removed to keep memory and disk usage bounded
+    :param d: DownloadItem object
+    :param playlists: list of MediaPlaylist objects, video and optionally audio
+    :return: None
+    """
+
+    # playlist reload interval, should be equal to target duration, or half of it if playlist didn't change
+    target_duration = max(float(playlists[0].max_seg_duration or 6), 1)
+    last_change = time.time()
+    interval = target_duration
+
+    try:
+        while d.status == config.Status.downloading:
+            # sleep in small steps to respond quickly to status change
+            timer = time.time()
+            while time.time() - timer < interval and d.status == config.Status.downloading:
+                time.sleep(0.1)
+
+            if d.status != config.Status.downloading:
+                break
+
+            new_segments = []
+            for playlist in [playlist for playlist in playlists if playlist.live]:
+                m3u8_doc = download_m3u8(playlist.url, http_headers=d.http_headers)
+                if not m3u8_doc:
+                    continue
+
+                segments = playlist.refresh(m3u8_doc)
+                new_segments += segments
+
+            # remove completed segments and their files, key files are kept until their segments are merged, since
+            # decrypt_segment() reads the key file while merging
+            pending_keys = [seg.key for seg in d.segments if seg.key and not seg.completed]
+            completed = [seg for seg in d.segments if seg.completed and not any(seg is key for key in pending_keys)]
+            if not config.keep_temp:
+                for seg in completed:
+                    delete_file(seg.name)
+
+            d.segments = [seg for seg in d.segments if seg not in completed] + new_segments
+
+            if new_segments:
+                log('record_live_hls()> new segments:', len([seg for seg in new_segments if seg.merge]), log_level=2)
+                last_change = time.time()
+                interval = target_duration
+            else:
+                interval = target_duration / 2
+
+            # stop recording if playlist ended or didn't change for long time
+            if not any(playlist.live for playlist in playlists):
+                log('record_live_hls()> stream ended:', d.name)
+                break
+            elif time.time() - last_change > target_duration * 3:
+                log('record_live_hls()> no new segments, stop recording:', d.name)
+                break
+
+    except Exception as e:
+        log('record_live_hls()> error:', e)
+        if config.TEST_MODE:
+            raise e
+    finally:
+        d.recording = False
+
+
 def post_process_hls(d):
     """ffmpeg will process m3u8 files"""
 
     log('post_process_hls()> start processing', d.name)
 
-    local_video_m3u8_file = os.path.join(d.temp_folder, 'local_video.m3u8')
-    local_audio_m3u8_file = os.path.join(d.temp_folder, 'local_audio.m3u8')
+    # list of (media type, local m3u8 file, output file)
+    jobs = [(MediaType.video, os.path.join(d.temp_folder, 'local_video.m3u8'), d.temp_file)]
+
+    if 'dash' in d.subtype_list:
+        jobs.append((MediaType.audio, os.path.join(d.temp_folder, 'local_audio.m3u8'), d.audio_file))
+
+    for media_type, local_m3u8_file, output_file in jobs:
+        segments = [seg for seg in d.segments if seg.media_type == media_type]
 
-    cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -protocol_whitelist "file,http,https,tcp,tls,crypto"  ' \
-          f'-allowed_extensions ALL -i "{local_video_m3u8_file}" -c copy "file:{d.temp_file}"'
+        if all(seg.merge for seg in segments):
+            # segments already merged "and decrypted if needed", output file has cleartext mpeg-ts contents, it will
+            # be processed with other streams in one ffmpeg run, see process_media(), merged segments of a live
+            # recording are removed from d.segments, and local m3u8 file lists only the first ones
+            continue
+
+        if not process_local_m3u8(local_m3u8_file, output_file, d, stream_type=media_type):
+            return False
+
+    log('post_process_hls()> done processing', d.name)
+
+    return True
+
+
+def process_local_m3u8(local_m3u8_file, output_file, d, stream_type=MediaType.video):
+    """let ffmpeg read local m3u8 file, decrypt segments if needed, and write output file"""
+    start = time.time()
+    method = 'remux'
+
+    cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -nostats -progress pipe:1 -y -protocol_whitelist "file,http,https,tcp,tls,crypto"  ' \
+          f'-allowed_extensions ALL -i "{local_m3u8_file}" -c copy "file:{output_file}"'
     error, output = run_command(cmd, d=d)
 
     if error:
         # retry without "-c copy" parameter, takes longer time
-        cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -protocol_whitelist "file,http,https,tcp,tls,crypto"  ' \
-              f'-allowed_extensions ALL -i "{local_video_m3u8_file}" "file:{d.temp_file}"'
+        method = 'reencode'
+        cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -nostats -progress pipe:1 -y -protocol_whitelist "file,http,https,tcp,tls,crypto"  ' \
+              f'-allowed_extensions ALL -i "{local_m3u8_file}" "file:{output_file}"'
         error, output = run_command(cmd, d=d)
 
         if error:
             log('post_process_hls()> ffmpeg failed:', output)
             return False
 
-    if 'dash' in d.subtype_list:
-        cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -protocol_whitelist "file,http,https,tcp,tls,crypto"  ' \
-              f'-allowed_extensions ALL -i "{local_audio_m3u8_file}" -c copy "file:{d.audio_file}"'
-        error, output = run_command(cmd, d=d)
+    # record finalize method and time taken
+    d.finalize_info[stream_type] = (method, round(time.time() - start, 2))
 
-        if error:
-            # retry without "-c copy" parameter, takes longer time
-            cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -protocol_whitelist "file,http,https,tcp,tls,crypto"  ' \
-                  f'-allowed_extensions ALL -i "{local_audio_m3u8_file}" "file:{d.audio_file}"'
-            error, output = run_command(cmd, d=d)
+    return True
 
-            if error:
-                log('post_process_hls()> ffmpeg failed:', output)
-                return False
 
-    log('post_process_hls()> done processing', d.name)
+def main_stream_type(d):
+    """stream type used as download item's finalize_info key, dash video and its audio are muxed in one run"""
+    return MediaType.audio if d.type == 'audio' else MediaType.video
 
-    return True
 
+# codecs which can be copied into a container without re-encoding, None means container accepts any codec
+container_codecs = {
+    '.ts': ('h264', 'hevc', 'mpeg2video', 'mpeg1video', 'aac', 'mp3', 'mp2', 'ac3', 'eac3', 'opus'),
+    '.mp4': ('h264', 'hevc', 'av1', 'vp9', 'mpeg4', 'aac', 'mp3', 'ac3', 'eac3', 'opus', 'flac', 'alac'),
+    '.m4a': ('aac', 'mp3', 'ac3', 'eac3', 'opus', 'flac', 'alac'),
+    '.mov': ('h264', 'hevc', 'mpeg4', 'aac', 'mp3', 'ac3', 'alac'),
+    '.webm': ('vp8', 'vp9', 'av1', 'opus', 'vorbis'),
+    '.aac': ('aac',),
+    '.mp3': ('mp3',),
+    '.ogg': ('vorbis', 'opus', 'flac'),
+    '.mkv': None,
+}
+
+# cache for media info, key: (file name, size, modification time), value: info dictionary
+_media_info_cache = {}
 
-def convert_audio(d):
+
+def get_media_info(file):
+    """
+    probe media file by ffmpeg, results are cached as long as file didn't change
+    :param file: file name including path
+    :return: dict, i.e. {'duration': 62.03, 'streams': [('video', 'h264'), ('audio', 'aac')]}, or None if failed
     """
-    convert audio formats
+    try:
+        stat = os.stat(file)
+        key = (file, stat.st_size, stat.st_mtime)
+    except:
+        return None
+
+    if key in _media_info_cache:
+        return _media_info_cache[key]
+
+    # ffmpeg without output file will print input info then exit with error, we only need the printed info
+    cmd = f'"{config.ffmpeg_actual_path}" -hide_banner -i "{file}"'
+    _, output = run_command(cmd, verbose=False)
+
+    # example: Stream #0:0[0x100]: Video: h264 (Main) ([27][0][0][0] / 0x001B), yuv420p, 1280x720
+    streams = re.findall(r'Stream #\d+:\d+.*?: (Video|Audio|Subtitle|Data): (\w+)', output)
+    if not streams:
+        log('get_media_info()> failed to probe:', file, log_level=3)
+        return None
+
+    duration = 0
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', output)
+    if match:
+        h, m, sec = match.groups()
+        duration = int(h) * 3600 + int(m) * 60 + float(sec)
+
+    info = {'duration': duration, 'streams': [(kind.lower(), codec) for kind, codec in streams]}
+    _media_info_cache[key] = info
+
+    return info
+
+
+# subtitle formats which need conversion, codec copy doesn't work between them
+subtitle_extensions = ('.srt', '.vtt', '.ass', '.ssa')
+
+
+def plan_ffmpeg_command(inputs, output, meta_file=None, transcode=False):
+    """
+    build one ffmpeg command for muxing input files, copying or transcoding codecs, and writing metadata / chapters
+    :param inputs: list of input file names, i.e. video and audio of dash video
+    :param output: output file name, its extension decide container
+    :param meta_file: optional ffmpeg metadata file name, it includes chapters if available
+    :param transcode: if True will re-encode all streams
+    :return: (cmd, method), where method is 'remux', 'reencode', or 'unknown' if couldn't probe input files
+    """
+    ext = os.path.splitext(output)[1].lower()
+    allowed = container_codecs.get(ext, None)
+    codec_params = []
+
+    if transcode or ext in subtitle_extensions:
+        method = 'reencode'
+    else:
+        # cached probing results, no need to try copy first and fail
+        infos = [get_media_info(file) for file in inputs]
+        if None in infos:
+            method = 'unknown'
+            codec_params.append('-c copy')
+        else:
+            method = 'remux'
+            streams = [stream for info in infos for stream in info['streams']]
+            for kind, flag in (('video', 'v'), ('audio', 'a')):
+                codecs = [codec for kind_, codec in streams if kind_ == kind]
+                if allowed is None or all(codec in allowed for codec in codecs):
+                    codec_params.append(f'-c:{flag} copy')
+                else:
+                    # let ffmpeg use default encoder for this container
+                    method = 'reencode'
+
+    input_params = [f'-i "{file}"' for file in inputs]
+
+    if meta_file:
+        # metadata file is the last input, it has global tags and chapters
+        input_params.append(f'-i "{meta_file}"')
+        codec_params.append(f'-map_metadata {len(inputs)} -map_chapters {len(inputs)}')
+
+    cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -nostats -progress pipe:1 -y {" ".join(input_params)} ' \
+          f'{" ".join(codec_params)} "file:{output}"'
+
+    return cmd, method
+
+
+def process_media(d, inputs, output, stream_type=None):
+    """
+    mux / convert input files into output file and write metadata, in one ffmpeg run
     :param d: DownloadItem object
-    :return: bool True for success or False when failed
+    :param inputs: list of input file names
+    :param output: output file name
+    :param stream_type: used for recording finalize info, default is main_stream_type(d)
+    :return: True if success and False if fail
     """
-    # famous formats: mp3, aac, wav, ogg
-    infile = d.temp_file
-    outfile = d.target_file
+    start = time.time()
+    stream_type = stream_type or main_stream_type(d)
+    d.processing_progress = {}
 
-    # look for compatible formats and use "copy" parameter for faster processing
-    cmd1 = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -i "{infile}" -acodec copy "{outfile}"'
+    # metadata file
+    meta_file = None
+    if d.metadata_file_content and config.write_metadata:
+        meta_file = output + '.meta'
+        with open(meta_file, 'w') as f:
+            f.write(d.metadata_file_content)
 
-    # general command, consume time
-    cmd2 = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -i "{infile}" "{outfile}"'
+    cmd, method = plan_ffmpeg_command(inputs, output, meta_file=meta_file)
+    log('process_media()>', d.name, 'method:', method)
 
-    # run command1
-    error, _ = run_command(cmd1, verbose=True, hide_window=True, d=d)
+    # media duration from cached probing results, required for progress percentage and eta
+    duration = max((info['duration'] for info in map(get_media_info, inputs) if info), default=0)
 
-    if error:
-        error, _ = run_command(cmd2, verbose=True, hide_window=True, d=d)
+    error, output_ = run_command(cmd, d=d, duration=duration)
+
+    if error and method == 'unknown':
+        # probing failed, re-encode, takes longer time
+        method = 'reencode'
+        cmd, _ = plan_ffmpeg_command(inputs, output, meta_file=meta_file, transcode=True)
+        error, output_ = run_command(cmd, d=d, duration=duration)
+
+    if meta_file:
+        delete_file(meta_file)
 
     if error:
+        log('process_media()> ffmpeg failed:', output_)
         return False
-    else:
-        return True
+
+    # probing failed but copying codecs worked
+    if method == 'unknown':
+        method = 'remux'
+
+    # record finalize method and time taken
+    d.finalize_info[stream_type] = (method, round(time.time() - start, 2))
+    log('process_media()>', d.name, 'done', d.finalize_info[stream_type])
+
+    return True
+
+
+def plan_stream_postprocess(d):
+    """
+    check if download item's post processing can be done by ffmpeg while still downloading
+    :param d: DownloadItem object
+    :return: list of input files, or None if streaming post processing is not possible / not needed
+    """
+    if not config.stream_postprocessing or not config.ffmpeg_actual_path or not d.segments:
+        return None
+
+    # in-order streams only, temp file grows by appending, therefore its whole size is a valid contiguous prefix
+    if any(seg.range or not (seg.merge or seg.media_type == MediaType.key) for seg in d.segments):
+        return None
+
+    inputs = [d.temp_file]
+    if 'dash' in d.subtype_list:
+        # audio is fed through a named pipe, not available on windows
+        if not hasattr(os, 'mkfifo'):
+            return None
+        inputs.append(d.audio_file)
+
+    # nothing to do for single hls stream in mpeg-ts container or normal files
+    elif not (d.type == 'audio' or ('hls' in d.subtype_list and os.path.splitext(d.target_file)[1].lower() != '.ts')):
+        return None
+
+    return inputs
+
+
+class StreamPostProcessor:
+    """
+    feed in-order temp files into ffmpeg while segments still downloading, first input is fed through stdin pipe
+    and second input "audio of dash video" through a named pipe, output is written to a separate file which will
+    replace normal post processing if succeeded
+    """
+
+    def __init__(self, d, inputs):
+        self.d = d
+        self.inputs = inputs
+        self.output = os.path.join(d.folder, f'_streamed_{d.name}'.replace(' ', '_'))
+        self.fifo = os.path.join(d.temp_folder, 'audio_fifo')
+        self.meta_file = None
+        self.process = None
+        self.threads = []
+        self.errors = []  # last lines of ffmpeg stderr output
+        self.done = False  # set when all segments merged into temp files
+        self.cancelled = False
+
+    def start(self):
+        """start ffmpeg subprocess and feeding threads"""
+        ffmpeg = config.ffmpeg_actual_path
+        codec = '-acodec copy' if self.d.type == 'audio' else '-c copy'
+        fifo_input = f'-i "{self.fifo}"' if len(self.inputs) > 1 else ''
+
+        # metadata file as last input, see plan_ffmpeg_command()
+        meta_params = ''
+        if self.d.metadata_file_content and config.write_metadata:
+            self.meta_file = self.output + '.meta'
+            with open(self.meta_file, 'w') as f:
+                f.write(self.d.metadata_file_content)
+            meta_params = f'-i "{self.meta_file}" -map_metadata {len(self.inputs)} -map_chapters {len(self.inputs)}'
+
+        cmd = f'"{ffmpeg}" -loglevel error -y -i pipe:0 {fifo_input} {meta_params} {codec} "file:{self.output}"'
+
+        log('StreamPostProcessor()> start streaming:', cmd, log_level=2)
+
+        try:
+            if len(self.inputs) > 1:
+                os.makedirs(self.d.temp_folder, exist_ok=True)
+                delete_file(self.fifo)
+                os.mkfifo(self.fifo)
+
+            # startupinfo to hide terminal window on windows
+            startupinfo = None
+            if config.operating_system == 'Windows':
+                startupinfo = subprocess.STARTUPINFO()
+                startupinfo.dwFlags = subprocess.STARTF_USESHOWWINDOW
+                startupinfo.wShowWindow = subprocess.SW_HIDE
+
+            self.process = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.PIPE, startupinfo=startupinfo)
+
+            # update reference in download item, it will be killed if download cancelled
+            self.d.subprocess = self.process
+
+            self.threads = [Thread(target=self.read_errors, daemon=True),
+                            Thread(target=self.feed, args=(self.inputs[0], self.process.stdin), daemon=True)]
+            if len(self.inputs) > 1:
+                self.threads.append(Thread(target=self.feed, args=(self.inputs[1], None), daemon=True))
+
+            for t in self.threads:
+                t.start()
+
+            return True
+        except Exception as e:
+            log('StreamPostProcessor()> failed to start:', e)
+            self.cancel()
+            return False
+
+    def read_errors(self):
+        for line in self.process.stderr:
+            self.errors = self.errors[-9:] + [line.decode('utf-8', errors='replace').strip()]
+
+    def open_fifo(self):
+        """open named pipe for writing, it waits until ffmpeg opens it for reading"""
+        while not self.cancelled and self.process.poll() is None:
+            try:
+                fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+                os.set_blocking(fd, True)
+                return os.fdopen(fd, 'wb')
+            except OSError:
+                # no reader yet
+                time.sleep(0.1)
+
+    def feed(self, file, pipe=None):
+        """
+        write temp file contents to pipe as it grows
+        :param file: temp file name
+        :param pipe: writable file object, if None will open fifo
+        """
+        try:
+            pipe = pipe or self.open_fifo()
+            if not pipe:
+                return
+
+            with open(file, 'rb') as src:
+                while not self.cancelled:
+                    # check flag before reading, an empty read after all segments merged means end of file
+                    done = self.done
+                    data = src.read(1024 * 1024)
+                    if data:
+                        pipe.write(data)
+                    elif done or self.process.poll() is not None:
+                        break
+                    else:
+                        time.sleep(0.1)
+        except Exception as e:
+            # BrokenPipeError if ffmpeg quit
+            log('StreamPostProcessor()> feeding', os.path.basename(file), 'stopped:', e, log_level=2)
+        finally:
+            try:
+                pipe.close()
+            except:
+                pass
+
+    def finish(self):
+        """
+        feed the rest of temp files, and wait for ffmpeg
+        :return: True if output file created successfully
+        """
+        start = time.time()
+        self.done = True
+
+        for t in self.threads:
+            t.join()
+
+        returncode = self.process.wait()
+        success = returncode == 0 and not self.cancelled and os.path.isfile(self.output) and \
+            os.path.getsize(self.output) > 0
+
+        if success:
+            stream_type = main_stream_type(self.d)
+            self.d.finalize_info[stream_type] = ('streamed', round(time.time() - start, 2))
+            log('StreamPostProcessor()> done', self.d.finalize_info[stream_type])
+        else:
+            log('StreamPostProcessor()> failed, will use normal post processing', self.errors)
+            delete_file(self.output)
+
+        delete_file(self.fifo)
+        delete_file(self.meta_file)
+        return success
+
+    def cancel(self):
+        """stop feeding, kill ffmpeg, and delete output file"""
+        self.cancelled = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+        for t in self.threads:
+            t.join(1)
+
+        delete_file(self.output)
+        delete_file(self.fifo)
+        delete_file(self.meta_file)
 
 
 # parse m3u8 lines
@@ -1052,19 +1568,6 @@ def get_metadata(info):
     return metadata_file_content
 
 
-def write_metadata(input_file, meta_file):
-    file, ext = os.path.splitext(input_file)
-    out_file = file + '_2' + ext
-    cmd = f'"{config.ffmpeg_actual_path}" -loglevel error -stats -y -i "{input_file}"  -i "{meta_file}" -map_metadata 1 -codec copy "{out_file}"'
-    error, output = run_command(cmd, verbose=True)
-    if error:
-        return False
-    else:
-        delete_file(input_file)
-        rename_file(out_file, input_file)
-        return True
-
-
 class Key(Segment):
     def __init__(self):
         super().__init__(self)
@@ -1081,6 +1584,45 @@ class Key(Segment):
         info = parse_m3u8_line(self.raw_line)
         return self.raw_line.replace(info.get('URI', '__NONE__'), self.url)
 
+    def get_iv(self, seq):
+        """
+        get initialization vector as 16 bytes
+        :param seq: media sequence number of the segment, used as iv if key line has no IV attribute
+        :return: bytes
+        """
+        if self.iv:
+            # example: IV=0x8f6109d91fffb816bcd43fefe018db49
+            iv = self.iv[2:] if self.iv.lower().startswith('0x') else self.iv
+            return bytes.fromhex(iv.zfill(32))
+        else:
+            return seq.to_bytes(16, 'big')
+
+
+def decrypt_segment(seg):
+    """
+    decrypt an AES-128 encrypted hls segment using its already downloaded key
+    :param seg: Segment object, with seg.key and seg.seq
+    :return: cleartext bytes
+    """
+    with open(seg.key.name, 'rb') as f:
+        key = f.read()
+
+    with open(seg.name, 'rb') as f:
+        data = f.read()
+
+    if len(key) != 16:
+        raise ValueError(f'invalid AES-128 key length: {len(key)}, key file: {seg.key.name}')
+
+    cipher = AES.new(key, AES.MODE_CBC, seg.key.get_iv(seg.seq))
+    contents = cipher.decrypt(data)
+
+    # remove PKCS7 padding
+    padding = contents[-1] if contents else 0
+    if 0 < padding <= 16 and contents[-padding:] == bytes([padding]) * padding:
+        contents = contents[:-padding]
+
+    return contents
+
 
 class MediaPlaylist:
     def __init__(self, d, url, m3u8_doc, stream_type):
@@ -1106,6 +1648,8 @@ class MediaPlaylist:
         self.encryption_type = None
         self.current_key = None
         self.segments = []
+        self.ended = False  # True if playlist has #EXT-X-ENDLIST tag
+        self.last_seq = -1  # media sequence number of last segment
         self.parse_m3u8_doc()
 
     def parse_m3u8_doc(self):
@@ -1113,6 +1657,10 @@ class MediaPlaylist:
         lines = self.m3u8_doc.splitlines()
         lines = [line.strip() for line in lines if line.strip()]
 
+        seq = 0  # media sequence number of next segment, default value is 0 if no #EXT-X-MEDIA-SEQUENCE tag
+        byte_range = None  # #EXT-X-BYTERANGE value of next segment
+        url_index = -1  # line index of last segment url
+
         for i, line in enumerate(lines):
 
             if line.startswith('#EXT-X-VERSION'):
@@ -1121,6 +1669,10 @@ class MediaPlaylist:
                 self.playlist_type = line.split(':')[1]
             elif line.startswith('#EXT-X-MEDIA-SEQUENCE'):
                 self.media_sequence = line.split(':')[1]
+                try:
+                    seq = int(self.media_sequence)
+                except:
+                    pass
             elif line.startswith('#EXT-X-TARGETDURATION'):
                 self.max_seg_duration = line.split(':')[1]
 
@@ -1131,7 +1683,11 @@ class MediaPlaylist:
                 key.url = info.get('URI')
                 key.method = info.get('METHOD')
                 key.iv = info.get('IV')
-                if key.method and key.url:
+                if key.method == 'NONE':
+                    # following segments are not encrypted
+                    self.current_key = None
+
+                elif key.method and key.url:
                     if key.url.startswith('skd://'):
                         # replace skd:// with https://
                         key.url = key.url.replace('skd://', 'https://')
@@ -1149,11 +1705,25 @@ class MediaPlaylist:
                 except:
                     pass
 
-                next_line = lines[i + 1]
+                # segment url is the next non tag line, #EXT-X-BYTERANGE tag might come before or after #EXTINF
+                # example: #EXT-X-BYTERANGE:75232@0, where 75232 is sub-range length and 0 is start offset
+                next_line = None
+                for url_index in range(i + 1, len(lines)):
+                    line_ = lines[url_index]
+                    if line_.startswith('#EXT-X-BYTERANGE'):
+                        byte_range = line_.split(':')[1]
+                    elif not line_.startswith('#'):
+                        next_line = line_
+                        break
+                    elif line_.startswith('#EXTINF'):
+                        break
+
                 seg = Segment()
-                seg.url = next_line if not next_line.startswith('#') else None
+                seg.url = next_line
                 seg.duration = self.seg_duration
                 seg.key = copy.copy(self.current_key)
+                seg.seq = seq
+                seq += 1
 
                 if seg.url:
                     if seg.url.startswith('skd://'):
@@ -1161,19 +1731,69 @@ class MediaPlaylist:
                         seg.url = seg.url.replace('skd://', 'https://')
 
                     seg.url = urljoin(self.url, seg.url)
+
+                    if byte_range:
+                        try:
+                            length, _, offset = byte_range.partition('@')
+                            if offset:
+                                start = int(offset)
+                            else:
+                                # no offset, sub-range begins at the next byte following previous segment's sub-range
+                                prev_seg = self.segments[-1] if self.segments else None
+                                prev_range = prev_seg.byte_range if prev_seg and prev_seg.url == seg.url else None
+                                start = prev_range[1] + 1 if prev_range else 0
+
+                            seg.byte_range = [start, start + int(length) - 1]
+                        except:
+                            log('MediaPlaylist.parse_m3u8_doc()> invalid byte range:', byte_range)
+                        byte_range = None
+
                     self.segments.append(seg)
 
+            elif line.startswith('#EXT-X-BYTERANGE') and i > url_index:
+                # tag before #EXTINF, will be used with next segment, tags after #EXTINF are already handled above
+                byte_range = line.split(':')[1]
+
             elif line.startswith('#EXT-X-ENDLIST'):
                 # print('end of playlist')
+                self.ended = True
                 break
 
-        # naming
+        if self.segments:
+            self.last_seq = self.segments[-1].seq
+
+        # naming, live playlist segments are named by media sequence number to stay unique across playlist reloads
+        self.name_segments(by_seq=self.live)
+
+    def name_segments(self, by_seq=False):
         for i, seg in enumerate(self.segments):
-            seg.name = os.path.join(self.d.temp_folder, f'{self.stream_type}_seg_{i + 1}.ts')
+            seg_num = seg.seq if by_seq else i + 1
+            seg.name = os.path.join(self.d.temp_folder, f'{self.stream_type}_seg_{seg_num}.ts')
 
             if seg.key:
                 seg.key.name = f'{seg.name}.key'
 
+    @property
+    def live(self):
+        """live or event playlist which will get new segments over time"""
+        return not self.ended and self.playlist_type != 'VOD'
+
+    def refresh(self, m3u8_doc):
+        """
+        update live playlist from a reloaded m3u8 doc
+        :param m3u8_doc: string representation of reloaded m3u8 doc
+        :return: segment list, new segments only, diffed by media sequence number
+        """
+        playlist = MediaPlaylist(self.d, self.url, m3u8_doc, self.stream_type)
+        playlist.segments = [seg for seg in playlist.segments if seg.seq > self.last_seq]
+        playlist.name_segments(by_seq=True)
+
+        self.ended = playlist.ended
+        if playlist.segments:
+            self.last_seq = playlist.segments[-1].seq
+
+        return playlist.create_segment_list()
+
     def summary(self):
         print('M3u8 playlist')
         print('url:', self.url)
@@ -1197,10 +1817,18 @@ class MediaPlaylist:
         lines.append(f'#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}')
 
         # segments
+        encrypted = False
         for seg in segments:
             if seg.key:
                 lines.append(seg.key.create_line())
+            elif encrypted:
+                # previous segments were encrypted, but not this one
+                lines.append('#EXT-X-KEY:METHOD=NONE')
+            encrypted = bool(seg.key)
             lines.append(f'#EXTINF:{seg.duration},')
+            if seg.byte_range:
+                a, b = seg.byte_range
+                lines.append(f'#EXT-X-BYTERANGE:{b - a + 1}@{a}')
             lines.append(seg.url)
 
         # end of playlist
@@ -1217,55 +1845,94 @@ class MediaPlaylist:
         segments = copy.deepcopy(self.segments)
         for seg in segments:
             seg.url = seg.name.replace('\\', '/')
+            seg.byte_range = None  # local segment file has sub-range contents only
 
             if seg.key:
                 seg.key.url = seg.key.name.replace('\\', '/')
 
         return self.create_m3u8_doc(segments)
 
+    def can_decrypt(self):
+        """return True if all encrypted segments can be decrypted in-process while downloading"""
+        return AES is not None and all(seg.key.method == 'AES-128' for seg in self.segments if seg.key)
+
+    def coalesce_segments(self):
+        """
+        combine adjacent #EXT-X-BYTERANGE segments of the same url in one segment, encrypted segments are excluded
+        since every segment has its own iv
+        :return: list of segments
+        """
+        segments = []
+        group = []  # consecutive non-encrypted segments with same url and byte ranges
+
+        def add_group():
+            if len(group) > 1:
+                start = 0
+                for span, parts in coalesce_ranges([seg.byte_range for seg in group]):
+                    members = group[start: start + len(parts)]
+                    start += len(parts)
+
+                    seg = copy.copy(members[0])
+                    seg.byte_range = span
+                    seg.duration = sum(x.duration for x in members)
+
+                    # name of combined segments i.e. video_seg_3-5.ts, for segments from video_seg_3.ts to video_seg_5.ts
+                    if len(members) > 1:
+                        name, ext = os.path.splitext(seg.name)
+                        last_num = os.path.splitext(members[-1].name)[0].rsplit('_', 1)[-1]
+                        seg.name = f'{name}-{last_num}{ext}'
+
+                    # drop gaps between sub-ranges while merging
+                    if sum(b - a + 1 for a, b in parts) < span[1] - span[0] + 1:
+                        seg.parts = [[a - span[0], b - span[0]] for a, b in parts]
+
+                    segments.append(seg)
+            else:
+                segments.extend(group)
+
+            group.clear()
+
+        for seg in self.segments:
+            if group and not (seg.byte_range and not seg.key and seg.url == group[-1].url):
+                add_group()
+
+            if seg.byte_range and not seg.key:
+                group.append(seg)
+            else:
+                segments.append(seg)
+
+        add_group()
+
+        if len(segments) < len(self.segments):
+            log(f'MediaPlaylist.coalesce_segments()> {self.stream_type}: combined {len(self.segments)} segments '
+                f'into {len(segments)} segments', log_level=3)
+
+        return segments
+
     def create_segment_list(self):
 
-        merge = 'encrypted' not in self.d.subtype_list  # merge non-encrypted streams only
+        # merge non-encrypted streams, or encrypted streams which will be decrypted in-process
+        merge = 'encrypted' not in self.d.subtype_list or self.can_decrypt()
         temp_file = self.d.temp_file if self.stream_type == 'video' else self.d.audio_file
+        media_type = MediaType.video if self.stream_type == 'video' else MediaType.audio
 
         segment_list = []
-        segments = self.segments.copy()
+        segments = self.coalesce_segments() if merge else self.segments.copy()
 
         # Segment(name=seg_name, num=i, range=None, size=0, url=abs_url, tempfile=d.temp_file, merge=merge)
         for i, seg in enumerate(segments):
+            # key comes first, it must be downloaded before its segment get decrypted and merged
             seg_key_pair = [seg]
             if seg.key:
-                seg_key_pair.append(seg.key)
+                seg_key_pair.insert(0, seg.key)
 
             for segment in seg_key_pair:
                 segment.num = i
                 segment.range = None
-                segment.size = 0
+                segment.size = segment.byte_range[1] - segment.byte_range[0] + 1 if segment.byte_range else 0
                 segment.tempfile = temp_file
-                segment.merge = merge
+                segment.merge = merge and segment is not seg.key  # never merge keys
+                segment.media_type = MediaType.key if segment is seg.key else media_type
                 segment_list.append(segment)
 
         return segment_list
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -9,10 +9,14 @@
 
 # worker class
 import os
+import re
+import time
 import pycurl
 
+from . import config, retry, storage
 from .config import Status, error_q, jobs_q, max_seg_retries
-from .utils import log, set_curl_options, size_format, translate_server_code
+from .utils import (log, set_curl_options, size_format, translate_server_code, mark_range_ignored, validator_headers,
+                    get_validators, validators_match, get_if_range)
 
 
 class Worker:
@@ -21,10 +25,17 @@ class Worker:
         self.d = d
         self.seg = None
         self.resume_range = None
+        self.requested_range = None  # range sent to server, segment range might be changed later by thread manager
+
+        # batch of consecutive segments to be downloaded after current segment, over the same curl handle / connection
+        self.batch = []
 
         # writing data parameters
         self.file = None
         self.mode = 'wb'  # file opening mode default to new write binary
+        self.writer = None  # device's disk writer, see storage.DiskWriter
+        self.paused = False  # curl transfer paused until disk writer has space in its queue
+        self.start_size = 0  # segment file size before this request, i.e. resumed segment
 
         self.downloaded = 0
 
@@ -32,6 +43,8 @@ class Worker:
         self.c = pycurl.Curl()
         self.speed_limit = 0
         self.headers = {}
+        self.response_code = 0  # http status code of current response
+        self.html_received = False  # server sent an html page instead of file contents
 
         # minimum speed and timeout, abort if download speed slower than n byte/sec during n seconds
         self.minimum_speed = None
@@ -39,13 +52,16 @@ class Worker:
 
         self.print_headers = True
 
+        # time between sending request and receiving first byte, in seconds, used to adapt fragments batch size
+        self.rtt = 0
+
     def __repr__(self):
         return f"worker_{self.tag}"
 
-    def reuse(self, seg=None, speed_limit=0, minimum_speed=None, timeout=None):
+    def reuse(self, seg=None, speed_limit=0, minimum_speed=None, timeout=None, batch=None):
         """Recycle same object again, better for performance as recommended by curl docs"""
         if seg.locked:
-            log('Seg', self.seg.basename, 'segment in use by another worker', '- worker', {self.tag}, log_level=2)
+            log('Seg', seg.basename, 'segment in use by another worker', '- worker', {self.tag}, log_level=2)
             return False
 
         self.reset()
@@ -55,6 +71,11 @@ class Worker:
         # set lock
         self.seg.locked = True
 
+        # lock batch segments too, they will be downloaded after this segment
+        self.batch = [x for x in batch or [] if x is not seg]
+        for x in self.batch:
+            x.locked = True
+
         self.speed_limit = speed_limit
 
         # minimum speed and timeout, abort if download speed slower than n byte/sec during n seconds
@@ -80,9 +101,16 @@ class Worker:
         # reset variables
         self.file = None
         self.mode = 'wb'  # file opening mode default to new write binary
+        self.writer = None
+        self.paused = False
+        self.start_size = 0
         self.downloaded = 0
         self.resume_range = None
+        self.requested_range = None
         self.headers = {}
+        self.response_code = 0
+        self.html_received = False
+        self.byte_range_ignored = False  # server ignored range of a byte_range segment, see check_range()
 
         self.print_headers = True
 
@@ -127,9 +155,9 @@ class Worker:
                 f.truncate(self.seg.size)
 
         # Case-3: Resume, with new range
-        elif self.seg.range and self.seg.current_size < self.seg.size:
+        elif (self.seg.range or self.seg.byte_range) and self.seg.current_size < self.seg.size:
             # set new range and file open mode
-            a, b = self.seg.range
+            a, b = self.seg.range or self.seg.byte_range
             self.resume_range = [a + self.seg.current_size, b]
             self.mode = 'ab'  # open file for append
 
@@ -182,12 +210,20 @@ class Worker:
 
     def set_options(self):
 
+        http_headers = self.d.http_headers or config.HEADERS
+
+        # remote file must be the same one which other segments downloaded from, otherwise server sends the whole
+        # new file, see check_validators()
+        if_range = get_if_range(self.d.validators.get(self.seg.stream, {})) if self.seg.range else None
+        if if_range:
+            http_headers = dict(http_headers, **{'If-Range': if_range})
+
         # set general curl options
-        set_curl_options(self.c, http_headers=self.d.http_headers)
+        set_curl_options(self.c, http_headers=http_headers)
 
         self.c.setopt(pycurl.URL, self.seg.url)
 
-        range_ = self.resume_range or self.seg.range
+        range_ = self.requested_range = self.resume_range or self.seg.range or self.seg.byte_range
         if range_:
             self.c.setopt(pycurl.RANGE, f'{range_[0]}-{range_[1]}')  # download segment only not the whole file
 
@@ -213,14 +249,21 @@ class Worker:
 
     def header_callback(self, header_line):
         header_line = header_line.decode('iso-8859-1')
-        header_line = header_line.lower()
+
+        # status line of every response "including redirections", i.e. http/1.1 206 partial content
+        if header_line.lower().startswith('http/'):
+            try:
+                self.response_code = int(header_line.split()[1])
+            except (IndexError, ValueError):
+                pass
+            return
 
         if ':' not in header_line:
             return
 
         name, value = header_line.split(':', 1)
-        name = name.strip()
-        value = value.strip()
+        name = name.strip().lower()
+        value = value.strip() if name in validator_headers else value.strip().lower()
         self.headers[name] = value
 
         # update segment size if not available
@@ -240,8 +283,13 @@ class Worker:
         if self.d.status != Status.downloading:
             return -1  # abort
 
+        # resume transfer paused by write(), disk writer has space in its queue
+        if self.paused and not self.writer.full:
+            self.paused = False
+            self.c.pause(pycurl.PAUSE_CONT)
+
         if self.headers and self.headers.get('content-range') and self.print_headers:
-            range_ = self.resume_range or self.seg.range
+            range_ = self.resume_range or self.seg.range or self.seg.byte_range
             log('Seg', self.seg.basename, 'range:', range_, 'server headers, range, size',
                 self.headers.get('content-range'), self.headers.get('content-length'), log_level=3)
             self.print_headers = False
@@ -251,6 +299,30 @@ class Worker:
         error_q.put(description)
 
     def run(self):
+        """download current segment, then segments batch one by one, curl handle keeps the connection alive"""
+        completed = self.download()
+
+        while completed and self.batch and self.d.status == Status.downloading:
+            seg = self.batch.pop(0)
+            seg.locked = False  # reuse() will lock it again
+            if not self.reuse(seg=seg, speed_limit=self.speed_limit, minimum_speed=self.minimum_speed,
+                              timeout=self.timeout, batch=self.batch):
+                break
+
+            completed = self.download()
+
+        # send unfinished batch segments back to thread manager
+        for seg in self.batch:
+            seg.locked = False
+            jobs_q.put(seg)
+        self.batch = []
+
+    def download(self):
+        """download current segment
+        :return: True if segment completed
+        """
+        completed = False
+        response_code = curl_errno = 0
         try:
 
             # check if file completed before and exit
@@ -264,6 +336,43 @@ class Worker:
             # record retries
             self.seg.retries += 1
 
+            response_code, curl_errno = self.transfer()
+
+            # link is working, previous errors weren't caused by an expired link
+            if self.downloaded and self.d.link_errors:
+                self.d.link_errors = []
+
+        except Exception as e:
+            log('Seg', self.seg.basename, '- worker', self.tag, 'quitting ...', repr(e), log_level=3)
+
+        finally:
+            # check if download completed
+            completed = self.verify()
+            if completed:
+                self.report_completed()
+                retry.report_success(self.seg.url)
+            else:
+                # if segment not fully downloaded send it back to thread manager to try again
+                self.report_not_completed()
+
+                # retry delay, and connections reduction
+                self.handle_failure(response_code, curl_errno)
+
+                # put back to jobs queue to try again
+                jobs_q.put(self.seg)
+
+            # remove segment lock
+            self.seg.locked = False
+
+        return completed
+
+    def transfer(self):
+        """
+        send request and write received data to segment file
+        :return: http status code, and curl error number, zero if no curl error
+        """
+        response_code = curl_errno = 0
+        try:
             # set options
             self.set_options()
 
@@ -274,49 +383,172 @@ class Worker:
 
             # open segment file
             self.file = open(self.seg.name, self.mode, buffering=0)
+            self.start_size = self.seg.current_size if self.mode == 'ab' else 0
+
+            # data will be written by device's disk writer thread
+            self.writer = storage.get_writer(self.seg.name) if config.use_disk_writers else None
 
             # Main Libcurl operation
             self.c.perform()
 
+            # time to first byte, approximately one round trip plus server processing time
+            self.rtt = self.c.getinfo(pycurl.STARTTRANSFER_TIME) - self.c.getinfo(pycurl.PRETRANSFER_TIME)
+
             # get response code and check for connection errors
             response_code = self.c.getinfo(pycurl.RESPONSE_CODE)
             if response_code in range(400, 512):
                 log('Seg', self.seg.basename, 'server refuse connection', response_code, translate_server_code(response_code),
                     'content type:', self.headers.get('content-type'), log_level=3)
 
-                # send error to thread manager, it will reduce connections number to fix this error
-                self.report_error(f'server refuse connection: {response_code}, {translate_server_code(response_code)}')
-
         except Exception as e:
+            if isinstance(e, pycurl.error):
+                curl_errno = e.args[0]
+                response_code = self.c.getinfo(pycurl.RESPONSE_CODE)
+
             # this error generated when user cancel download, or write function abort
-            if any(statement in repr(e) for statement in ('Failed writing body', 'Callback aborted')):
+            if any(statement in repr(e) for statement in ('Failed writing body', 'Failure writing output',
+                                                          'Callback aborted')):
                 error = f'terminated'
                 log('Seg', self.seg.basename, error, 'worker', self.tag, log_level=3)
             else:
                 error = repr(e)
                 log('Seg', self.seg.basename, '- worker', self.tag, 'quitting ...', error, log_level=3)
 
-                # report server error to thread manager
-                self.report_error(repr(e))
-
         finally:
-            # close segment file handle
+            # close segment file handle, after queued data written by disk writer
             if self.file:
+                if self.writer:
+                    error = self.writer.flush(self.file)
+                    if error:
+                        log('Seg', self.seg.basename, 'disk write error:', error, '- worker', self.tag)
                 self.file.close()
 
-            # check if download completed
-            completed = self.verify()
-            if completed:
-                self.report_completed()
-            else:
-                # if segment not fully downloaded send it back to thread manager to try again
-                self.report_not_completed()
+        return response_code, curl_errno
 
-                # put back to jobs queue to try again
-                jobs_q.put(self.seg)
+    def handle_failure(self, response_code, curl_errno):
+        """
+        classify segment failure and apply retry policy, see retry.py
+        :param response_code: http status code
+        :param curl_errno: curl error number, zero if no curl error
+        :return: None
+        """
+        # byte_range segments are slices of a resource shared with other segments, i.e. hls #EXT-X-BYTERANGE, they
+        # can't be downloaded without ranges, retrying won't help
+        if self.byte_range_ignored and self.d.status == Status.downloading:
+            retry.report_failure(self.seg.url, 'aborted')
+            log('Seg', self.seg.basename, 'failed, server ignored byte range:', self.seg.byte_range, showpopup=True)
+            self.d.status = Status.error
+            return
 
-            # remove segment lock
-            self.seg.locked = False
+        error_class = retry.classify(response_code, curl_errno, html=self.html_received)
+
+        # cancelled by user, or aborted by write callback which reports its own errors
+        if error_class == 'aborted' or self.d.status != Status.downloading:
+            # resolve circuit breaker probe, if this request was the probe
+            retry.report_failure(self.seg.url, 'aborted')
+            return
+
+        retry_after = retry.parse_retry_after(self.headers.get('retry-after'))
+        retry.report_failure(self.seg.url, error_class, retry_after)
+
+        # thread manager will not start this segment before retry time
+        delay = retry.backoff_delay(error_class, self.seg.retries, retry_after)
+        self.seg.retry_time = time.time() + delay
+
+        description = f'{error_class}: {response_code or ""} {translate_server_code(response_code) if response_code else ""}' \
+                      f'{f" curl error {curl_errno}" if curl_errno else ""}'
+        log('Seg', self.seg.basename, description, '- retry after', round(delay, 1), 'seconds', '- worker', self.tag,
+            log_level=3)
+
+        # send error to thread manager, it will reduce connections number to fix this error
+        if retry.policies[error_class]['reduce']:
+            self.report_error(description)
+
+        # might be an expired link, thread manager will get a fresh link after a burst of these errors
+        expiry = retry.policies[error_class]['expiry'] and config.auto_refresh_link and self.d.link_refreshable
+        if expiry:
+            self.d.link_errors.append(time.time())
+
+        # network errors are counted per host, segments wait for circuit breaker probes, their own retries grow slowly
+        retries = retry.host_failures(self.seg.url) if error_class == 'network' else self.seg.retries
+
+        # give up, i.e. expired link, unless thread manager will refresh it
+        if retry.is_fatal(error_class, retries) and not expiry:
+            log('Seg', self.seg.basename, 'failed', retries, 'times with', description,
+                '- maybe network problem' if error_class == 'network' else '- maybe expired link', showpopup=True)
+            self.d.status = Status.error
+
+    def check_validators(self):
+        """
+        compare remote file validators "etag, last-modified, size" from response headers with the stored ones, data
+        from a changed file can't be mixed with previously downloaded segments
+        :return: True if remote file not changed
+        """
+        # only ranged segments are parts of the same remote file
+        if not self.seg.range:
+            return True
+
+        validators = get_validators(self.headers)
+        stored = self.d.validators.get(self.seg.stream)
+
+        # first response for this stream, i.e. dash audio
+        if not stored:
+            if validators:
+                self.d.validators[self.seg.stream] = validators
+            return True
+
+        if validators_match(stored, validators):
+            return True
+
+        log('Seg', self.seg.basename, 'remote file changed:', stored, '- new:', validators, '- worker', self.tag,
+            log_level=2)
+
+        # thread manager will discard downloaded data and start over, see restart_download()
+        self.d.validators[self.seg.stream] = validators
+        self.d.remote_changed = True
+
+        return False
+
+    def check_range(self):
+        """
+        validate server response against requested range, some servers ignore range header and send the whole file
+        with "200 OK", or send a different range
+        :return: True if response matches requested range or no range requested
+        """
+        # segment range might be shrunk by thread manager after sending request, compare with what we asked for
+        range_ = self.requested_range
+        if not range_:
+            return True
+
+        # getinfo() can't be used while transfer is running, status code is taken from headers instead
+        response_code = self.response_code
+        match = re.match(r'bytes (\d+)-(\d+)/', self.headers.get('content-range', ''))
+
+        # partial content, start must match, end might be less than requested if requested range exceeds file size
+        if response_code == 206 and match:
+            start, end = int(match.group(1)), int(match.group(2))
+            if start == range_[0] and end <= range_[1]:
+                return True
+
+        # whole file requested
+        elif response_code == 200 and range_[0] == 0 and self.headers.get('content-length') == str(range_[1] + 1):
+            return True
+
+        log('Seg', self.seg.basename, 'server ignored range:', range_, '- response:', response_code,
+            self.headers.get('content-range'), '- worker', self.tag, log_level=2)
+
+        mark_range_ignored(self.seg.url)
+
+        # byte_range segment fails, see handle_failure(), otherwise thread manager will fall back to one connection
+        # without ranges, see thread_manager()
+        if self.seg.byte_range and not self.seg.range:
+            self.byte_range_ignored = True
+        elif self.seg.range or self.resume_range:
+            self.d.resumable = False
+        else:
+            self.report_error('server ignored range')
+
+        return False
 
     def write(self, data):
         """write to file"""
@@ -331,29 +563,45 @@ class Worker:
 
                     log('=' * 20, data, '=' * 20, sep='\n', start='', log_level=3)
 
-                    # report server error to thread manager
-                    self.report_error('received html contents')
+                    # will be handled as a server error, see handle_failure()
+                    self.html_received = True
 
                     return -1  # abort
             except Exception as e:
                 pass
                 # log('worker:', e)
 
-        # write to file
-        self.file.write(data)
+        # validate remote file and range with first received data, before writing anything, html error pages are
+        # handled above
+        if not self.downloaded and not (self.check_validators() and self.check_range()):
+            return -1  # abort
+
+        # write to file, or hand data to disk writer, if its queue is full for a while, transfer will be paused and
+        # curl will pass the same data again after resuming, see progress()
+        if self.writer:
+            try:
+                if not self.writer.submit(self.file, data, wait=0.1):
+                    self.paused = True
+                    return pycurl.WRITEFUNC_PAUSE
+            except OSError as e:
+                log('Seg', self.seg.basename, 'disk write error:', e, '- worker', self.tag)
+                return -1  # abort
+        else:
+            self.file.write(data)
 
         self.downloaded += len(data)
 
         # report to download item
         self.d.downloaded += len(data)
 
-        # check if we getting over sized
-        if self.seg.current_size > self.seg.size > 0:
+        # check if we getting over sized, segment file size on disk might be behind while data in disk writer queue
+        current_size = self.start_size + self.downloaded
+        if current_size > self.seg.size > 0:
             log('Seg', self.seg.basename, 'oversized:',
-                'current segment size:', self.seg.current_size, ' - worker', self.tag, log_level=3)
+                'current segment size:', current_size, ' - worker', self.tag, log_level=3)
 
             # re-adjust value of total downloaded data
-            self.d.downloaded -= self.seg.current_size - self.seg.size
+            self.d.downloaded -= current_size - self.seg.size
             return -1  # abort
 
 
@@ -0,0 +1,101 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# throughput of in-process worker threads vs. multi-process engine "config.use_process_engine", see engine.py
+# a file is served from memory by a local server, so results show download manager's own cpu cost, not network speed
+# run: python tests/benchmark_engine.py --size 200 --connections 16 --rounds 3
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_server import Server
+from pyidm import config, brain, engine
+from pyidm.downloaditem import DownloadItem
+
+
+def run(server, data, folder, use_engine):
+    """
+    download test file once
+    :return: seconds, or None if failed
+    """
+    config.use_process_engine = use_engine
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    d = DownloadItem(url=server.url + '/file.bin', folder=folder)
+    d.update(d.url)
+
+    start = time.time()
+    brain.brain(d)
+    seconds = time.time() - start
+
+    with open(d.target_file, 'rb') as f:
+        if d.status != config.Status.completed or f.read() != data:
+            return None
+
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='threads vs. processes download throughput')
+    parser.add_argument('--size', type=int, default=100, help='file size in MB')
+    parser.add_argument('--connections', type=int, default=16, help='max connections')
+    parser.add_argument('--segment', type=int, default=1024, help='segment size in KB')
+    parser.add_argument('--rounds', type=int, default=2, help='downloads per method')
+    parser.add_argument('--processes', type=int, default=0, help='engine processes, 0 = cpu cores count')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 1024 * 1024)
+    server = Server().start()
+    server.files['/file.bin'] = data
+    root = tempfile.mkdtemp()
+
+    config.max_connections = args.connections
+    config.segment_size = args.segment * 1024
+    config.engine_processes = args.processes
+    config.headers_cache_ttl = 0
+    config.log_level = 0
+
+    # start engine processes before measuring
+    engine.get_pool()
+
+    results = {'threads': [], 'engine': []}
+    for i in range(args.rounds):
+        for method in results:
+            seconds = run(server, data, os.path.join(root, method), use_engine=method == 'engine')
+            results[method].append(seconds)
+
+    print(f'file: {args.size} MB, connections: {args.connections}, segment: {args.segment} KB, '
+          f'engine processes: {engine.get_pool().size}, cpu cores: {os.cpu_count()}')
+
+    for method, times in results.items():
+        if None in times:
+            print(f'{method:8} failed')
+            continue
+
+        best = min(times)
+        print(f'{method:8} best: {best:.2f} s, {len(data) / best / 1e6:.0f} MB/s, '
+              f'all: {", ".join(f"{t:.2f}" for t in times)}')
+
+    shutil.rmtree(root, ignore_errors=True)
+    server.shutdown()
+
+    # engine child processes are daemons, don't wait for engine threads
+    os._exit(0)
+
+
+# engine uses spawn start method, child processes import this module, main() must not run there
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# local http server for tests, serves files from memory with range support, and counts requests
+
+import re
+import socketserver
+import http.server
+from threading import Thread
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self):
+        self.files = {}  # key: path, value: bytes
+        self.dynamic = {}  # key: path, value: function which returns bytes, i.e. a growing live playlist
+        self.ignore_range = set()  # paths which answer ranged requests with the whole file
+        self.requests = []  # list of (path, range header)
+        super().__init__(('127.0.0.1', 0), Handler)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients abort transfers on purpose, i.e. segment range shrunk by thread manager
+        pass
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        range_header = self.headers.get('Range')
+        server.requests.append((path, range_header))
+
+        if path in server.dynamic:
+            data = server.dynamic[path]()
+        elif path in server.files:
+            data = server.files[path]
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        match = re.match(r'bytes=(\d+)-(\d*)', range_header or '')
+        if match and path not in server.ignore_range:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            body = data
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
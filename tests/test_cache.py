@@ -0,0 +1,119 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# local download cache, see cache.py
+# run: python -m unittest discover tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from local_server import Server
+from pyidm import config, brain, cache
+from pyidm.downloaditem import DownloadItem
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.server = Server().start()
+        self.folder = tempfile.mkdtemp()
+        self.data = os.urandom(2 * 1024 * 1024)
+        self.server.files['/setup.exe'] = self.data
+        self.server.files['/mirror/setup.exe'] = self.data
+
+        # settings changed by tests, restored in tearDown()
+        self.settings = {key: getattr(config, key) for key in ('use_download_cache', 'download_cache_folder',
+                                                                'download_cache_min_size', 'headers_cache_ttl',
+                                                                'write_metadata')}
+        config.use_download_cache = True
+        config.download_cache_folder = os.path.join(self.folder, 'cache')
+        config.download_cache_min_size = 0
+        config.headers_cache_ttl = 0
+        cache.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        cache.clear()
+        config.__dict__.update(self.settings)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def download(self, path, folder, name=None):
+        """
+        :return: DownloadItem object, and number of requests sent to server for file contents
+        """
+        folder = os.path.join(self.folder, folder)
+        os.makedirs(folder, exist_ok=True)
+
+        d = DownloadItem(url=self.server.url + path, folder=folder)
+        d.update(d.url)
+        if name:
+            d.name = name
+
+        requests = len(self.server.requests)
+        brain.brain(d)
+
+        self.assertEqual(d.status, config.Status.completed)
+        with open(d.target_file, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+        return d, len(self.server.requests) - requests
+
+    def test_hit(self):
+        """same file in another folder is restored from cache without downloading it"""
+        self.download('/setup.exe', 'a')
+        d, requests = self.download('/setup.exe', 'b')
+
+        self.assertEqual(requests, 0)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_extension_change(self):
+        """output options are part of cache key, other target extension is a miss, same extension is a hit"""
+        self.download('/setup.exe', 'a')
+
+        d, requests = self.download('/setup.exe', 'b', name='setup.bin')
+        self.assertGreater(requests, 0)
+
+        d, requests = self.download('/setup.exe', 'c', name='renamed.exe')
+        self.assertEqual(requests, 0)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_video_key(self):
+        """video key has selected formats and output options"""
+        d = DownloadItem(url='https://Example.com:443/watch?v=1#t=10', name='video.mp4')
+        d.format_id, d.audio_format_id = '137', '140'
+        key = cache.get_key(d)
+
+        d.name = 'video.mkv'
+        self.assertNotEqual(cache.get_key(d), key)
+
+        d.name = 'video.mp4'
+        d.metadata_file_content = ';FFMETADATA1\n'
+        config.write_metadata = True
+        self.assertNotEqual(cache.get_key(d), key)
+
+        d.metadata_file_content = ''
+        self.assertEqual(cache.get_key(d), key)
+        self.assertIn('https://example.com/watch?v=1|137|140', key)
+
+    def test_deduplication(self):
+        """same contents from another url is stored once, target file becomes a hardlink to cached object"""
+        a, _ = self.download('/setup.exe', 'a')
+        b, _ = self.download('/mirror/setup.exe', 'b')
+
+        stats = cache.stats()
+        self.assertEqual((stats['files'], stats['deduplicated']), (1, 1))
+        self.assertTrue(os.path.samefile(a.target_file, b.target_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
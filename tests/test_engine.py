@@ -0,0 +1,75 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# multi-process download engine, segments downloaded in child processes, see engine.py
+# throughput comparison with worker threads: python tests/benchmark_engine.py
+# run: python -m unittest discover tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from local_server import Server
+from pyidm import config, brain, engine, utils
+from pyidm.downloaditem import DownloadItem
+
+
+class TestEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = Server().start()
+        self.folder = tempfile.mkdtemp()
+        self.data = os.urandom(8 * 1024 * 1024)
+        self.server.files['/file.bin'] = self.data
+
+        self.settings = {key: getattr(config, key) for key in ('use_process_engine', 'segment_size',
+                                                                'headers_cache_ttl')}
+        config.use_process_engine = True
+        config.segment_size = 512 * 1024
+        config.headers_cache_ttl = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        config.__dict__.update(self.settings)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def download(self):
+        d = DownloadItem(url=self.server.url + '/file.bin', folder=self.folder)
+        d.update(d.url)
+        brain.brain(d)
+
+        self.assertEqual(d.status, config.Status.completed)
+        with open(d.target_file, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+        return d
+
+    def test_download(self):
+        """segments downloaded by child processes, progress counted once"""
+        d = self.download()
+        self.assertEqual(d.downloaded, len(self.data))
+        self.assertGreater(len([r for _, r in self.server.requests if r]), 1)
+
+    def test_range_ignored(self):
+        """server ignores ranges, range check result comes back from child process, one connection fallback"""
+        self.server.ignore_range.add('/file.bin')
+        utils._range_ignoring_hosts.clear()
+        self.download()
+
+    def test_killed_process(self):
+        """dead child process is replaced, its segments are downloaded again"""
+        pool = engine.get_pool()
+        pool.processes[0].kill()
+        pool.processes[0].join()
+        self.download()
+
+
+if __name__ == '__main__':
+    unittest.main()
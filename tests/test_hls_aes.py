@@ -0,0 +1,113 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# AES-128 encrypted hls segments are decrypted in-process while merging, see video.decrypt_segment()
+# run: python -m unittest discover tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from local_server import Server
+from pyidm import config, brain
+from pyidm.video import AES
+from pyidm.downloaditem import DownloadItem
+
+
+def encrypt(key, iv, data):
+    pad = 16 - len(data) % 16
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(data + bytes([pad]) * pad)
+
+
+@unittest.skipIf(AES is None, 'pycryptodomex is not installed')
+class TestHlsAes(unittest.TestCase):
+    def setUp(self):
+        self.server = Server().start()
+        self.folder = tempfile.mkdtemp()
+        config.TEST_MODE = True
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def download(self, playlist):
+        self.server.files['/playlist.m3u8'] = '\n'.join(playlist).encode()
+
+        d = DownloadItem(url=self.server.url + '/playlist.m3u8', folder=self.folder, name='video.ts')
+        d.eff_url = d.url
+        d.subtype_list = ['hls']
+        d.type = 'video'
+        brain.brain(d)
+
+        return d
+
+    def test_byte_ranges(self):
+        """encrypted sub-ranges of one file, with unused bytes between them, iv comes from media sequence"""
+        key = os.urandom(16)
+        self.server.files['/key.bin'] = key
+
+        playlist = ['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:100',
+                    '#EXT-X-PLAYLIST-TYPE:VOD', '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"']
+        plain, blob = [], b''
+        for seq, size in enumerate([1000, 4096, 20000, 777], start=100):
+            data = os.urandom(size)
+            encrypted = encrypt(key, seq.to_bytes(16, 'big'), data)
+            blob += os.urandom(50)
+            playlist += ['#EXTINF:2.0,', f'#EXT-X-BYTERANGE:{len(encrypted)}@{len(blob)}', 'media.ts']
+            blob += encrypted
+            plain.append(data)
+
+        playlist.append('#EXT-X-ENDLIST')
+        self.server.files['/media.ts'] = blob
+
+        d = self.download(playlist)
+
+        self.assertEqual(d.status, config.Status.completed)
+        with open(d.target_file, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(plain))
+
+    def test_explicit_iv(self):
+        """segments with key rotation and explicit iv"""
+        plain = []
+        playlist = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-PLAYLIST-TYPE:VOD']
+        for i in range(3):
+            key, iv = os.urandom(16), os.urandom(16)
+            data = os.urandom(3000 + i)
+            self.server.files[f'/key{i}.bin'] = key
+            self.server.files[f'/seg{i}.ts'] = encrypt(key, iv, data)
+            playlist += [f'#EXT-X-KEY:METHOD=AES-128,URI="key{i}.bin",IV=0x{iv.hex()}', '#EXTINF:2.0,', f'seg{i}.ts']
+            plain.append(data)
+
+        playlist.append('#EXT-X-ENDLIST')
+
+        d = self.download(playlist)
+
+        self.assertEqual(d.status, config.Status.completed)
+        with open(d.target_file, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(plain))
+
+    def test_byte_range_ignored(self):
+        """server which ignores ranges can't serve sub-range segments, download fails instead of retrying forever"""
+        self.server.files['/key.bin'] = key = os.urandom(16)
+        self.server.files['/media.ts'] = encrypt(key, bytes(16), os.urandom(5000)) * 2
+        self.server.ignore_range.add('/media.ts')
+
+        playlist = ['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-TARGETDURATION:2', '#EXT-X-PLAYLIST-TYPE:VOD',
+                    '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"', '#EXTINF:2.0,', '#EXT-X-BYTERANGE:5008@0', 'media.ts',
+                    '#EXTINF:2.0,', '#EXT-X-BYTERANGE:5008@5008', 'media.ts', '#EXT-X-ENDLIST']
+
+        d = self.download(playlist)
+
+        self.assertEqual(d.status, config.Status.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+    PyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# live hls recording, playlist is reloaded and new segments are appended until stream ends, see video.record_live_hls()
+# run: python -m unittest discover tests
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+
+from local_server import Server
+from pyidm import config, brain
+from pyidm.video import AES
+from pyidm.downloaditem import DownloadItem
+
+SEGMENTS = 6  # total number of segments in stream
+WINDOW = 3  # segments listed in playlist at once
+TIMEOUT = 30  # seconds
+
+
+class TestLiveHls(unittest.TestCase):
+    def setUp(self):
+        self.server = Server().start()
+        self.folder = tempfile.mkdtemp()
+        self.start = time.time()
+        self.key_line = None
+        config.TEST_MODE = True
+        config.record_live_hls = True
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def playlist(self):
+        """sliding window playlist, a new segment every second, ends after all segments are listed"""
+        end = min(int(time.time() - self.start) + WINDOW, SEGMENTS)
+        first = max(end - WINDOW, 0)
+
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:1', f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        if self.key_line:
+            lines.append(self.key_line)
+
+        for i in range(first, end):
+            lines += ['#EXTINF:1.0,', f's{i}.ts']
+
+        if end == SEGMENTS and time.time() - self.start > WINDOW + 1:
+            lines.append('#EXT-X-ENDLIST')
+
+        return '\n'.join(lines).encode()
+
+    def record(self):
+        self.server.dynamic['/live/playlist.m3u8'] = self.playlist
+
+        d = DownloadItem(url=self.server.url + '/live/playlist.m3u8', folder=self.folder, name='live.ts')
+        d.eff_url = d.url
+        d.subtype_list = ['hls']
+        d.type = 'video'
+
+        # segments which can't be merged are retried forever, give up after a time limit
+        thread = Thread(target=brain.brain, args=(d,), daemon=True)
+        thread.start()
+        thread.join(TIMEOUT)
+        if thread.is_alive():
+            d.status = config.Status.cancelled
+            self.fail(f'recording did not finish in {TIMEOUT} seconds')
+
+        return d
+
+    def test_rollover(self):
+        """segments which left the playlist window before being downloaded are still recorded, each one once"""
+        data = [os.urandom(10000 + i) for i in range(SEGMENTS)]
+        for i, segment in enumerate(data):
+            self.server.files[f'/live/s{i}.ts'] = segment
+
+        d = self.record()
+
+        self.assertEqual(d.status, config.Status.completed)
+        with open(d.target_file, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(data))
+
+        requested = [path for path, _ in self.server.requests if path.endswith('.ts')]
+        self.assertEqual(sorted(requested), sorted(f'/live/s{i}.ts' for i in range(SEGMENTS)))
+        self.assertEqual(d.finalize_info[config.MediaType.video][0], 'concat')
+
+    @unittest.skipIf(AES is None, 'pycryptodomex is not installed')
+    def test_encrypted(self):
+        """key files stay until their segments are merged, slow segments complete after their keys"""
+        key = os.urandom(16)
+        self.server.files['/live/key.bin'] = key
+        self.key_line = '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"'
+
+        data = [os.urandom(5000 + i) for i in range(SEGMENTS)]
+
+        def slow_segment(i):
+            def get():
+                time.sleep(1.5)
+                pad = 16 - len(data[i]) % 16
+                return AES.new(key, AES.MODE_CBC, i.to_bytes(16, 'big')).encrypt(data[i] + bytes([pad]) * pad)
+            return get
+
+        for i in range(SEGMENTS):
+            self.server.dynamic[f'/live/s{i}.ts'] = slow_segment(i)
+
+        d = self.record()
+
+        self.assertEqual(d.status, config.Status.completed)
+        with open(d.target_file, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(data))
+
+
+if __name__ == '__main__':
+    unittest.main()